@@ -7,6 +7,7 @@ class ChangesAppConfig(AppConfig):
     name = "changes"
 
     def ready(self):
-        from .signals import psh_validate_implement
+        from .signals import psh_invalidate_engage_context, psh_validate_implement
 
         post_save.connect(psh_validate_implement, sender="changes.Change")
+        post_save.connect(psh_invalidate_engage_context, sender="changes.Change")
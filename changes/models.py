@@ -79,13 +79,18 @@ class Change(models.Model):
     def is_engage_action(self):
         return "engage" in self.data
 
-    def async_refresh_engage_context(self):
+    def refresh_engage_context_task(self):
         from changes.tasks import refresh_engage_context
 
         engage = self.data["engage"]
-        refresh_engage_context.delay(
-            engage["integration_uuid"], engage["integration_action_uuid"]
+        return refresh_engage_context.si(
+            engage["integration_uuid"],
+            engage["integration_action_uuid"],
+            self.registrant_id,
         )
 
+    def async_refresh_engage_context(self):
+        self.refresh_engage_context_task().delay()
+
     def __str__(self):
         return str(self.id)
@@ -5,3 +5,13 @@ def psh_validate_implement(sender, instance, created, **kwargs):
         from .tasks import validate_implement
 
         validate_implement.apply_async(kwargs={"change_id": str(instance.id)})
+
+
+def psh_invalidate_engage_context(sender, instance, **kwargs):
+    """ Post save hook to remove the registrant's cached Engage context when a
+        Change is validated
+    """
+    if instance.validated:
+        from ndoh_hub.utils import engage_context_cache
+
+        engage_context_cache.invalidate(instance.registrant_id)
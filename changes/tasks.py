@@ -1,4 +1,6 @@
 import re
+from concurrent.futures import ThreadPoolExecutor
+from copy import deepcopy
 from datetime import datetime
 from itertools import chain as ichain
 from itertools import dropwhile, takewhile
@@ -6,7 +8,6 @@ from uuid import UUID
 
 import phonenumbers
 import pytz
-import requests
 from celery import chain
 from celery.exceptions import SoftTimeLimitExceeded
 from celery.task import Task
@@ -15,16 +16,17 @@ from demands import HTTPServiceError
 from django.conf import settings
 from django.utils import dateparse, translation
 from requests.exceptions import ConnectionError, HTTPError, RequestException, Timeout
-from seed_services_client.identity_store import IdentityStoreApiClient
 from seed_services_client.stage_based_messaging import StageBasedMessagingApiClient
 from six import iteritems
 
+from eventstore.models import Message
 from ndoh_hub import utils
 from ndoh_hub.celery import app
 from registrations.models import Registration, Source, SubscriptionRequest
 from registrations.tasks import (
     add_personally_identifiable_fields,
     delete_jembi_pii,
+    invalidate_subscription_check_cache,
     request_to_jembi_api,
 )
 
@@ -41,7 +43,7 @@ sbm_client = StageBasedMessagingApiClient(
     auth_token=settings.STAGE_BASED_MESSAGING_TOKEN,
 )
 
-is_client = IdentityStoreApiClient(
+is_client = utils.CachedIdentityStoreApiClient(
     api_url=settings.IDENTITY_STORE_URL, auth_token=settings.IDENTITY_STORE_TOKEN
 )
 
@@ -54,6 +56,36 @@ class ValidateImplement(Task):
     log = get_task_logger(__name__)
 
     # Helpers
+    def update_subscriptions(self, updates):
+        """ Applies the list of (subscription id, data) updates concurrently, with at
+        most SBM_MAX_CONCURRENT_REQUESTS requests to Stage Based Messaging at a time.
+
+        All of the updates are attempted, even if some of them fail. The failures are
+        logged, and then the first one is raised, so that the task fails the same way
+        that it would for a single failed update.
+        """
+        updates = list(updates)
+        if not updates:
+            return
+
+        workers = min(settings.SBM_MAX_CONCURRENT_REQUESTS, len(updates))
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = [
+                (id, pool.submit(sbm_client.update_subscription, id, data))
+                for id, data in updates
+            ]
+
+        errors = [(i, f.exception()) for i, f in futures if f.exception() is not None]
+        if errors:
+            self.log.error(
+                "Failed to update {} of {} subscriptions: {}".format(
+                    len(errors),
+                    len(updates),
+                    ", ".join("{}: {}".format(i, e) for i, e in errors),
+                )
+            )
+            raise errors[0][1]
+
     def deactivate_all(self, change):
         """ Deactivates all subscriptions for an identity
         """
@@ -63,8 +95,9 @@ class ValidateImplement(Task):
         )["results"]
 
         self.log.info("Deactivating all active subscriptions")
-        for active_sub in active_subs:
-            sbm_client.update_subscription(active_sub["id"], {"active": False})
+        self.update_subscriptions(
+            (active_sub["id"], {"active": False}) for active_sub in active_subs
+        )
 
         self.log.info("All subscriptions deactivated")
         return True
@@ -79,15 +112,17 @@ class ValidateImplement(Task):
         )["results"]
 
         self.log.info("Retrieving nurseconnect messagesets")
-        messagesets = sbm_client.get_messagesets()["results"]
+        messagesets = utils.messageset_catalogue.get_messagesets()
         nc_messageset_ids = [
             ms["id"] for ms in messagesets if "nurseconnect" in ms["short_name"]
         ]
 
         self.log.info("Deactivating active non-nurseconnect subscriptions")
-        for active_sub in active_subs:
-            if active_sub["messageset"] not in nc_messageset_ids:
-                sbm_client.update_subscription(active_sub["id"], {"active": False})
+        self.update_subscriptions(
+            (active_sub["id"], {"active": False})
+            for active_sub in active_subs
+            if active_sub["messageset"] not in nc_messageset_ids
+        )
 
         self.log.info("Non-nurseconnect subscriptions deactivated")
         return True
@@ -96,7 +131,7 @@ class ValidateImplement(Task):
         """ Deactivates nurseconnect subscriptions only
         """
         self.log.info("Retrieving messagesets")
-        messagesets = sbm_client.get_messagesets()["results"]
+        messagesets = utils.messageset_catalogue.get_messagesets()
         nc_messagesets = [
             ms for ms in messagesets if "nurseconnect" in ms["short_name"]
         ]
@@ -115,8 +150,9 @@ class ValidateImplement(Task):
             )
 
         self.log.info("Deactivating active nurseconnect subscriptions")
-        for active_sub in active_subs:
-            sbm_client.update_subscription(active_sub["id"], {"active": False})
+        self.update_subscriptions(
+            (active_sub["id"], {"active": False}) for active_sub in active_subs
+        )
 
     def deactivate_pmtct(self, change):
         """ Deactivates any pmtct subscriptions
@@ -128,7 +164,9 @@ class ValidateImplement(Task):
 
         self.log.info("Deactivating active pmtct subscriptions")
         for active_sub in active_subs:
-            messageset = sbm_client.get_messageset(active_sub["messageset"])
+            messageset = utils.messageset_catalogue.get_messageset(
+                active_sub["messageset"]
+            )
             if "pmtct" in messageset["short_name"]:
                 self.log.info("Deactivating messageset %s" % messageset["id"])
                 sbm_client.update_subscription(active_sub["id"], {"active": False})
@@ -146,7 +184,7 @@ class ValidateImplement(Task):
             return False
 
         whatsapp = False
-        messagesets = list(sbm_client.get_messagesets()["results"])
+        messagesets = utils.messageset_catalogue.get_messagesets()
         for sub in active_subs:
             lang = sub["lang"]
             for ms in messagesets:
@@ -209,10 +247,13 @@ class ValidateImplement(Task):
         has_active_whatsapp_pmtct_prebirth_sub = False
         has_active_momconnect_prebirth_sub = False
         has_active_whatsapp_momconnect_prebirth_sub = False
+        deactivate = []
 
         for active_sub in active_subs:
             self.log.info("Retrieving messageset")
-            messageset = sbm_client.get_messageset(active_sub["messageset"])
+            messageset = utils.messageset_catalogue.get_messageset(
+                active_sub["messageset"]
+            )
             if "pmtct_prebirth" in messageset["short_name"]:
                 if "whatsapp" in messageset["short_name"]:
                     has_active_whatsapp_pmtct_prebirth_sub = True
@@ -224,8 +265,10 @@ class ValidateImplement(Task):
                     has_active_whatsapp_momconnect_prebirth_sub = True
                 lang = active_sub["lang"]
             if "prebirth" in messageset["short_name"]:
-                self.log.info("Deactivating subscription")
-                sbm_client.update_subscription(active_sub["id"], {"active": False})
+                deactivate.append(active_sub["id"])
+
+        self.log.info("Deactivating {} subscriptions".format(len(deactivate)))
+        self.update_subscriptions((id, {"active": False}) for id in deactivate)
 
         if has_active_momconnect_prebirth_sub:
             self.log.info("Starting postbirth momconnect subscriptionrequest")
@@ -405,13 +448,15 @@ class ValidateImplement(Task):
         active_subs = sbm_client.get_subscriptions(
             {"identity": change.registrant_id, "active": True}
         )
+        updates = []
         for sub in active_subs["results"]:
             self.log.info("Getting messageset for subscription {}".format(sub["id"]))
-            messageset = sbm_client.get_messageset(sub["messageset"])
+            messageset = utils.messageset_catalogue.get_messageset(sub["messageset"])
             if "momconnect" not in messageset["short_name"]:
                 continue
             self.log.info("Changing language for subscription {}".format(sub["id"]))
-            sbm_client.update_subscription(sub["id"], {"lang": language})
+            updates.append((sub["id"], {"lang": language}))
+        self.update_subscriptions(updates)
 
         self.log.info("Fetching identity {}".format(change.registrant_id))
         identity = is_client.get_identity(change.registrant_id)
@@ -507,10 +552,8 @@ class ValidateImplement(Task):
             # Deactivate subscription
             sbm_client.update_subscription(subscription["id"], {"active": False})
 
-            new_messageset = next(
-                sbm_client.get_messagesets({"short_name": change.data["messageset"]})[
-                    "results"
-                ]
+            new_messageset = utils.messageset_catalogue.get_messageset_by_short_name(
+                change.data["messageset"]
             )
 
             # Make new subscription request object
@@ -532,9 +575,7 @@ class ValidateImplement(Task):
         """
         Switch all active subscriptions to the desired channel
         """
-        messagesets = {
-            ms["id"]: ms["short_name"] for ms in sbm_client.get_messagesets()["results"]
-        }
+        messagesets = utils.messageset_catalogue.get_messageset_short_names()
         messagesets_rev = {v: k for k, v in messagesets.items()}
         params = {"identity": change.registrant_id, "active": True}
         subscriptions = list(sbm_client.get_subscriptions(params)["results"])
@@ -613,13 +654,21 @@ class ValidateImplement(Task):
                 )
             return
 
+        # Deactivate all the subscriptions that we're switching first
+        switch = []
         for sub in subscriptions:
             if not sub["active"]:
                 continue
             short_name = messagesets[sub["messageset"]]
-            if change.data["channel"] == "whatsapp" and "whatsapp" not in short_name:
+            if (
+                change.data["channel"] == "whatsapp" and "whatsapp" not in short_name
+            ) or (change.data["channel"] == "sms" and "whatsapp" in short_name):
+                switch.append((sub, short_name))
+        self.update_subscriptions((sub["id"], {"active": False}) for sub, _ in switch)
+
+        for sub, short_name in switch:
+            if change.data["channel"] == "whatsapp":
                 # Change any SMS subscriptions to WhatsApp
-                sbm_client.update_subscription(sub["id"], {"active": False})
                 messageset = messagesets_rev["whatsapp_" + short_name]
                 SubscriptionRequest.objects.create(
                     identity=sub["identity"],
@@ -657,11 +706,9 @@ class ValidateImplement(Task):
                     schedule=msgset_schedule,
                 )
 
-            elif change.data["channel"] == "sms" and "whatsapp" in short_name:
-                # Change any WhatsApp subscriptions to SMS
-                sbm_client.update_subscription(sub["id"], {"active": False})
-
-                # There's no service info for SMS
+            else:
+                # Change any WhatsApp subscriptions to SMS. There's no service info
+                # for SMS
                 if "service_info" in short_name:
                     continue
 
@@ -1005,17 +1052,26 @@ class ValidateImplement(Task):
                 "switch_channel": self.switch_channel,
             }.get(change.action, None)(change)
 
+            # Anything cached while the change was being implemented is out of date,
+            # so it's removed once the change has been implemented
+            finish = [invalidate_subscription_check_cache.si(change.registrant_id)]
+            if change.is_engage_action:
+                # This removes the cached context before Engage fetches it again
+                finish.append(change.refresh_engage_context_task())
+            else:
+                finish.append(invalidate_engage_context.si(change.registrant_id))
+
             if submit_task is not None:
                 task = chain(
                     submit_task,
                     remove_personally_identifiable_fields.si(str(change.pk)),
+                    *finish,
                 )
-                task.delay()
+            else:
+                task = chain(*finish)
+            task.delay()
             self.log.info("Task executed successfully")
 
-            if change.is_engage_action:
-                change.async_refresh_engage_context()
-
             return True
         else:
             self.log.info("Task terminated due to validation issues")
@@ -1025,6 +1081,11 @@ class ValidateImplement(Task):
 validate_implement = ValidateImplement()
 
 
+@app.task(acks_late=True, soft_time_limit=10, time_limit=15)
+def invalidate_engage_context(registrant_id):
+    utils.engage_context_cache.invalidate(registrant_id)
+
+
 @app.task(
     autoretry_for=(RequestException, SoftTimeLimitExceeded),
     retry_backoff=True,
@@ -1033,8 +1094,13 @@ validate_implement = ValidateImplement()
     soft_time_limit=10,
     time_limit=15,
 )
-def refresh_engage_context(integration_uuid, integration_action_uuid):
-    response = requests.post(
+def refresh_engage_context(
+    integration_uuid, integration_action_uuid, registrant_id=None
+):
+    if registrant_id is not None:
+        # Make sure that Engage gets the updated context, not the cached one
+        utils.engage_context_cache.invalidate(registrant_id)
+    response = utils.get_http_session().post(
         urljoin(
             settings.ENGAGE_URL,
             "api/integrations/{}/notify/finish".format(integration_uuid),
@@ -1804,54 +1870,21 @@ def get_timestamp_from_turn_message(message: dict) -> datetime:
         return dateparse.parse_datetime(message["_vnd"]["v1"]["inserted_at"])
 
 
-@app.task(
-    autoretry_for=(HTTPError, ConnectionError, Timeout),
-    retry_backoff=True,
-    retry_jitter=True,
-    max_retries=15,
-    acks_late=True,
-    time_limit=10,
-)
-def get_engage_inbound_and_reply(wa_contact_id, message_id):
+def get_inbound_and_reply_from_turn_messages(messages, message_id):
     """
-    Fetches the messages for `wa_contact_id`, and returns details about the outbound
-    specified by `message_id`, as well as details about the possible inbound/s that
-    the outbound is responding to.
-
-    This is a best-guess effort, and isn't guaranteed to be correct.
-
-    Args:
-        wa_contact_id (str): The whatsapp ID for the contact
-        message_id (str): The message ID for the outbound
+    Given the Turn messages for a contact in descending timestamp order, finds the
+    operator outbound `message_id` and the inbound/s that it is responding to. See
+    `get_engage_inbound_and_reply` for the result.
 
-    Returns:
-        dict:
-            inbound_text: The concatenated text body of the inbound/s
-            inbound_timestamp: The timestamp of the last inbound
-            inbound_address: The contact address of the inbound
-            reply_text: The text of the outbound
-            reply_timestamp: The timestamp of the outbound
-            reply_operator: The operator who sent the outbound
+    Raises StopIteration if the outbound isn't found, or IndexError if there are no
+    inbounds before it.
     """
-
-    response = requests.get(
-        urljoin(settings.ENGAGE_URL, "v1/contacts/{}/messages".format(wa_contact_id)),
-        headers={
-            "Authorization": "Bearer {}".format(settings.ENGAGE_TOKEN),
-            "Accept": "application/vnd.v1+json",
-        },
-    )
-    response.raise_for_status()
-    messages = response.json()["messages"]
-
     # Filter out outbounds that aren't from helpdesk operators
     messages = filter(
         lambda m: m["_vnd"]["v1"]["direction"] == "inbound"
         or m["_vnd"]["v1"]["author"].get("type") == "OPERATOR",
         messages,
     )
-    # Sort in timestamp order, descending
-    messages = sorted(messages, key=get_timestamp_from_turn_message, reverse=True)
     # Filter out all messages that came after after the one we care about
     messages = dropwhile(lambda m: m["id"] != message_id, messages)
 
@@ -1889,6 +1922,117 @@ def get_engage_inbound_and_reply(wa_contact_id, message_id):
     }
 
 
+def turn_message_from_eventstore(message: Message) -> dict:
+    """
+    Converts a message stored in the eventstore back into the format of the Turn
+    message that it was stored from
+    """
+    turn_message = deepcopy(message.data or {})
+    vnd = turn_message.setdefault("_vnd", {}).setdefault("v1", {})
+    vnd.setdefault("author", {})
+    address = "to"
+    vnd["direction"] = "outbound"
+    if message.message_direction == Message.INBOUND:
+        address = "from"
+        vnd["direction"] = "inbound"
+    turn_message.update(
+        {
+            "id": message.id,
+            "type": message.type,
+            "timestamp": str(int(message.timestamp.timestamp())),
+            address: message.contact_id,
+        }
+    )
+    return turn_message
+
+
+def get_eventstore_inbound_and_reply(message_id):
+    """
+    Finds the operator outbound `message_id` and the inbound/s that it is responding
+    to in the eventstore, reading the contact's messages newest first, only as far
+    back as the previous operator outbound. See `get_engage_inbound_and_reply` for the
+    result.
+
+    Returns None if the outbound or its inbounds aren't in the eventstore, or if the
+    inbounds were stored without their labels.
+    """
+    reply = Message.objects.filter(id=message_id).first()
+    if reply is None:
+        return None
+
+    messages = (
+        Message.objects.filter(
+            contact_id=reply.contact_id,
+            timestamp__lte=reply.timestamp,
+            fallback_channel=False,
+        )
+        # Outbound timestamps are when we received them, so they can be the same as
+        # other messages' timestamps, and we need a stable order for those
+        .order_by("-timestamp", "-id")
+        # There are usually only a few messages between operator replies
+        .iterator(chunk_size=20)
+    )
+    try:
+        return get_inbound_and_reply_from_turn_messages(
+            map(turn_message_from_eventstore, messages), message_id
+        )
+    except (StopIteration, IndexError):
+        return None
+    except KeyError:
+        # Inbounds that didn't come through Turn don't have its labels, so we need
+        # to get them from Engage
+        return None
+
+
+@app.task(
+    autoretry_for=(HTTPError, ConnectionError, Timeout),
+    retry_backoff=True,
+    retry_jitter=True,
+    max_retries=15,
+    acks_late=True,
+    time_limit=10,
+)
+def get_engage_inbound_and_reply(wa_contact_id, message_id):
+    """
+    Returns details about the outbound specified by `message_id`, as well as details
+    about the possible inbound/s that the outbound is responding to. These come from
+    the eventstore if it has them, otherwise the messages for `wa_contact_id` are
+    fetched from Engage.
+
+    This is a best-guess effort, and isn't guaranteed to be correct.
+
+    Args:
+        wa_contact_id (str): The whatsapp ID for the contact
+        message_id (str): The message ID for the outbound
+
+    Returns:
+        dict:
+            inbound_text: The concatenated text body of the inbound/s
+            inbound_timestamp: The timestamp of the last inbound
+            inbound_address: The contact address of the inbound
+            reply_text: The text of the outbound
+            reply_timestamp: The timestamp of the outbound
+            reply_operator: The operator who sent the outbound
+    """
+    result = get_eventstore_inbound_and_reply(message_id)
+    if result is not None:
+        return result
+
+    response = utils.get_http_session().get(
+        urljoin(settings.ENGAGE_URL, "v1/contacts/{}/messages".format(wa_contact_id)),
+        headers={
+            "Authorization": "Bearer {}".format(settings.ENGAGE_TOKEN),
+            "Accept": "application/vnd.v1+json",
+        },
+    )
+    response.raise_for_status()
+    messages = response.json()["messages"]
+
+    # Sort in timestamp order, descending
+    messages = sorted(messages, key=get_timestamp_from_turn_message, reverse=True)
+    return get_inbound_and_reply_from_turn_messages(messages, message_id)
+
+
 @app.task(
     autoretry_for=(HTTPError, ConnectionError, Timeout, HTTPServiceError),
     retry_backoff=True,
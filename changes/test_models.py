@@ -50,7 +50,9 @@ class ChangeTests(TestCase):
             source=source,
         )
         change.async_refresh_engage_context()
-        task.delay.assert_called_once_with(
+        task.si.assert_called_once_with(
             "8cf3d402-7b25-47fd-8ef2-3e2537fccc14",
             "009d3a39-326c-42f3-af72-b5ddbece219a",
+            "test-registrant-id",
         )
+        task.si.return_value.delay.assert_called_once_with()
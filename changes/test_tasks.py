@@ -3,6 +3,7 @@ from datetime import datetime, timedelta
 from unittest import mock
 from urllib.parse import urlencode
 
+import pytz
 import responses
 from django.contrib.auth.models import User
 from django.db.models.signals import post_save
@@ -23,6 +24,7 @@ from changes.tasks import (
     refresh_engage_context,
     send_helpdesk_response_to_dhis2,
 )
+from eventstore.models import Message
 from ndoh_hub import utils
 from registrations.models import Registration, Source
 from registrations.signals import psh_validate_subscribe
@@ -670,6 +672,156 @@ class GetEngageInboundAndReplyTests(TestCase):
             },
         )
 
+    def create_message(self, id, direction, timestamp, data, type="text"):
+        return Message.objects.create(
+            id=id,
+            contact_id="27820001001",
+            type=type,
+            data=data,
+            message_direction=direction,
+            timestamp=datetime.fromtimestamp(timestamp, tz=pytz.utc),
+        )
+
+    @responses.activate
+    def test_get_eventstore_inbound_and_reply(self):
+        """
+        If the messages are in the eventstore, they should be used instead of fetching
+        them from engage
+        """
+        operator = {
+            "id": "2ab15df1-082a-4420-8f1a-1fed53b13eba",
+            "name": "Operator Name",
+            "type": "OPERATOR",
+        }
+        self.create_message(
+            "previous-question",
+            Message.INBOUND,
+            1540802744,
+            {"text": {"body": "Previous user question, should be ignored"}},
+        )
+        self.create_message(
+            "previous-reply",
+            Message.OUTBOUND,
+            1540802812,
+            {
+                "text": {"body": "Previous operator response, should ignore"},
+                "_vnd": {"v1": {"author": operator}},
+            },
+        )
+        self.create_message(
+            "text-question",
+            Message.INBOUND,
+            1540802983,
+            {
+                "text": {"body": "User question as text"},
+                "_vnd": {"v1": {"labels": [{"value": "text"}]}},
+            },
+        )
+        self.create_message(
+            "image-question",
+            Message.INBOUND,
+            1540803293,
+            {
+                "image": {"caption": "User question as caption"},
+                "_vnd": {"v1": {"labels": [{"value": "image"}]}},
+            },
+            type="image",
+        )
+        self.create_message(
+            "autoresponse",
+            Message.OUTBOUND,
+            1540803295,
+            {
+                "text": {"body": "Autoresponse - should be ignored"},
+                "_vnd": {"v1": {"author": {"type": "SYSTEM"}}},
+            },
+        )
+        self.create_message(
+            "reply",
+            Message.OUTBOUND,
+            1540803363,
+            {
+                "text": {"body": "Operator response"},
+                "_vnd": {"v1": {"author": operator}},
+            },
+        )
+        self.create_message(
+            "later-reply",
+            Message.OUTBOUND,
+            1540803400,
+            {
+                "text": {"body": "Response after the one we care about"},
+                "_vnd": {"v1": {"author": operator}},
+            },
+        )
+
+        self.assertEqual(
+            get_engage_inbound_and_reply("27820001001", "reply"),
+            {
+                "inbound_address": "27820001001",
+                "inbound_text": "User question as text | User question as caption",
+                "inbound_timestamp": 1540803293,
+                "inbound_labels": ["image", "text"],
+                "reply_text": "Operator response",
+                "reply_timestamp": 1540803363,
+                "reply_operator": 56748517727534413379787391391214157498,
+            },
+        )
+        self.assertEqual(len(responses.calls), 0)
+
+    @responses.activate
+    def test_get_eventstore_inbound_without_labels(self):
+        """
+        If the inbounds in the eventstore don't have their labels, then the messages
+        should be fetched from engage
+        """
+        operator = {
+            "id": "2ab15df1-082a-4420-8f1a-1fed53b13eba",
+            "name": "Operator Name",
+            "type": "OPERATOR",
+        }
+        self.create_message(
+            "question", Message.INBOUND, 1540802983, {"text": {"body": "Question"}}
+        )
+        self.create_message(
+            "reply",
+            Message.OUTBOUND,
+            1540803363,
+            {"text": {"body": "Answer"}, "_vnd": {"v1": {"author": operator}}},
+        )
+        responses.add(
+            responses.GET,
+            "http://engage/v1/contacts/27820001001/messages",
+            json={
+                "messages": [
+                    {
+                        "_vnd": {"v1": {"direction": "outbound", "author": operator}},
+                        "id": "reply",
+                        "text": {"body": "Answer"},
+                        "timestamp": "1540803363",
+                        "type": "text",
+                    },
+                    {
+                        "_vnd": {
+                            "v1": {
+                                "direction": "inbound",
+                                "labels": [{"value": "text"}],
+                            }
+                        },
+                        "from": "27820001001",
+                        "id": "question",
+                        "text": {"body": "Question"},
+                        "timestamp": "1540802983",
+                        "type": "text",
+                    },
+                ]
+            },
+        )
+
+        result = get_engage_inbound_and_reply("27820001001", "reply")
+        self.assertEqual(result["inbound_labels"], ["text"])
+        self.assertEqual(len(responses.calls), 1)
+
 
 class TestGetTextOrCaptionFromTurnMessage(TestCase):
     def test_text_type_body(self):
@@ -1079,3 +1231,22 @@ class RefreshEngageContextTests(TestCase):
         )
         self.assertEqual(call.request.headers["Authorization"], "Bearer engage-token")
         self.assertEqual(call.request.headers["Content-Type"], "application/json")
+
+    @responses.activate
+    @mock.patch.object(utils.engage_context_cache, "invalidate")
+    def test_invalidate_cache(self, invalidate):
+        """
+        Should remove the cached context for the registrant, so that engage gets the
+        updated context
+        """
+        responses.add(
+            responses.POST,
+            "http://engage/api/integrations/8cf3d402-7b25-47fd-8ef2-3e2537fccc14/"
+            "notify/finish",
+        )
+        refresh_engage_context(
+            "8cf3d402-7b25-47fd-8ef2-3e2537fccc14",
+            "009d3a39-326c-42f3-af72-b5ddbece219a",
+            "registrant-id",
+        )
+        invalidate.assert_called_once_with("registrant-id")
@@ -3254,23 +3254,23 @@ class TestChangeActions(AuthenticatedAPITestCase):
         validate_implement(change.id)
         change.refresh_from_db()
 
-        (
-            _,
-            ms_11,
-            ms_21,
-            prebirth_update,
-            ms_61,
-            ms_32,
-            postbirth_update,
-            _,
-            _,
-        ) = responses.calls
+        # The updates are done concurrently, after the messageset lookups
+        (_, ms_11, ms_21, ms_61, ms_32, update1, update2, _, _) = responses.calls
         self.assertNotIn("momconnect", ms_11.response.text)
         self.assertIn("momconnect", ms_21.response.text)
-        self.assertEqual(json.loads(prebirth_update.request.body), {"lang": "xho_ZA"})
         self.assertNotIn("momconnect", ms_61.response.text)
         self.assertIn("momconnect", ms_32.response.text)
-        self.assertEqual(json.loads(postbirth_update.request.body), {"lang": "xho_ZA"})
+        self.assertEqual(
+            sorted([update1.request.url, update2.request.url]),
+            sorted(
+                [
+                    "http://sbm/api/v1/subscriptions/{}/".format(prebirth),
+                    "http://sbm/api/v1/subscriptions/{}/".format(postbirth),
+                ]
+            ),
+        )
+        self.assertEqual(json.loads(update1.request.body), {"lang": "xho_ZA"})
+        self.assertEqual(json.loads(update2.request.body), {"lang": "xho_ZA"})
 
     @responses.activate
     def test_momconnect_change_language_old_language(self):
@@ -4295,13 +4295,14 @@ class TestChangeActions(AuthenticatedAPITestCase):
             },
         )
 
+    @mock.patch("changes.tasks.chain")
     @mock.patch("changes.tasks.refresh_engage_context")
     @mock.patch("changes.tasks.validate_implement.switch_channel")
     @mock.patch("changes.tasks.validate_implement.validate")
-    def test_update_engage_context(self, validate, switch_channel, refresh):
+    def test_update_engage_context(self, validate, switch_channel, refresh, chain):
         """
         A successful change that is from an engage action should notify engage to
-        update the context.
+        update the context, once the change has been implemented.
         """
         validate.return_value = True
         change = Change.objects.create(
@@ -4319,10 +4320,37 @@ class TestChangeActions(AuthenticatedAPITestCase):
 
         validate_implement(change.id)
 
-        refresh.delay.assert_called_once_with(
+        refresh.si.assert_called_once_with(
             "8cf3d402-7b25-47fd-8ef2-3e2537fccc14",
             "009d3a39-326c-42f3-af72-b5ddbece219a",
+            "registrant-id",
         )
+        args, _ = chain.call_args
+        self.assertEqual(args[-1], refresh.si.return_value)
+        chain.return_value.delay.assert_called_once_with()
+
+
+class UpdateSubscriptionsTests(TestCase):
+    @responses.activate
+    def test_partial_failure(self):
+        """
+        Should attempt all of the updates, and then raise the failure
+        """
+        mock_update_subscription("sub1")
+        responses.add(
+            responses.PATCH, "http://sbm/api/v1/subscriptions/sub2/", status=500
+        )
+        mock_update_subscription("sub3")
+
+        with self.assertRaises(Exception):
+            validate_implement.update_subscriptions(
+                [
+                    ("sub1", {"active": False}),
+                    ("sub2", {"active": False}),
+                    ("sub3", {"active": False}),
+                ]
+            )
+        self.assertEqual(len(responses.calls), 3)
 
 
 class TestRemovePersonallyIdentifiableInformation(AuthenticatedAPITestCase):
@@ -18,7 +18,7 @@ from seed_services_client.stage_based_messaging import (  # noqa
 )
 
 from changes import tasks
-from ndoh_hub.utils import TokenAuthQueryString
+from ndoh_hub.utils import TokenAuthQueryString, messageset_catalogue
 
 from .models import Change, Source
 from .serializers import (
@@ -150,7 +150,7 @@ class ReceiveAdminOptout(generics.GenericAPIView):
 
         actions = set()
         for sub in active_subs:
-            messageset = sbm_client.get_messageset(sub["messageset"])
+            messageset = messageset_catalogue.get_messageset(sub["messageset"])
             if "nurseconnect" in messageset["short_name"]:
                 actions.add("nurse_optout")
             elif "pmtct" in messageset["short_name"]:
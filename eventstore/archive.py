@@ -0,0 +1,49 @@
+"""
+Archived eventstore rows are stored as gzipped JSON lines files, one row per line,
+partitioned by table and by the date of the row's timestamp:
+
+    <root>/<table>/date=<YYYY-MM-DD>/part-<run>.jsonl.gz
+
+There can be more than one part for a date, if that date was archived over more
+than one run.
+"""
+import gzip
+import json
+import os
+from datetime import date, datetime
+from typing import Iterator, Optional
+
+
+def archive_file_path(root: str, table: str, day: date, run: str) -> str:
+    return os.path.join(root, table, f"date={day.isoformat()}", f"part-{run}.jsonl.gz")
+
+
+def count_rows(path: str) -> int:
+    """
+    Counts the rows in an archive file, without loading it all into memory
+    """
+    with gzip.open(path, "rt") as f:
+        return sum(1 for _ in f)
+
+
+def read_archive(
+    root: str, table: str, since: Optional[date] = None, until: Optional[date] = None
+) -> Iterator[dict]:
+    """
+    Yields the archived rows for `table`, in date order, one at a time. If given,
+    only dates from `since` and before `until` are read.
+    """
+    table_dir = os.path.join(root, table)
+    if not os.path.isdir(table_dir):
+        return
+    for partition in sorted(os.listdir(table_dir)):
+        day = datetime.strptime(partition, "date=%Y-%m-%d").date()
+        if (since and day < since) or (until and day >= until):
+            continue
+        partition_dir = os.path.join(table_dir, partition)
+        for name in sorted(os.listdir(partition_dir)):
+            if not name.endswith(".jsonl.gz"):
+                continue
+            with gzip.open(os.path.join(partition_dir, name), "rt") as f:
+                for line in f:
+                    yield json.loads(line)
@@ -0,0 +1,132 @@
+import gzip
+import json
+import os
+import time
+from datetime import datetime, timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils import timezone
+
+from eventstore.archive import archive_file_path, count_rows
+from eventstore.models import Event, Message
+
+MODELS = {"message": Message, "event": Event}
+
+
+class Command(BaseCommand):
+    help = (
+        "Moves messages and events older than the given number of days out of the "
+        "database, into gzipped JSON lines files partitioned by date. Each file's "
+        "row count is verified before its rows are deleted. Use "
+        "eventstore.archive.read_archive to read the archived rows."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--output", required=True, help="The directory to write the archive to"
+        )
+        parser.add_argument(
+            "--days",
+            type=int,
+            default=90,
+            help="Archive rows with a timestamp older than this many days",
+        )
+        parser.add_argument(
+            "--model",
+            choices=list(MODELS),
+            action="append",
+            help="Only archive these models. Defaults to all of them",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=1000,
+            help="The number of rows to delete in each query",
+        )
+
+    def delete(self, model, ids, batch_size):
+        for start in range(0, len(ids), batch_size):
+            end = start + batch_size
+            model.objects.filter(pk__in=ids[start:end]).delete()
+
+    def count_db_rows(self, model, day, cutoff):
+        """
+        Counts the rows in the database for the day that are older than the cutoff
+        """
+        start = datetime.combine(day, datetime.min.time(), tzinfo=timezone.utc)
+        return model.objects.filter(
+            timestamp__gte=start, timestamp__lt=min(start + timedelta(days=1), cutoff)
+        ).count()
+
+    def finish_file(self, model, path, ids, day, cutoff, batch_size):
+        """
+        Makes the file visible once its row count is verified against the rows that
+        we archived, and the rows in the database for the same day, and then deletes
+        the archived rows
+        """
+        rows = count_rows(f"{path}.tmp")
+        if rows != len(ids):
+            raise CommandError(
+                f"{path}.tmp has {rows} rows, expected {len(ids)}. Not deleting them."
+            )
+        db_rows = self.count_db_rows(model, day, cutoff)
+        if rows != db_rows:
+            raise CommandError(
+                f"{path}.tmp has {rows} rows, but the database has {db_rows} rows for "
+                f"{day}. Not deleting them."
+            )
+        os.rename(f"{path}.tmp", path)
+        self.delete(model, ids, batch_size)
+
+    def archive(self, model, root, cutoff, run, batch_size):
+        table = model._meta.db_table
+        # Ordering by timestamp means that we only need one file open at a time
+        rows = (
+            model.objects.filter(timestamp__lt=cutoff)
+            .order_by("timestamp")
+            .values()
+            .iterator(chunk_size=batch_size)
+        )
+
+        total = 0
+        start, d_print = time.time(), time.time()
+        day, path, f, ids = None, None, None, []
+        try:
+            for row in rows:
+                row_day = row["timestamp"].astimezone(timezone.utc).date()
+                if row_day != day:
+                    if f is not None:
+                        f.close()
+                        self.finish_file(model, path, ids, day, cutoff, batch_size)
+                    day, ids = row_day, []
+                    path = archive_file_path(root, table, day, run)
+                    os.makedirs(os.path.dirname(path), exist_ok=True)
+                    f = gzip.open(f"{path}.tmp", "wt")
+                f.write(json.dumps(row, cls=DjangoJSONEncoder))
+                f.write("\n")
+                ids.append(row["id"])
+
+                total += 1
+                if time.time() - d_print > 1:
+                    self.stdout.write(
+                        f"\rArchived {total} {table} at "
+                        f"{total/(time.time() - start):.0f}/s",
+                        ending="",
+                    )
+                    d_print = time.time()
+            if f is not None:
+                f.close()
+                self.finish_file(model, path, ids, day, cutoff, batch_size)
+        finally:
+            if f is not None:
+                f.close()
+        self.stdout.write(f"\rArchived {total} {table}")
+
+    def handle(self, *args, **options):
+        cutoff = timezone.now() - timedelta(days=options["days"])
+        run = timezone.now().strftime("%Y%m%d%H%M%S")
+        for name in options["model"] or MODELS:
+            self.archive(
+                MODELS[name], options["output"], cutoff, run, options["batch_size"]
+            )
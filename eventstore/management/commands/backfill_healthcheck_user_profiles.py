@@ -0,0 +1,68 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from eventstore.models import Covid19Triage, HealthCheckUserProfile
+
+
+class Command(BaseCommand):
+    help = (
+        "Creates the HealthCheck user profiles for all MSISDNs that have completed "
+        "HealthChecks, but don't have a profile yet, in a single pass over the "
+        "HealthChecks"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=1000,
+            help="The number of profiles to create in each query",
+        )
+
+    def get_profiles(self):
+        """
+        Yields a profile for each MSISDN without one, by replaying their healthchecks
+        in order
+        """
+        healthchecks = (
+            Covid19Triage.objects.exclude(
+                msisdn__in=HealthCheckUserProfile.objects.values("msisdn")
+            )
+            .order_by("msisdn", "completed_timestamp")
+            .iterator()
+        )
+        profile = None
+        for healthcheck in healthchecks:
+            if profile is None or profile.msisdn != healthcheck.msisdn:
+                if profile is not None:
+                    yield profile
+                profile = HealthCheckUserProfile()
+            profile.update_from_healthcheck(healthcheck)
+        if profile is not None:
+            yield profile
+
+    def create_profiles(self, profiles):
+        # Profiles created since we started are more up to date than ours
+        HealthCheckUserProfile.objects.bulk_create(profiles, ignore_conflicts=True)
+
+    def handle(self, *args, **options):
+        batch_size = options["batch_size"]
+        total = 0
+        start, d_print = time.time(), time.time()
+        batch = []
+        for profile in self.get_profiles():
+            batch.append(profile)
+            if len(batch) >= batch_size:
+                self.create_profiles(batch)
+                total += len(batch)
+                batch = []
+            if time.time() - d_print > 1:
+                self.stdout.write(
+                    f"\rProcessed {total} at {total/(time.time() - start):.0f}/s",
+                    ending="",
+                )
+                d_print = time.time()
+        self.create_profiles(batch)
+        total += len(batch)
+        self.stdout.write(f"\rProcessed {total} profiles")
@@ -0,0 +1,230 @@
+import copy
+import signal
+import socket
+import time
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.core.management.base import BaseCommand
+from django.db import DataError, IntegrityError, transaction
+
+from eventstore.models import Event
+from eventstore.views import (
+    handle_messages_and_events,
+    parse_whatsapp_webhook,
+    save_messages_and_events,
+    save_turn_outbound,
+)
+from eventstore.webhook_queue import WebhookQueue
+from eventstore.whatsapp_actions import handle_outbound
+
+# Errors caused by the webhook's data, that will happen again if we retry it.
+# Anything else, eg. losing the database connection, is assumed to be temporary.
+DATA_ERRORS = (
+    DataError,
+    IntegrityError,
+    ValidationError,
+    KeyError,
+    TypeError,
+    ValueError,
+)
+
+
+class Command(BaseCommand):
+    help = (
+        "Stores the webhooks queued by the messages API in the database, in batches. "
+        "On SIGTERM or SIGINT, stores the webhooks that have already been read "
+        "before exiting. On startup, also stores the webhooks that other consumers "
+        "read but didn't store within --claim-idle seconds. Exits if a webhook "
+        "can't be stored for any reason other than its data, leaving it to be "
+        "stored on the next startup."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=settings.EVENTSTORE_WEBHOOK_QUEUE_BATCH_SIZE,
+            help="The maximum number of webhooks to store at once",
+        )
+        parser.add_argument(
+            "--max-wait",
+            type=float,
+            default=settings.EVENTSTORE_WEBHOOK_QUEUE_MAX_WAIT,
+            help="The maximum number of seconds to wait for a batch to fill up",
+        )
+        parser.add_argument(
+            "--consumer",
+            default=socket.gethostname(),
+            help=(
+                "The name of this consumer. Must be unique between concurrent "
+                "consumers, and stable between restarts"
+            ),
+        )
+        parser.add_argument(
+            "--claim-idle",
+            type=float,
+            default=settings.EVENTSTORE_WEBHOOK_QUEUE_CLAIM_IDLE,
+            help=(
+                "Claim webhooks that other consumers read, but didn't store, within "
+                "this many seconds. These consumers are assumed to have stopped"
+            ),
+        )
+        parser.add_argument(
+            "--drain",
+            action="store_true",
+            help="Exit once the queue is empty, instead of waiting for new webhooks",
+        )
+
+    def stop(self, signum, frame):
+        self.running = False
+
+    def read_batch(self, queue, consumer, batch_size, max_wait):
+        """
+        Reads webhooks until we have a full batch, or until max_wait has passed
+        """
+        batch = []
+        deadline = time.monotonic() + max_wait
+        while self.running and len(batch) < batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            webhooks = queue.read(
+                consumer, batch_size - len(batch), block=max(int(remaining * 1000), 1)
+            )
+            if not webhooks:
+                break
+            batch.extend(webhooks)
+        return batch
+
+    def unsaved_events(self, events):
+        """
+        Removes the events that are already in the database
+        """
+        saved = set(
+            Event.objects.filter(
+                message_id__in={e.message_id for e in events}
+            ).values_list("message_id", "status", "timestamp")
+        )
+        return [e for e in events if (e.message_id, e.status, e.timestamp) not in saved]
+
+    def save(self, webhooks, redelivered=False):
+        """
+        Writes the webhooks to the database in a single transaction, without
+        triggering their actions. Returns the saved messages, events, and outbounds.
+
+        Webhooks that were `redelivered` might have been written before, so their
+        events are only written if they aren't already in the database. Messages
+        are upserted, so they are only ever written once.
+        """
+        messages, events, outbounds = [], [], []
+        with transaction.atomic():
+            for _, webhook in webhooks:
+                if webhook["type"] == WebhookQueue.WHATSAPP:
+                    m, e = parse_whatsapp_webhook(
+                        copy.deepcopy(webhook["data"]),
+                        webhook["created_by"],
+                        webhook["fallback_channel"],
+                    )
+                    messages.extend(m)
+                    events.extend(e)
+                else:
+                    outbounds.append(
+                        save_turn_outbound(
+                            copy.deepcopy(webhook["data"]),
+                            webhook["message_id"],
+                            webhook["created_by"],
+                            webhook["fallback_channel"],
+                        )
+                    )
+            if redelivered and events:
+                events = self.unsaved_events(events)
+            messages, events = save_messages_and_events(messages, events)
+        return messages, events, outbounds
+
+    def action_failed(self, e):
+        self.stderr.write(f"Error running action: {e}")
+
+    def flush(self, queue, batch, redelivered=False):
+        """
+        Stores the batch of webhooks, acknowledges them, and then triggers their
+        actions. `redelivered` batches were read before, and might have been written
+        without being acknowledged.
+        """
+        saved, done = [], []
+        try:
+            try:
+                saved.append(self.save(batch, redelivered))
+                done = batch
+            except DATA_ERRORS as e:
+                # The transaction was rolled back, so nothing in the batch was
+                # written. Save them one at a time, so that one bad webhook doesn't
+                # stop the rest
+                self.stderr.write(f"Error storing batch of {len(batch)}: {e}")
+                for id, webhook in batch:
+                    try:
+                        saved.append(self.save([(id, webhook)], redelivered))
+                    except DATA_ERRORS as e:
+                        self.stderr.write(f"Moving webhook {id} to dead letters: {e}")
+                        queue.dead_letter(id, webhook)
+                    done.append((id, webhook))
+        finally:
+            # Any other error leaves the rest of the batch unacknowledged, to be
+            # read again on the next startup. Redelivered webhooks aren't written
+            # twice, so we can acknowledge after writing, and failed actions are
+            # logged and not retried.
+            queue.ack([id for id, _ in done])
+
+        for messages, events, outbounds in saved:
+            handle_messages_and_events(messages, events, on_error=self.action_failed)
+            if not settings.ENABLE_EVENTSTORE_WHATSAPP_ACTIONS:
+                continue
+            for msg, created in outbounds:
+                if created:
+                    try:
+                        handle_outbound(msg)
+                    except Exception as e:
+                        self.action_failed(e)
+
+    def handle(self, *args, **options):
+        self.running = True
+        handlers = {
+            signum: signal.signal(signum, self.stop)
+            for signum in (signal.SIGTERM, signal.SIGINT)
+        }
+        try:
+            self.consume(options)
+        finally:
+            for signum, handler in handlers.items():
+                signal.signal(signum, handler)
+
+    def consume(self, options):
+        queue = WebhookQueue()
+        queue.create_group()
+        consumer, batch_size = options["consumer"], options["batch_size"]
+
+        # First store anything that we read, but didn't store, before a restart
+        while True:
+            batch = queue.read(consumer, batch_size, pending=True)
+            if not batch:
+                break
+            self.flush(queue, batch, redelivered=True)
+
+        # Then anything that consumers that no longer exist read, but didn't store
+        min_idle_time = int(options["claim_idle"] * 1000)
+        while True:
+            batch = queue.claim_idle(consumer, batch_size, min_idle_time)
+            if not batch:
+                break
+            self.flush(queue, batch, redelivered=True)
+
+        total = 0
+        while self.running:
+            batch = self.read_batch(queue, consumer, batch_size, options["max_wait"])
+            if batch:
+                self.flush(queue, batch)
+                total += len(batch)
+            elif options["drain"]:
+                break
+
+        self.stdout.write(f"Stored {total} webhooks")
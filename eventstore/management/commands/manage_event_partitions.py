@@ -0,0 +1,35 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from eventstore.tasks import manage_event_partitions
+
+
+class Command(BaseCommand):
+    help = (
+        "Creates the monthly event partitions for the coming months, and detaches "
+        "the partitions older than the retention period, leaving them as standalone "
+        "tables to be archived. This also runs daily as a periodic task."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--months-ahead",
+            type=int,
+            default=settings.EVENTSTORE_EVENT_PARTITIONS_AHEAD,
+            help="Create partitions up to this many months after the current month",
+        )
+        parser.add_argument(
+            "--retention-months",
+            type=int,
+            default=settings.EVENTSTORE_EVENT_RETENTION_MONTHS,
+            help="Detach partitions older than this many months. 0 keeps all of them",
+        )
+
+    def handle(self, *args, **options):
+        created, detached = manage_event_partitions(
+            options["months_ahead"], options["retention_months"]
+        )
+        for name in created:
+            self.stdout.write(f"Created partition {name}")
+        for name in detached:
+            self.stdout.write(f"Detached partition {name}")
@@ -1,6 +1,10 @@
 import time
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
 
 from django.core.management.base import BaseCommand
+from django.db import connection
+from django_redis import get_redis_connection
 
 from changes.models import Change
 from eventstore.models import (
@@ -18,6 +22,19 @@ from eventstore.models import (
 from ndoh_hub.constants import LANGUAGES
 from registrations.models import Registration
 
+MODELS = {
+    "public": PublicRegistration,
+    "CHW": CHWRegistration,
+    "prebirth": PrebirthRegistration,
+    "PMTCT": PMTCTRegistration,
+    "babyswitch": BabySwitch,
+    "optout": OptOut,
+    "channelswitch": ChannelSwitch,
+    "msisdnswitch": MSISDNSwitch,
+    "languageswitch": LanguageSwitch,
+    "identificationswitch": IdentificationSwitch,
+}
+
 
 class Command(BaseCommand):
     help = (
@@ -32,22 +49,77 @@ class Command(BaseCommand):
             action="store_true",
             help="Deletes the migrated registrations and changes",
         )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=1000,
+            help="The number of rows to read, write, and delete at a time",
+        )
+        parser.add_argument(
+            "--concurrency",
+            type=int,
+            default=1,
+            help="The number of registration and change types to migrate at once",
+        )
+        parser.add_argument(
+            "--resume",
+            action="store_true",
+            help="Continue from where the previous run stopped",
+        )
+
+    def checkpoint_key(self, name):
+        return f"migrate_to_eventstore:checkpoint:{name}"
+
+    def migrate(self, name, query, model, transform, options):
+        """
+        Migrates the rows of `query` into `model` in batches, ordered by ID, saving
+        the last migrated ID after each batch so that an interrupted run can be
+        resumed.
 
-    def execute_with_progress(self, func, iterator):
+        `transform` returns the field values for a row. Rows that were already
+        migrated only have those fields updated.
+        """
+        redis = get_redis_connection("redis")
+        key = self.checkpoint_key(name)
+        if options["resume"]:
+            checkpoint = redis.get(key)
+            if checkpoint:
+                query = query.filter(id__gt=checkpoint.decode())
+        else:
+            redis.delete(key)
+
+        rows = query.order_by("id").iterator(chunk_size=options["batch_size"])
         total = 0
         start, d_print = time.time(), time.time()
-        for arg in iterator:
-            func(arg)
-            if time.time() - d_print > 1:
+        while True:
+            batch = list(islice(rows, options["batch_size"]))
+            if not batch:
+                break
+            values = [transform(row) for row in batch]
+            model.objects.bulk_upsert(
+                [model(**v) for v in values],
+                update_fields=sorted({f for v in values for f in v} - {"id"}),
+            )
+            if options["delete"]:
+                query.model.objects.filter(id__in=[row.id for row in batch]).delete()
+            redis.set(key, str(batch[-1].id))
+
+            total += len(batch)
+            if time.time() - d_print > 10:
                 self.stdout.write(
-                    f"\rProcessed {total} at {total/(time.time() - start):.0f}/s",
-                    ending="",
+                    f"Processed {total} {name} at {total/(time.time() - start):.0f}/s"
                 )
                 d_print = time.time()
-            total += 1
-        self.stdout.write("")
+        self.stdout.write(f"Processed {total} {name}")
 
-    def handle_public_registration(self, reg):
+    def migrate_in_thread(self, *args):
+        try:
+            self.migrate(*args)
+        finally:
+            # Each thread has its own database connection
+            connection.close()
+
+    def transform_public_registration(self, reg):
         data = reg.data or {}
         if "whatsapp" in reg.reg_type:
             channel = "WhatsApp"
@@ -62,21 +134,19 @@ class Command(BaseCommand):
         else:
             language = ""
 
-        PublicRegistration.objects.update_or_create(
+        return dict(
             id=reg.id,
-            defaults={
-                "contact_id": reg.registrant_id or uuid_registrant,
-                "device_contact_id": operator_id or uuid_device,
-                "source": reg.source.name,
-                "language": language,
-                "channel": channel,
-                "timestamp": reg.created_at,
-                "created_by": reg.source.user.username,
-                "data": data,
-            },
+            contact_id=reg.registrant_id or uuid_registrant,
+            device_contact_id=operator_id or uuid_device,
+            source=reg.source.name,
+            language=language,
+            channel=channel,
+            timestamp=reg.created_at,
+            created_by=reg.source.user.username,
+            data=data,
         )
 
-    def handle_CHW_registration(self, reg):
+    def transform_CHW_registration(self, reg):
         data = reg.data or {}
         if "whatsapp" in reg.reg_type:
             channel = "WhatsApp"
@@ -96,26 +166,24 @@ class Command(BaseCommand):
         else:
             language = ""
 
-        CHWRegistration.objects.update_or_create(
+        return dict(
             id=reg.id,
-            defaults={
-                "contact_id": reg.registrant_id or uuid_registrant,
-                "device_contact_id": operator_id or uuid_device,
-                "source": reg.source.name,
-                "id_type": {"none": "dob"}.get(id_type, id_type),
-                "id_number": id_number,
-                "passport_country": passport_country,
-                "passport_number": passport_number,
-                "date_of_birth": date_of_birth,
-                "channel": channel,
-                "language": language,
-                "timestamp": reg.created_at,
-                "created_by": reg.source.user.username,
-                "data": data,
-            },
+            contact_id=reg.registrant_id or uuid_registrant,
+            device_contact_id=operator_id or uuid_device,
+            source=reg.source.name,
+            id_type={"none": "dob"}.get(id_type, id_type),
+            id_number=id_number,
+            passport_country=passport_country,
+            passport_number=passport_number,
+            date_of_birth=date_of_birth,
+            channel=channel,
+            language=language,
+            timestamp=reg.created_at,
+            created_by=reg.source.user.username,
+            data=data,
         )
 
-    def handle_prebirth_registration(self, reg):
+    def transform_prebirth_registration(self, reg):
         data = reg.data or {}
         if "whatsapp" in reg.reg_type:
             channel = "WhatsApp"
@@ -138,58 +206,52 @@ class Command(BaseCommand):
         else:
             language = ""
 
-        PrebirthRegistration.objects.update_or_create(
+        return dict(
             id=reg.id,
-            defaults={
-                "contact_id": contact_id,
-                "device_contact_id": operator_id or uuid_device or contact_id,
-                "id_type": {"none": "dob"}.get(id_type, id_type),
-                "id_number": id_number,
-                "passport_country": passport_country,
-                "passport_number": passport_number,
-                "date_of_birth": date_of_birth,
-                "channel": channel,
-                "language": language,
-                "edd": edd,
-                "facility_code": facility_code,
-                "source": reg.source.name,
-                "timestamp": reg.created_at,
-                "created_by": reg.source.user.username,
-                "data": data,
-            },
+            contact_id=contact_id,
+            device_contact_id=operator_id or uuid_device or contact_id,
+            id_type={"none": "dob"}.get(id_type, id_type),
+            id_number=id_number,
+            passport_country=passport_country,
+            passport_number=passport_number,
+            date_of_birth=date_of_birth,
+            channel=channel,
+            language=language,
+            edd=edd,
+            facility_code=facility_code,
+            source=reg.source.name,
+            timestamp=reg.created_at,
+            created_by=reg.source.user.username,
+            data=data,
         )
 
-    def handle_PMTCT_registration(self, reg):
+    def transform_PMTCT_registration(self, reg):
         data = reg.data or {}
         operator_id = data.pop("operator_id", None)
         date_of_birth = data.pop("mom_dob", None)
 
-        PMTCTRegistration.objects.update_or_create(
+        return dict(
             id=reg.id,
-            defaults={
-                "contact_id": reg.registrant_id,
-                "device_contact_id": operator_id or reg.registrant_id,
-                "source": reg.source.name,
-                "date_of_birth": date_of_birth,
-                "timestamp": reg.created_at,
-                "created_by": reg.source.user.username,
-                "data": data,
-            },
+            contact_id=reg.registrant_id,
+            device_contact_id=operator_id or reg.registrant_id,
+            source=reg.source.name,
+            date_of_birth=date_of_birth,
+            timestamp=reg.created_at,
+            created_by=reg.source.user.username,
+            data=data,
         )
 
-    def handle_babyswitch_change(self, change):
-        BabySwitch.objects.update_or_create(
+    def transform_babyswitch_change(self, change):
+        return dict(
             id=change.id,
-            defaults={
-                "contact_id": change.registrant_id,
-                "source": change.source.name,
-                "timestamp": change.created_at,
-                "created_by": change.source.user.username,
-                "data": change.data or {},
-            },
+            contact_id=change.registrant_id,
+            source=change.source.name,
+            timestamp=change.created_at,
+            created_by=change.source.user.username,
+            data=change.data or {},
         )
 
-    def handle_optout_change(self, change):
+    def transform_optout_change(self, change):
         data = change.data or {}
         if change.action in ("pmtct_loss_switch", "momconnect_loss_switch"):
             optout_type = "loss"
@@ -201,90 +263,80 @@ class Command(BaseCommand):
             optout_type = "stop"
         reason = data.pop("reason", "")
 
-        OptOut.objects.update_or_create(
+        return dict(
             id=change.id,
-            defaults={
-                "contact_id": change.registrant_id,
-                "optout_type": optout_type,
-                "reason": reason,
-                "source": change.source.name,
-                "timestamp": change.created_at,
-                "created_by": change.source.user.username,
-                "data": data,
-            },
+            contact_id=change.registrant_id,
+            optout_type=optout_type,
+            reason=reason,
+            source=change.source.name,
+            timestamp=change.created_at,
+            created_by=change.source.user.username,
+            data=data,
         )
 
-    def handle_channelswitch_change(self, change):
+    def transform_channelswitch_change(self, change):
         data = change.data or {}
         to_channel = {"sms": "SMS", "whatsapp": "WhatsApp"}[data.pop("channel")]
         from_channel = data.pop(
             "old_channel", {"SMS": "whatsapp", "WhatsApp": "sms"}[to_channel]
         )
         from_channel = {"sms": "SMS", "whatsapp": "WhatsApp"}[from_channel]
-        ChannelSwitch.objects.update_or_create(
+        return dict(
             id=change.id,
-            defaults={
-                "contact_id": change.registrant_id,
-                "source": change.source.name,
-                "from_channel": from_channel,
-                "to_channel": to_channel,
-                "timestamp": change.created_at,
-                "created_by": change.source.user.username,
-                "data": data,
-            },
+            contact_id=change.registrant_id,
+            source=change.source.name,
+            from_channel=from_channel,
+            to_channel=to_channel,
+            timestamp=change.created_at,
+            created_by=change.source.user.username,
+            data=data,
         )
 
-    def handle_msisdnswitch_change(self, change):
+    def transform_msisdnswitch_change(self, change):
         data = change.data or {}
         msisdn = data.pop("msisdn", "")
-        MSISDNSwitch.objects.update_or_create(
+        return dict(
             id=change.id,
-            defaults={
-                "contact_id": change.registrant_id,
-                "source": change.source.name,
-                "new_msisdn": msisdn,
-                "timestamp": change.created_at,
-                "created_by": change.source.user.username,
-                "data": data,
-            },
+            contact_id=change.registrant_id,
+            source=change.source.name,
+            new_msisdn=msisdn,
+            timestamp=change.created_at,
+            created_by=change.source.user.username,
+            data=data,
         )
 
-    def handle_languageswitch_change(self, change):
+    def transform_languageswitch_change(self, change):
         data = change.data or {}
         new_language = data.pop("language").rstrip("_ZA")
         old_language = (data.pop("old_language") or "").rstrip("_ZA")
-        LanguageSwitch.objects.update_or_create(
+        return dict(
             id=change.id,
-            defaults={
-                "contact_id": change.registrant_id,
-                "source": change.source.name,
-                "old_language": old_language,
-                "new_language": new_language,
-                "timestamp": change.created_at,
-                "created_by": change.source.user.username,
-                "data": data,
-            },
+            contact_id=change.registrant_id,
+            source=change.source.name,
+            old_language=old_language,
+            new_language=new_language,
+            timestamp=change.created_at,
+            created_by=change.source.user.username,
+            data=data,
         )
 
-    def handle_identificationswitch_change(self, change):
+    def transform_identificationswitch_change(self, change):
         data = change.data or {}
         id_type = data.pop("id_type", "")
         passport_no = data.pop("passport_no", "")
         passport_origin = data.pop("passport_origin", "")
         sa_id_no = data.pop("sa_id_no", "")
-        IdentificationSwitch.objects.update_or_create(
+        return dict(
             id=change.id,
-            defaults={
-                "contact_id": change.registrant_id,
-                "source": change.source.name,
-                "new_identification_type": id_type,
-                "new_passport_number": passport_no,
-                "new_passport_country": passport_origin,
-                "new_id_number": sa_id_no,
-                "timestamp": change.created_at,
-                "created_by": change.source.user.username,
-                "data": data,
-            },
+            contact_id=change.registrant_id,
+            source=change.source.name,
+            new_identification_type=id_type,
+            new_passport_number=passport_no,
+            new_passport_country=passport_origin,
+            new_id_number=sa_id_no,
+            timestamp=change.created_at,
+            created_by=change.source.user.username,
+            data=data,
         )
 
     def handle(self, *args, **options):
@@ -315,14 +367,15 @@ class Command(BaseCommand):
             ).select_related("source", "source__user"),
         }
 
-        for name, query in queries.items():
-            self.stdout.write(f"Processing {name} registrations...")
-            self.execute_with_progress(
-                getattr(self, f"handle_{name}_registration"), query.iterator()
+        groups = [
+            (
+                f"{name} registrations",
+                query,
+                MODELS[name],
+                getattr(self, f"transform_{name}_registration"),
             )
-            if options["delete"]:
-                self.stdout.write(f"Deleting {name} registrations...")
-                query.delete()
+            for name, query in queries.items()
+        ]
 
         queries = {
             "babyswitch": Change.objects.filter(
@@ -353,11 +406,25 @@ class Command(BaseCommand):
             ).select_related("source", "source__user"),
         }
 
-        for name, query in queries.items():
-            self.stdout.write(f"Processing {name} changes...")
-            self.execute_with_progress(
-                getattr(self, f"handle_{name}_change"), query.iterator()
+        groups += [
+            (
+                f"{name} changes",
+                query,
+                MODELS[name],
+                getattr(self, f"transform_{name}_change"),
             )
-            if options["delete"]:
-                self.stdout.write(f"Deleting {name} changes...")
-                query.delete()
+            for name, query in queries.items()
+        ]
+
+        if options["concurrency"] <= 1:
+            for group in groups:
+                self.migrate(*group, options)
+            return
+
+        # The types are independent of each other, so they can be migrated at once
+        with ThreadPoolExecutor(max_workers=options["concurrency"]) as pool:
+            futures = [
+                pool.submit(self.migrate_in_thread, *group, options) for group in groups
+            ]
+            for future in futures:
+                future.result()
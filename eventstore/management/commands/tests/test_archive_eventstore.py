@@ -0,0 +1,111 @@
+import os
+import tempfile
+from datetime import date, datetime, timedelta
+from io import StringIO
+from unittest.mock import patch
+
+from django.core.management import CommandError, call_command
+from django.test import TestCase
+from django.utils import timezone
+
+from eventstore.archive import read_archive
+from eventstore.management.commands.archive_eventstore import Command
+from eventstore.models import Event, Message
+
+
+class ArchiveEventstoreTests(TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tempdir.cleanup)
+
+    def test_archive(self):
+        """
+        Should move old messages and events into files partitioned by date
+        """
+        old = timezone.now() - timedelta(days=100)
+        Message.objects.create(id="old1", contact_id="27820001001", timestamp=old)
+        Message.objects.create(
+            id="old2", contact_id="27820001001", timestamp=old - timedelta(days=1)
+        )
+        Message.objects.create(id="new", contact_id="27820001001")
+        Event.objects.create(message_id="old1", status=Event.READ, timestamp=old)
+        new_event = Event.objects.create(message_id="new", status=Event.READ)
+
+        call_command(
+            "archive_eventstore", output=self.tempdir.name, days=90, stdout=StringIO()
+        )
+
+        self.assertEqual(list(Message.objects.values_list("id", flat=True)), ["new"])
+        self.assertEqual(list(Event.objects.all()), [new_event])
+
+        messages = list(read_archive(self.tempdir.name, "eventstore_message"))
+        self.assertEqual([m["id"] for m in messages], ["old2", "old1"])
+        self.assertEqual(messages[0]["contact_id"], "27820001001")
+        self.assertEqual(
+            sorted(os.listdir(os.path.join(self.tempdir.name, "eventstore_message"))),
+            [
+                f"date={(old - timedelta(days=1)).date().isoformat()}",
+                f"date={old.date().isoformat()}",
+            ],
+        )
+        [event] = read_archive(self.tempdir.name, "eventstore_event")
+        self.assertEqual(event["message_id"], "old1")
+
+    def test_archive_database_count_mismatch(self):
+        """
+        Should not delete anything if the database has a different number of rows
+        for the day than the archive file
+        """
+        old = timezone.now() - timedelta(days=100)
+        Message.objects.create(id="old", timestamp=old)
+
+        with patch.object(Command, "count_db_rows", return_value=2):
+            with self.assertRaises(CommandError):
+                call_command(
+                    "archive_eventstore",
+                    output=self.tempdir.name,
+                    model=["message"],
+                    stdout=StringIO(),
+                )
+
+        self.assertTrue(Message.objects.filter(id="old").exists())
+        self.assertEqual(
+            list(read_archive(self.tempdir.name, "eventstore_message")), []
+        )
+
+    def test_archive_model(self):
+        """
+        Should only archive the specified models
+        """
+        old = timezone.now() - timedelta(days=100)
+        Message.objects.create(id="old", timestamp=old)
+        Event.objects.create(message_id="old", timestamp=old)
+
+        call_command(
+            "archive_eventstore",
+            output=self.tempdir.name,
+            model=["event"],
+            stdout=StringIO(),
+        )
+
+        self.assertTrue(Message.objects.exists())
+        self.assertFalse(Event.objects.exists())
+
+    def test_read_archive_dates(self):
+        """
+        Should only read the archived dates in the given range
+        """
+        for day in (1, 2, 3):
+            Message.objects.create(
+                id=f"message{day}",
+                timestamp=datetime(2020, 1, day, 12, tzinfo=timezone.utc),
+            )
+        call_command("archive_eventstore", output=self.tempdir.name, stdout=StringIO())
+
+        messages = read_archive(
+            self.tempdir.name,
+            "eventstore_message",
+            since=date(2020, 1, 2),
+            until=date(2020, 1, 3),
+        )
+        self.assertEqual([m["id"] for m in messages], ["message2"])
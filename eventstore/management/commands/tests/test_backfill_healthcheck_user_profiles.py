@@ -0,0 +1,62 @@
+from io import StringIO
+
+from django.core.management import call_command
+from django.test import TestCase
+
+from eventstore.models import Covid19Triage, HealthCheckUserProfile
+
+
+class BackfillHealthCheckUserProfilesTests(TestCase):
+    def create_healthcheck(self, msisdn, **kwargs):
+        return Covid19Triage.objects.create(
+            msisdn=msisdn,
+            source="USSD",
+            province="ZA-WC",
+            city="Cape Town",
+            age=Covid19Triage.AGE_18T40,
+            fever=False,
+            cough=False,
+            sore_throat=False,
+            exposure=Covid19Triage.EXPOSURE_NO,
+            tracing=True,
+            risk=Covid19Triage.RISK_LOW,
+            **kwargs,
+        )
+
+    def test_creates_profiles(self):
+        """
+        Should create a profile for each MSISDN, from all of their healthchecks, in
+        order
+        """
+        self.create_healthcheck(
+            "+27820001001",
+            first_name="old",
+            last_name="last",
+            completed_timestamp="2020-01-01T00:00:00Z",
+        )
+        self.create_healthcheck(
+            "+27820001001", first_name="new", completed_timestamp="2020-01-02T00:00:00Z"
+        )
+        self.create_healthcheck("+27820001002", first_name="other")
+
+        call_command(
+            "backfill_healthcheck_user_profiles", "--batch-size=1", stdout=StringIO()
+        )
+
+        profile = HealthCheckUserProfile.objects.get(msisdn="+27820001001")
+        self.assertEqual(profile.first_name, "new")
+        self.assertEqual(profile.last_name, "last")
+        profile = HealthCheckUserProfile.objects.get(msisdn="+27820001002")
+        self.assertEqual(profile.first_name, "other")
+
+    def test_skips_existing_profiles(self):
+        """
+        Existing profiles should not be changed
+        """
+        self.create_healthcheck("+27820001001", first_name="old")
+        HealthCheckUserProfile.objects.create(msisdn="+27820001001", first_name="new")
+
+        call_command("backfill_healthcheck_user_profiles", stdout=StringIO())
+
+        [profile] = HealthCheckUserProfile.objects.all()
+        self.assertEqual(profile.first_name, "new")
@@ -0,0 +1,251 @@
+from datetime import datetime, timezone
+from io import StringIO
+from unittest import mock
+
+from django.core.management import call_command
+from django.db import OperationalError
+from django.test import TestCase, override_settings
+from django_redis import get_redis_connection
+
+from eventstore.models import Event, Message
+from eventstore.webhook_queue import WebhookQueue
+
+
+@override_settings(EVENTSTORE_WEBHOOK_QUEUE_STREAM="test_eventstore_webhooks")
+class FlushWebhookQueueTests(TestCase):
+    def tearDown(self):
+        redis = get_redis_connection("redis")
+        redis.delete("test_eventstore_webhooks", "test_eventstore_webhooks:dead")
+
+    def call_command(self, *args):
+        stdout = StringIO()
+        call_command(
+            "flush_webhook_queue",
+            "--drain",
+            "--max-wait=0.1",
+            "--consumer=test",
+            *args,
+            stdout=stdout,
+            stderr=StringIO(),
+        )
+        return stdout.getvalue().strip()
+
+    def test_stores_queued_webhooks(self):
+        """
+        Should store all the queued webhooks, and remove them from the queue
+        """
+        queue = WebhookQueue()
+        queue.enqueue(
+            WebhookQueue.WHATSAPP,
+            {
+                "messages": [
+                    {
+                        "id": "inbound-id",
+                        "from": "27820001001",
+                        "timestamp": "1518694700",
+                        "type": "text",
+                        "text": {"body": "hi"},
+                    }
+                ],
+                "statuses": [
+                    {
+                        "id": "outbound-id",
+                        "recipient_id": "27820001001",
+                        "status": "read",
+                        "timestamp": "1518694700",
+                    }
+                ],
+            },
+            created_by="test",
+            fallback_channel=True,
+        )
+        queue.enqueue(
+            WebhookQueue.TURN,
+            {"to": "27820001001", "type": "text", "text": {"body": "hello"}},
+            created_by="test",
+            fallback_channel=False,
+            message_id="outbound-id",
+        )
+
+        self.assertEqual(self.call_command(), "Stored 2 webhooks")
+
+        inbound = Message.objects.get(id="inbound-id")
+        self.assertEqual(inbound.message_direction, Message.INBOUND)
+        self.assertTrue(inbound.fallback_channel)
+        outbound = Message.objects.get(id="outbound-id")
+        self.assertEqual(outbound.message_direction, Message.OUTBOUND)
+        self.assertFalse(outbound.fallback_channel)
+        [event] = Event.objects.all()
+        self.assertEqual(event.status, "read")
+        self.assertEqual(queue.length(), 0)
+
+    def test_stores_pending_webhooks(self):
+        """
+        Webhooks that were read but never stored, eg. because the process was
+        killed, should be stored
+        """
+        queue = WebhookQueue()
+        queue.create_group()
+        queue.enqueue(
+            WebhookQueue.WHATSAPP,
+            {"statuses": []},
+            created_by="test",
+            fallback_channel=False,
+        )
+        queue.enqueue(
+            WebhookQueue.TURN,
+            {"to": "27820001001", "type": "text", "text": {"body": "hello"}},
+            created_by="test",
+            fallback_channel=False,
+            message_id="outbound-id",
+        )
+        [_, (id, webhook)] = queue.read("test", 10)
+        self.assertEqual(webhook["message_id"], "outbound-id")
+
+        self.call_command()
+
+        self.assertTrue(Message.objects.filter(id="outbound-id").exists())
+        self.assertEqual(queue.length(), 0)
+
+    def test_dead_letters_invalid_webhooks(self):
+        """
+        Webhooks that cannot be stored should be moved to the dead letter stream,
+        without stopping the rest of the batch from being stored
+        """
+        queue = WebhookQueue()
+        queue.enqueue(
+            WebhookQueue.WHATSAPP,
+            {"messages": [{"id": "invalid"}]},
+            created_by="test",
+            fallback_channel=False,
+        )
+        queue.enqueue(
+            WebhookQueue.TURN,
+            {"to": "27820001001", "type": "text", "text": {"body": "hello"}},
+            created_by="test",
+            fallback_channel=False,
+            message_id="outbound-id",
+        )
+
+        self.call_command()
+
+        self.assertTrue(Message.objects.filter(id="outbound-id").exists())
+        self.assertEqual(queue.length(), 0)
+        self.assertEqual(queue.redis.xlen("test_eventstore_webhooks:dead"), 1)
+
+    @mock.patch("eventstore.management.commands.flush_webhook_queue.Command.save")
+    def test_temporary_errors_not_dead_lettered(self, save):
+        """
+        Webhooks that cannot be stored because of a temporary error, eg. losing the
+        database connection, should be left in the queue to be stored again
+        """
+        save.side_effect = OperationalError("connection lost")
+        queue = WebhookQueue()
+        queue.enqueue(
+            WebhookQueue.TURN,
+            {"to": "27820001001", "type": "text", "text": {"body": "hello"}},
+            created_by="test",
+            fallback_channel=False,
+            message_id="outbound-id",
+        )
+
+        with self.assertRaises(OperationalError):
+            self.call_command()
+
+        self.assertEqual(queue.length(), 1)
+        self.assertEqual(queue.redis.xlen("test_eventstore_webhooks:dead"), 0)
+
+    def test_redelivered_events_not_stored_again(self):
+        """
+        Webhooks that were stored but not acknowledged, eg. because the process was
+        killed, shouldn't have their events stored again
+        """
+        queue = WebhookQueue()
+        queue.create_group()
+        queue.enqueue(
+            WebhookQueue.WHATSAPP,
+            {
+                "statuses": [
+                    {
+                        "id": f"outbound-{i}",
+                        "recipient_id": "27820001001",
+                        "status": "read",
+                        "timestamp": "1518694700",
+                    }
+                    for i in range(2)
+                ]
+            },
+            created_by="test",
+            fallback_channel=False,
+        )
+        queue.read("test", 10)
+        Event.objects.create(
+            message_id="outbound-0",
+            recipient_id="27820001001",
+            status="read",
+            timestamp=datetime(2018, 2, 15, 11, 38, 20, tzinfo=timezone.utc),
+        )
+
+        self.call_command()
+
+        self.assertEqual(
+            sorted(Event.objects.values_list("message_id", flat=True)),
+            ["outbound-0", "outbound-1"],
+        )
+        self.assertEqual(queue.length(), 0)
+
+    def test_claims_idle_webhooks(self):
+        """
+        Webhooks that were read by another consumer, but never stored, should be
+        claimed and stored once they've been idle for long enough
+        """
+        queue = WebhookQueue()
+        queue.create_group()
+        queue.enqueue(
+            WebhookQueue.TURN,
+            {"to": "27820001001", "type": "text", "text": {"body": "hello"}},
+            created_by="test",
+            fallback_channel=False,
+            message_id="outbound-id",
+        )
+        queue.read("stopped-consumer", 10)
+
+        self.call_command("--claim-idle=60")
+        self.assertFalse(Message.objects.filter(id="outbound-id").exists())
+
+        self.call_command("--claim-idle=0")
+        self.assertTrue(Message.objects.filter(id="outbound-id").exists())
+        self.assertEqual(queue.length(), 0)
+
+    @override_settings(ENABLE_EVENTSTORE_WHATSAPP_ACTIONS=True)
+    @mock.patch("eventstore.views.handle_event")
+    def test_failed_actions_not_stored_again(self, handle_event):
+        """
+        If an action fails after the webhooks are written, the rest of the actions
+        should still run, and the webhooks shouldn't be written again
+        """
+        handle_event.side_effect = [Exception("action failed"), None]
+        queue = WebhookQueue()
+        queue.enqueue(
+            WebhookQueue.WHATSAPP,
+            {
+                "statuses": [
+                    {
+                        "id": f"outbound-{i}",
+                        "recipient_id": "27820001001",
+                        "status": "read",
+                        "timestamp": "1518694700",
+                    }
+                    for i in range(2)
+                ]
+            },
+            created_by="test",
+            fallback_channel=False,
+        )
+
+        self.call_command()
+
+        self.assertEqual(Event.objects.count(), 2)
+        self.assertEqual(handle_event.call_count, 2)
+        self.assertEqual(queue.length(), 0)
+        self.assertEqual(queue.redis.xlen("test_eventstore_webhooks:dead"), 0)
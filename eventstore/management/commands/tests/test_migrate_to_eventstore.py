@@ -332,3 +332,79 @@ class MigrateToEventstoreTests(TestCase):
         self.assertEqual(change.new_passport_number, "A123456")
         self.assertEqual(change.source, "testsource")
         self.assertEqual(change.created_by, "testusername")
+
+    def create_babyswitch_change(self, id):
+        user, _ = User.objects.get_or_create(username="testusername")
+        source, _ = Source.objects.get_or_create(
+            name="testsource", authority="patient", user=user
+        )
+        return Change.objects.create(
+            id=id,
+            registrant_id="0bbb7161-ba0a-45e2-9888-d1a29fa01b40",
+            action="baby_switch",
+            source=source,
+            validated=True,
+        )
+
+    def test_delete_in_batches(self):
+        """
+        Should migrate and delete the changes in batches
+        """
+        for i in range(3):
+            self.create_babyswitch_change(f"7fd2b2d4-e5fd-4264-b365-d2eda1764ba{i}")
+
+        call_command("migrate_to_eventstore", delete=True, batch_size=2)
+
+        self.assertEqual(BabySwitch.objects.count(), 3)
+        self.assertFalse(Change.objects.exists())
+
+    def test_rerun(self):
+        """
+        Running the migration again should update the existing rows
+        """
+        change = self.create_babyswitch_change("7fd2b2d4-e5fd-4264-b365-d2eda1764ba4")
+        call_command("migrate_to_eventstore")
+        change.data = {"test": "data"}
+        change.save()
+        call_command("migrate_to_eventstore")
+
+        [babyswitch] = BabySwitch.objects.all()
+        self.assertEqual(babyswitch.data, {"test": "data"})
+
+    def test_rerun_keeps_other_fields(self):
+        """
+        Running the migration again should only update the migrated fields
+        """
+        user = User.objects.create_user("testusername")
+        source = Source.objects.create(
+            name="testsource", authority="patient", user=user
+        )
+        change = Change.objects.create(
+            id="7fd2b2d4-e5fd-4264-b365-d2eda1764ba4",
+            registrant_id="0bbb7161-ba0a-45e2-9888-d1a29fa01b40",
+            action="momconnect_change_msisdn",
+            source=source,
+            validated=True,
+            data={"msisdn": "+27820001001"},
+        )
+        call_command("migrate_to_eventstore")
+        MSISDNSwitch.objects.filter(id=change.id).update(old_msisdn="+27820001002")
+        call_command("migrate_to_eventstore")
+
+        [msisdnswitch] = MSISDNSwitch.objects.all()
+        self.assertEqual(msisdnswitch.old_msisdn, "+27820001002")
+        self.assertEqual(msisdnswitch.new_msisdn, "+27820001001")
+
+    def test_resume(self):
+        """
+        Should only migrate the rows after the last migrated row when resuming
+        """
+        self.create_babyswitch_change("7fd2b2d4-e5fd-4264-b365-d2eda1764ba1")
+        call_command("migrate_to_eventstore")
+        BabySwitch.objects.all().delete()
+        self.create_babyswitch_change("7fd2b2d4-e5fd-4264-b365-d2eda1764ba2")
+
+        call_command("migrate_to_eventstore", resume=True)
+
+        [babyswitch] = BabySwitch.objects.all()
+        self.assertEqual(babyswitch.id, UUID("7fd2b2d4-e5fd-4264-b365-d2eda1764ba2"))
@@ -0,0 +1,79 @@
+from django.db import migrations, models
+
+
+def add_index_concurrently(model_name, field, name):
+    """
+    AddIndex, but without locking the table against writes while it is built
+    """
+    return migrations.SeparateDatabaseAndState(
+        database_operations=[
+            migrations.RunSQL(
+                sql=f'CREATE INDEX CONCURRENTLY IF NOT EXISTS "{name}" '
+                f'ON "eventstore_{model_name}" ("{field}");',
+                reverse_sql=f'DROP INDEX CONCURRENTLY IF EXISTS "{name}";',
+            )
+        ],
+        state_operations=[
+            migrations.AddIndex(
+                model_name=model_name, index=models.Index(fields=[field], name=name)
+            )
+        ],
+    )
+
+
+class Migration(migrations.Migration):
+    atomic = False
+
+    dependencies = [("eventstore", "0036_auto_20201007_1040")]
+
+    operations = [
+        add_index_concurrently(
+            "optout", "contact_id", "eventstore__contact_529239_idx"
+        ),
+        add_index_concurrently(
+            "babyswitch", "contact_id", "eventstore__contact_fcf542_idx"
+        ),
+        add_index_concurrently(
+            "channelswitch", "contact_id", "eventstore__contact_5bf251_idx"
+        ),
+        add_index_concurrently(
+            "msisdnswitch", "contact_id", "eventstore__contact_d9d1ad_idx"
+        ),
+        add_index_concurrently(
+            "languageswitch", "contact_id", "eventstore__contact_2837d2_idx"
+        ),
+        add_index_concurrently(
+            "identificationswitch", "contact_id", "eventstore__contact_3141b9_idx"
+        ),
+        add_index_concurrently(
+            "researchoptinswitch", "contact_id", "eventstore__contact_94c198_idx"
+        ),
+        add_index_concurrently(
+            "publicregistration", "contact_id", "eventstore__contact_957b46_idx"
+        ),
+        add_index_concurrently(
+            "chwregistration", "contact_id", "eventstore__contact_542d32_idx"
+        ),
+        add_index_concurrently(
+            "prebirthregistration", "contact_id", "eventstore__contact_d55a9a_idx"
+        ),
+        add_index_concurrently(
+            "pmtctregistration", "contact_id", "eventstore__contact_1a1225_idx"
+        ),
+        add_index_concurrently(
+            "postbirthregistration", "contact_id", "eventstore__contact_2a7e58_idx"
+        ),
+        add_index_concurrently(
+            "eddswitch", "contact_id", "eventstore__contact_1d7a99_idx"
+        ),
+        add_index_concurrently(
+            "babydobswitch", "contact_id", "eventstore__contact_8eabff_idx"
+        ),
+        add_index_concurrently(
+            "message", "contact_id", "eventstore__contact_6d9808_idx"
+        ),
+        add_index_concurrently("event", "message_id", "eventstore__message_5be75d_idx"),
+        add_index_concurrently(
+            "event", "recipient_id", "eventstore__recipie_37cb61_idx"
+        ),
+    ]
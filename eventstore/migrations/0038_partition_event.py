@@ -0,0 +1,133 @@
+import datetime
+
+from django.db import migrations, transaction
+from django.db.migrations.exceptions import IrreversibleError
+
+CHECK_CONSTRAINT = "eventstore_event_legacy_timestamp_check"
+UNIQUE_INDEX = "eventstore_event_legacy_id_timestamp"
+MINIMUM_SERVER_VERSION = 110_000
+
+
+def partition_events(apps, schema_editor):
+    """
+    Turns the events table into a table partitioned by range on timestamp, with the
+    existing table attached as the partition for everything before the start of the
+    month after next. The manage_event_partitions command creates the monthly
+    partitions after that.
+
+    Everything that would lock the existing table for longer than a moment, ie.
+    building the index and validating the constraint that the partition needs, is
+    done before the switch.
+    """
+    today = datetime.date.today()
+    month = today.replace(day=1) + datetime.timedelta(days=32)
+    cutoff = (month.replace(day=1) + datetime.timedelta(days=32)).replace(day=1)
+    cutoff = f"{cutoff.isoformat()} 00:00:00+00"
+
+    connection = schema_editor.connection
+    if connection.pg_version < MINIMUM_SERVER_VERSION:
+        raise RuntimeError(
+            "Partitioning the events table needs PostgreSQL 11 or later, but the "
+            f"server is version {connection.pg_version}"
+        )
+
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"""
+            CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS "{UNIQUE_INDEX}"
+            ON "eventstore_event" ("id", "timestamp")
+            """
+        )
+        cursor.execute(
+            f"""
+            ALTER TABLE "eventstore_event" ADD CONSTRAINT "{CHECK_CONSTRAINT}"
+            CHECK ("timestamp" < '{cutoff}') NOT VALID
+            """
+        )
+        cursor.execute(
+            f'ALTER TABLE "eventstore_event" VALIDATE CONSTRAINT "{CHECK_CONSTRAINT}"'
+        )
+
+    with transaction.atomic(using=connection.alias), connection.cursor() as cursor:
+        for sql in [
+            'ALTER TABLE "eventstore_event" RENAME TO "eventstore_event_legacy"',
+            'ALTER TABLE "eventstore_event_legacy" RENAME CONSTRAINT '
+            '"eventstore_event_pkey" TO "eventstore_event_legacy_pkey"',
+            'ALTER INDEX "eventstore__message_5be75d_idx" '
+            'RENAME TO "eventstore_event_legacy_message_id"',
+            'ALTER INDEX "eventstore__recipie_37cb61_idx" '
+            'RENAME TO "eventstore_event_legacy_recipient_id"',
+            f'ALTER TABLE "eventstore_event_legacy" ADD CONSTRAINT "{UNIQUE_INDEX}" '
+            f'UNIQUE USING INDEX "{UNIQUE_INDEX}"',
+            'CREATE TABLE "eventstore_event" '
+            '(LIKE "eventstore_event_legacy" INCLUDING DEFAULTS) '
+            'PARTITION BY RANGE ("timestamp")',
+            'ALTER TABLE "eventstore_event" ADD CONSTRAINT "eventstore_event_pkey" '
+            'PRIMARY KEY ("id", "timestamp")',
+            'CREATE INDEX "eventstore__message_5be75d_idx" '
+            'ON ONLY "eventstore_event" ("message_id")',
+            'CREATE INDEX "eventstore__recipie_37cb61_idx" '
+            'ON ONLY "eventstore_event" ("recipient_id")',
+            # The existing indexes on the old table are attached to the new ones
+            'ALTER TABLE "eventstore_event" ATTACH PARTITION "eventstore_event_legacy" '
+            f"FOR VALUES FROM (MINVALUE) TO ('{cutoff}')",
+            # So that the sequence isn't dropped with the old table once it's archived
+            'ALTER SEQUENCE "eventstore_event_id_seq" OWNED BY "eventstore_event"."id"',
+            # Events never fail to insert, even if the future partitions are missing
+            'CREATE TABLE "eventstore_event_default" '
+            'PARTITION OF "eventstore_event" DEFAULT',
+        ]:
+            cursor.execute(sql)
+
+
+def unpartition_events(apps, schema_editor):
+    """
+    Turns the events table back into a regular table, by detaching the original
+    table and moving the events from all the other partitions into it. Events in
+    partitions that were already detached, for archiving, aren't moved back.
+    """
+    connection = schema_editor.connection
+    with transaction.atomic(using=connection.alias), connection.cursor() as cursor:
+        cursor.execute(
+            """
+            SELECT 1 FROM pg_inherits
+            WHERE inhparent = 'eventstore_event'::regclass
+            AND inhrelid = 'eventstore_event_legacy'::regclass
+            """
+        )
+        if cursor.fetchone() is None:
+            raise IrreversibleError(
+                "The eventstore_event_legacy partition has been detached, so the "
+                "events table can't be turned back into a regular table"
+            )
+
+        for sql in [
+            'ALTER TABLE "eventstore_event" '
+            'DETACH PARTITION "eventstore_event_legacy"',
+            f'ALTER TABLE "eventstore_event_legacy" DROP CONSTRAINT "{CHECK_CONSTRAINT}"',
+            # Both tables have the same columns in the same order
+            'INSERT INTO "eventstore_event_legacy" SELECT * FROM "eventstore_event"',
+            'ALTER SEQUENCE "eventstore_event_id_seq" '
+            'OWNED BY "eventstore_event_legacy"."id"',
+            # Drops the remaining partitions, and the partitioned indexes
+            'DROP TABLE "eventstore_event"',
+            'ALTER TABLE "eventstore_event_legacy" RENAME TO "eventstore_event"',
+            'ALTER TABLE "eventstore_event" RENAME CONSTRAINT '
+            '"eventstore_event_legacy_pkey" TO "eventstore_event_pkey"',
+            'ALTER INDEX "eventstore_event_legacy_message_id" '
+            'RENAME TO "eventstore__message_5be75d_idx"',
+            'ALTER INDEX "eventstore_event_legacy_recipient_id" '
+            'RENAME TO "eventstore__recipie_37cb61_idx"',
+            f'ALTER TABLE "eventstore_event" DROP CONSTRAINT "{UNIQUE_INDEX}"',
+        ]:
+            cursor.execute(sql)
+
+
+class Migration(migrations.Migration):
+    atomic = False
+
+    dependencies = [("eventstore", "0037_contact_id_indexes")]
+
+    operations = [
+        migrations.RunPython(partition_events, unpartition_events, atomic=False)
+    ]
@@ -0,0 +1,48 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    atomic = False
+
+    dependencies = [("eventstore", "0038_partition_event")]
+
+    operations = [
+        # The new index also covers lookups on just contact_id, so it replaces the
+        # contact_id index
+        migrations.SeparateDatabaseAndState(
+            database_operations=[
+                migrations.RunSQL(
+                    sql="""
+                    CREATE INDEX CONCURRENTLY IF NOT EXISTS
+                    "eventstore__contact_95b0eb_idx"
+                    ON "eventstore_message" ("contact_id", "timestamp");
+                    """,
+                    reverse_sql="""
+                    DROP INDEX CONCURRENTLY IF EXISTS "eventstore__contact_95b0eb_idx";
+                    """,
+                ),
+                migrations.RunSQL(
+                    sql="""
+                    DROP INDEX CONCURRENTLY IF EXISTS "eventstore__contact_6d9808_idx";
+                    """,
+                    reverse_sql="""
+                    CREATE INDEX CONCURRENTLY IF NOT EXISTS
+                    "eventstore__contact_6d9808_idx"
+                    ON "eventstore_message" ("contact_id");
+                    """,
+                ),
+            ],
+            state_operations=[
+                migrations.AddIndex(
+                    model_name="message",
+                    index=models.Index(
+                        fields=["contact_id", "timestamp"],
+                        name="eventstore__contact_95b0eb_idx",
+                    ),
+                ),
+                migrations.RemoveIndex(
+                    model_name="message", name="eventstore__contact_6d9808_idx"
+                ),
+            ],
+        )
+    ]
@@ -1,14 +1,22 @@
+import datetime
+import re
 import uuid
-from typing import Text
+from itertools import chain
+from typing import Iterable, List, Optional, Text, Tuple
 
 import pycountry
+from django.conf import settings
 from django.conf.locale import LANG_INFO
 from django.contrib.postgres.fields import JSONField
-from django.db import models
-from django.utils import timezone
+from django.core.cache import caches
+from django.db import IntegrityError, connections, models, transaction
+from django.utils import dateparse, timezone
+from django_redis import get_redis_connection
 
 from registrations.validators import geographic_coordinate, za_phone_number
 
+locmem_cache = caches["locmem"]
+
 LANGUAGE_TYPES = ((v["code"].rstrip("-za"), v["name"]) for v in LANG_INFO.values())
 
 SAID_IDTYPE = "sa_id"
@@ -34,6 +42,74 @@ WHATSAPP_CHANNELTYPE = "WhatsApp"
 CHANNEL_TYPES = ((SMS_CHANNELTYPE, "SMS"), (WHATSAPP_CHANNELTYPE, "WhatsApp"))
 
 
+class BulkUpsertManager(models.Manager):
+    # Postgres allows at most this many parameters in a single query
+    MAX_QUERY_PARAMS = 65535
+
+    def bulk_upsert(
+        self, objs: List[models.Model], update_fields: Optional[Iterable[str]] = None
+    ) -> List[Tuple[models.Model, bool]]:
+        """
+        Inserts or updates all of the given objects using INSERT ... ON CONFLICT (pk)
+        DO UPDATE queries, as few as Postgres's limit on query parameters allows.
+        If `update_fields` is given, only those fields are updated on existing rows.
+
+        Returns a list of (obj, created) tuples, in the same order as the given
+        objects, where created is True if the object didn't exist before.
+        """
+        # Postgres cannot update the same row twice in a single statement, so if
+        # the same primary key is repeated, the last one wins
+        pk = self.model._meta.pk
+        unique = {pk.to_python(obj.pk): obj for obj in objs}
+        if not unique:
+            return []
+
+        connection = connections[self.db]
+        qn = connection.ops.quote_name
+        opts = self.model._meta
+        fields = opts.concrete_fields
+        if update_fields is None:
+            updated = [f for f in fields if not f.primary_key]
+        else:
+            updated = [opts.get_field(name) for name in update_fields]
+        pk_column = qn(pk.column)
+
+        row = "({})".format(", ".join(["%s"] * len(fields)))
+        sql = """
+            INSERT INTO {table} ({columns}) VALUES {{values}}
+            ON CONFLICT ({pk}) DO UPDATE SET {updates}
+            RETURNING {pk}, (xmax = 0)
+        """.format(
+            table=qn(opts.db_table),
+            columns=", ".join(qn(f.column) for f in fields),
+            pk=pk_column,
+            updates=", ".join(
+                f"{qn(f.column)} = EXCLUDED.{qn(f.column)}" for f in updated
+            ),
+        )
+
+        batch_size = self.MAX_QUERY_PARAMS // len(fields)
+        unique_objs = list(unique.values())
+        created: dict = {}
+        with connection.cursor() as cursor:
+            for start in range(0, len(unique_objs), batch_size):
+                end = start + batch_size
+                batch = unique_objs[start:end]
+                params: list = []
+                for obj in batch:
+                    params.extend(
+                        f.get_db_prep_save(f.pre_save(obj, True), connection)
+                        for f in fields
+                    )
+                cursor.execute(sql.format(values=", ".join([row] * len(batch))), params)
+                # xmax is 0 for newly inserted rows, and nonzero for updated rows
+                created.update(
+                    (pk.to_python(id), inserted) for id, inserted in cursor.fetchall()
+                )
+
+        return [(obj, created[id]) for id, obj in unique.items()]
+
+
 class OptOut(models.Model):
     STOP_TYPE = "stop"
     FORGET_TYPE = "forget"
@@ -68,6 +144,11 @@ class OptOut(models.Model):
     created_by = models.CharField(max_length=255, blank=True, default="")
     data = JSONField(default=dict, blank=True, null=True)
 
+    objects = BulkUpsertManager()
+
+    class Meta:
+        indexes = [models.Index(fields=["contact_id"])]
+
     def __str__(self):
         return "{} opt out: {} <{}>".format(
             self.get_optout_type_display(), self.get_reason_display(), self.contact_id
@@ -82,8 +163,11 @@ class BabySwitch(models.Model):
     created_by = models.CharField(max_length=255, blank=True, default="")
     data = JSONField(default=dict, blank=True, null=True)
 
+    objects = BulkUpsertManager()
+
     class Meta:
         verbose_name_plural = "Baby switches"
+        indexes = [models.Index(fields=["contact_id"])]
 
 
 class ChannelSwitch(models.Model):
@@ -96,8 +180,11 @@ class ChannelSwitch(models.Model):
     created_by = models.CharField(max_length=255, blank=True, default="")
     data = JSONField(default=dict, blank=True, null=True)
 
+    objects = BulkUpsertManager()
+
     class Meta:
         verbose_name_plural = "Channel switches"
+        indexes = [models.Index(fields=["contact_id"])]
 
 
 class MSISDNSwitch(models.Model):
@@ -110,12 +197,95 @@ class MSISDNSwitch(models.Model):
     created_by = models.CharField(max_length=255, blank=True, default="")
     data = JSONField(default=dict, blank=True, null=True)
 
+    objects = BulkUpsertManager()
+
+    class Meta:
+        indexes = [models.Index(fields=["contact_id"])]
+
+
+class DeliveryFailureManager(models.Manager):
+    def record_failure(
+        self, contact_id: Text, timestamp: datetime.datetime
+    ) -> Optional[int]:
+        """
+        Atomically increments the number of failures for the contact, but only
+        counts at most one failure per day, and not within a day of the contact's
+        last successful delivery.
+
+        Returns the new number of failures, or None if the failure wasn't counted
+        because there was already one counted, or a successful delivery, in the day
+        before `timestamp`.
+
+        Also forgets that the contact is at 0 failures, see `reset_delivery_failures`.
+        """
+        redis = get_redis_connection("redis")
+        # Successful deliveries for contacts that are known to be at 0 failures only
+        # update the time in their marker, instead of the timestamp in the database
+        last_reset = redis.get(f"delivery_failure_zero:{contact_id}")
+        if last_reset is not None:
+            last_reset = datetime.datetime.fromtimestamp(
+                float(last_reset), tz=datetime.timezone.utc
+            )
+
+        connection = connections[self.db]
+        qn = connection.ops.quote_name
+        table = qn(self.model._meta.db_table)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"""
+                INSERT INTO {table} ("contact_id", "timestamp", "number_of_failures")
+                VALUES (%s, %s, 1)
+                ON CONFLICT ("contact_id") DO UPDATE SET
+                    "number_of_failures" = {table}."number_of_failures" + 1,
+                    "timestamp" = EXCLUDED."timestamp"
+                WHERE %s - GREATEST({table}."timestamp", %s) >= interval '1 day'
+                RETURNING "number_of_failures"
+                """,
+                [contact_id, timezone.now(), timestamp, last_reset],
+            )
+            row = cursor.fetchone()
+        # The contact might no longer be at 0 failures, so we can't skip their reset.
+        # Changing the version stops a concurrent reset from marking them as at 0.
+        pipe = redis.pipeline()
+        pipe.delete(f"delivery_failure_zero:{contact_id}")
+        pipe.incr(f"delivery_failure_version:{contact_id}")
+        pipe.expire(
+            f"delivery_failure_version:{contact_id}",
+            settings.DELIVERY_FAILURE_ZERO_CACHE_TTL,
+        )
+        pipe.execute()
+        return row[0] if row else None
+
+    def reset_failures(
+        self, contact_ids: List[Text], timestamp: datetime.datetime
+    ) -> None:
+        """
+        Sets the number of failures for the contacts to 0, and their timestamp to
+        `timestamp`, in a single query, creating any that don't exist
+        """
+        connection = connections[self.db]
+        qn = connection.ops.quote_name
+        table = qn(self.model._meta.db_table)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"""
+                INSERT INTO {table} ("contact_id", "timestamp", "number_of_failures")
+                SELECT unnest(%s::varchar[]), %s, 0
+                ON CONFLICT ("contact_id") DO UPDATE SET
+                    "number_of_failures" = 0,
+                    "timestamp" = EXCLUDED."timestamp"
+                """,
+                [contact_ids, timestamp],
+            )
+
 
 class DeliveryFailure(models.Model):
     contact_id = models.CharField(primary_key=True, max_length=255, blank=False)
     timestamp = models.DateTimeField(auto_now=True)
     number_of_failures = models.IntegerField(null=False, default=0)
 
+    objects = DeliveryFailureManager()
+
 
 class LanguageSwitch(models.Model):
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
@@ -127,6 +297,11 @@ class LanguageSwitch(models.Model):
     created_by = models.CharField(max_length=255, blank=True, default="")
     data = JSONField(default=dict, blank=True, null=True)
 
+    objects = BulkUpsertManager()
+
+    class Meta:
+        indexes = [models.Index(fields=["contact_id"])]
+
 
 class IdentificationSwitch(models.Model):
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
@@ -150,6 +325,11 @@ class IdentificationSwitch(models.Model):
     created_by = models.CharField(max_length=255, blank=True, default="")
     data = JSONField(default=dict, blank=True, null=True)
 
+    objects = BulkUpsertManager()
+
+    class Meta:
+        indexes = [models.Index(fields=["contact_id"])]
+
 
 class ResearchOptinSwitch(models.Model):
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
@@ -161,6 +341,9 @@ class ResearchOptinSwitch(models.Model):
     created_by = models.CharField(max_length=255, blank=True, default="")
     data = JSONField(default=dict, blank=True, null=True)
 
+    class Meta:
+        indexes = [models.Index(fields=["contact_id"])]
+
 
 class PublicRegistration(models.Model):
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
@@ -173,6 +356,11 @@ class PublicRegistration(models.Model):
     created_by = models.CharField(max_length=255, blank=True, default="")
     data = JSONField(default=dict, blank=True, null=True)
 
+    objects = BulkUpsertManager()
+
+    class Meta:
+        indexes = [models.Index(fields=["contact_id"])]
+
 
 class CHWRegistration(models.Model):
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
@@ -192,6 +380,11 @@ class CHWRegistration(models.Model):
     created_by = models.CharField(max_length=255, blank=True, default="")
     data = JSONField(default=dict, blank=True, null=True)
 
+    objects = BulkUpsertManager()
+
+    class Meta:
+        indexes = [models.Index(fields=["contact_id"])]
+
 
 class PrebirthRegistration(models.Model):
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
@@ -213,6 +406,11 @@ class PrebirthRegistration(models.Model):
     created_by = models.CharField(max_length=255, blank=True, default="")
     data = JSONField(default=dict, blank=True, null=True)
 
+    objects = BulkUpsertManager()
+
+    class Meta:
+        indexes = [models.Index(fields=["contact_id"])]
+
 
 class PMTCTRegistration(models.Model):
     NORMAL = "normal"
@@ -228,6 +426,11 @@ class PMTCTRegistration(models.Model):
     created_by = models.CharField(max_length=255, blank=True, default="")
     data = JSONField(default=dict, blank=True, null=True)
 
+    objects = BulkUpsertManager()
+
+    class Meta:
+        indexes = [models.Index(fields=["contact_id"])]
+
 
 class PostbirthRegistration(models.Model):
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
@@ -249,6 +452,9 @@ class PostbirthRegistration(models.Model):
     created_by = models.CharField(max_length=255, blank=True, default="")
     data = JSONField(default=dict, blank=True, null=True)
 
+    class Meta:
+        indexes = [models.Index(fields=["contact_id"])]
+
 
 class EddSwitch(models.Model):
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
@@ -260,6 +466,9 @@ class EddSwitch(models.Model):
     created_by = models.CharField(max_length=255, blank=True, default="")
     data = JSONField(default=dict, blank=True, null=True)
 
+    class Meta:
+        indexes = [models.Index(fields=["contact_id"])]
+
 
 class BabyDobSwitch(models.Model):
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
@@ -271,6 +480,9 @@ class BabyDobSwitch(models.Model):
     created_by = models.CharField(max_length=255, blank=True, default="")
     data = JSONField(default=dict, blank=True, null=True)
 
+    class Meta:
+        indexes = [models.Index(fields=["contact_id"])]
+
 
 class Message(models.Model):
     INBOUND = "I"
@@ -286,6 +498,11 @@ class Message(models.Model):
     created_by = models.CharField(max_length=255, blank=True)
     fallback_channel = models.BooleanField(default=False)
 
+    objects = BulkUpsertManager()
+
+    class Meta:
+        indexes = [models.Index(fields=["contact_id", "timestamp"])]
+
     @property
     def is_operator_message(self):
         """
@@ -321,6 +538,127 @@ class Message(models.Model):
         return False
 
 
+def add_months(timestamp: datetime.datetime, months: int) -> datetime.datetime:
+    """
+    Returns the start of the month `months` months after the month of `timestamp`
+    """
+    month = timestamp.year * 12 + timestamp.month - 1 + months
+    return timestamp.replace(
+        year=month // 12,
+        month=month % 12 + 1,
+        day=1,
+        hour=0,
+        minute=0,
+        second=0,
+        microsecond=0,
+    )
+
+
+class EventManager(models.Manager):
+    """
+    The events table is partitioned by range on timestamp, with a partition per
+    month. These create and detach those partitions.
+    """
+
+    def get_partitions(self) -> List[Tuple[str, Optional[datetime.datetime]]]:
+        """
+        Returns a (name, end) tuple for each partition, where end is the exclusive
+        upper bound of the partition's timestamps, or None for the default partition
+        """
+        with connections[self.db].cursor() as cursor:
+            cursor.execute(
+                """
+                SELECT c.relname, pg_get_expr(c.relpartbound, c.oid)
+                FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+                WHERE i.inhparent = %s::regclass
+                """,
+                [self.model._meta.db_table],
+            )
+            partitions = []
+            for name, bound in cursor.fetchall():
+                match = re.search(r"TO \('([^']+)'\)", bound)
+                end = dateparse.parse_datetime(match.group(1)) if match else None
+                partitions.append((name, end))
+        return sorted(partitions, key=lambda p: (p[1] is None, p[1]))
+
+    def create_partitions(
+        self, months_ahead: int, now: Optional[datetime.datetime] = None
+    ) -> List[str]:
+        """
+        Creates the monthly partitions up to and including `months_ahead` months
+        after the current month, following on from the latest existing partition.
+
+        Any events in the default partition that belong in a new partition are moved
+        into it, otherwise Postgres refuses to create the partition.
+
+        Returns the names of the created partitions.
+        """
+        now = now or timezone.now()
+        partitions = self.get_partitions()
+        ends = [end for _, end in partitions if end is not None]
+        default = next((name for name, end in partitions if end is None), None)
+        start = max(ends) if ends else add_months(now, 0)
+        last = add_months(now, months_ahead + 1)
+
+        connection = connections[self.db]
+        qn = connection.ops.quote_name
+        table = self.model._meta.db_table
+        created = []
+        while start < last:
+            end = add_months(start, 1)
+            name = f"{table}_p{start:%Y_%m}"
+            bounds = f"FROM ('{start.isoformat()}') TO ('{end.isoformat()}')"
+            with transaction.atomic(using=self.db), connection.cursor() as cursor:
+                cursor.execute(
+                    f"CREATE TABLE {qn(name)} (LIKE {qn(table)} INCLUDING DEFAULTS)"
+                )
+                if default is not None:
+                    # So that no more events for this month can be inserted into the
+                    # default partition, until the new partition is attached
+                    cursor.execute(
+                        f"LOCK TABLE {qn(default)} IN SHARE ROW EXCLUSIVE MODE"
+                    )
+                    cursor.execute(
+                        f"""
+                        WITH moved AS (
+                            DELETE FROM {qn(default)}
+                            WHERE "timestamp" >= %s AND "timestamp" < %s
+                            RETURNING *
+                        )
+                        INSERT INTO {qn(name)} SELECT * FROM moved
+                        """,
+                        [start, end],
+                    )
+                # Attaching creates the partition's indexes from the table's indexes
+                cursor.execute(
+                    f"ALTER TABLE {qn(table)} ATTACH PARTITION {qn(name)} "
+                    f"FOR VALUES {bounds}"
+                )
+            created.append(name)
+            start = end
+        return created
+
+    def detach_partitions(self, before: datetime.datetime) -> List[str]:
+        """
+        Detaches the partitions that only contain events from before `before`. The
+        detached partitions are left as standalone tables, to be archived.
+
+        Returns the names of the detached partitions.
+        """
+        connection = connections[self.db]
+        qn = connection.ops.quote_name
+        detached = []
+        with connection.cursor() as cursor:
+            for name, end in self.get_partitions():
+                if end is not None and end <= before:
+                    cursor.execute(
+                        f"ALTER TABLE {qn(self.model._meta.db_table)} "
+                        f"DETACH PARTITION {qn(name)}"
+                    )
+                    detached.append(name)
+        return detached
+
+
 class Event(models.Model):
     SENT = "sent"
     DELIVERED = "delivered"
@@ -341,6 +679,14 @@ class Event(models.Model):
     data = JSONField(default=dict, blank=True, null=True)
     fallback_channel = models.BooleanField(default=False)
 
+    objects = EventManager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["message_id"]),
+            models.Index(fields=["recipient_id"]),
+        ]
+
     @property
     def is_hsm_error(self):
         """
@@ -495,7 +841,11 @@ class HealthCheckUserProfileManager(models.Manager):
     def get_or_prefill(self, msisdn: Text) -> "HealthCheckUserProfile":
         """
         Either gets the existing user profile, or creates one using data in the
-        historical healthchecks
+        historical healthchecks.
+
+        Profiles created from historical healthchecks are saved, so the history is
+        only replayed once per MSISDN. The backfill_healthcheck_user_profiles command
+        creates the profiles for all historical healthchecks up front.
         """
         try:
             return self.get(msisdn=msisdn)
@@ -506,8 +856,74 @@ class HealthCheckUserProfileManager(models.Manager):
             profile = self.model()
             for healthcheck in healthchecks.iterator():
                 profile.update_from_healthcheck(healthcheck)
+            if not profile.msisdn:
+                return profile
+
+            try:
+                with transaction.atomic():
+                    profile.save(force_insert=True)
+            except IntegrityError:
+                # Created concurrently by another request
+                return self.get(msisdn=msisdn)
             return profile
 
+    def get_cached(self, msisdn: Text) -> Optional["HealthCheckUserProfile"]:
+        """
+        Gets the user profile, prefilling it if it doesn't exist, from a per process
+        cache. Returns None if there is no profile.
+
+        Saving the profile clears it from the cache of the current process, other
+        processes will see the change once their cache entry expires.
+        """
+
+        def get():
+            profile = self.get_or_prefill(msisdn)
+            return profile if profile.pk else None
+
+        return locmem_cache.get_or_set(
+            self.model.cache_key(msisdn),
+            get,
+            timeout=settings.HEALTHCHECK_PROFILE_CACHE_TIMEOUT,
+        )
+
+    def bulk_update_from_healthchecks(
+        self, healthchecks: List[Covid19Triage]
+    ) -> List["HealthCheckUserProfile"]:
+        """
+        Updates the profiles of all the MSISDNs in healthchecks, which must already be
+        saved, prefilling the profiles that don't exist yet from the historical
+        healthchecks. Uses a fixed number of queries, regardless of the number of
+        healthchecks.
+        """
+        healthchecks = sorted(healthchecks, key=lambda h: h.completed_timestamp)
+        msisdns = {h.msisdn for h in healthchecks}
+        profiles = self.in_bulk(msisdns)
+
+        new_msisdns = msisdns - profiles.keys()
+        history = (
+            Covid19Triage.objects.filter(msisdn__in=new_msisdns)
+            .exclude(id__in=[h.id for h in healthchecks])
+            .order_by("completed_timestamp")
+        )
+        for healthcheck in chain(history.iterator(), healthchecks):
+            if healthcheck.msisdn not in profiles:
+                profiles[healthcheck.msisdn] = self.model()
+            profiles[healthcheck.msisdn].update_from_healthcheck(healthcheck)
+
+        self.bulk_update(
+            [p for p in profiles.values() if p.msisdn not in new_msisdns],
+            fields=[f for f in self.model.HEALTHCHECK_FIELDS if f != "msisdn"]
+            + ["data"],
+        )
+        # If a profile was created concurrently, it already contains its own
+        # healthcheck, and the history that we've prefilled with
+        self.bulk_create(
+            [p for p in profiles.values() if p.msisdn in new_msisdns],
+            ignore_conflicts=True,
+        )
+        locmem_cache.delete_many([self.model.cache_key(m) for m in profiles])
+        return list(profiles.values())
+
 
 class HealthCheckUserProfile(models.Model):
     msisdn = models.CharField(
@@ -539,8 +955,33 @@ class HealthCheckUserProfile(models.Model):
     persons_in_household = models.IntegerField(blank=True, null=True, default=None)
     data = JSONField(default=dict, blank=True, null=True)
 
+    # The fields that are copied from each healthcheck
+    HEALTHCHECK_FIELDS = (
+        "msisdn",
+        "first_name",
+        "last_name",
+        "province",
+        "city",
+        "age",
+        "date_of_birth",
+        "gender",
+        "location",
+        "city_location",
+        "preexisting_condition",
+        "rooms_in_household",
+        "persons_in_household",
+    )
+
     objects = HealthCheckUserProfileManager()
 
+    @staticmethod
+    def cache_key(msisdn: Text) -> Text:
+        return f"healthcheck_user_profile:{msisdn}"
+
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        locmem_cache.delete(self.cache_key(self.msisdn))
+
     def update_from_healthcheck(self, healthcheck: Covid19Triage) -> None:
         """
         Updates the profile with the data from the latest healthcheck
@@ -553,21 +994,7 @@ class HealthCheckUserProfile(models.Model):
             """
             return v or v == 0 or v is False
 
-        for field in [
-            "msisdn",
-            "first_name",
-            "last_name",
-            "province",
-            "city",
-            "age",
-            "date_of_birth",
-            "gender",
-            "location",
-            "city_location",
-            "preexisting_condition",
-            "rooms_in_household",
-            "persons_in_household",
-        ]:
+        for field in self.HEALTHCHECK_FIELDS:
             value = getattr(healthcheck, field, None)
             if has_value(value):
                 setattr(self, field, value)
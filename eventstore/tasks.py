@@ -1,13 +1,14 @@
+import hashlib
 import json
 from datetime import datetime
 from urllib.parse import urljoin
 
 import phonenumbers
 import pytz
-import requests
 from celery.exceptions import SoftTimeLimitExceeded
 from django.conf import settings
-from django.utils import dateparse, translation
+from django.db import transaction
+from django.utils import dateparse, timezone, translation
 from django_redis import get_redis_connection
 from requests.exceptions import RequestException
 from temba_client.exceptions import TembaHttpError
@@ -30,11 +31,15 @@ from eventstore.models import (
     PrebirthRegistration,
     PublicRegistration,
     ResearchOptinSwitch,
+    add_months,
 )
 from ndoh_hub.celery import app
-from ndoh_hub.utils import get_today, rapidpro
+from ndoh_hub.utils import get_http_session, get_today, rapidpro
 from registrations.tasks import request_to_jembi_api
 
+# The maximum number of URNs that RapidPro accepts for a single flow start
+RAPIDPRO_MAX_FLOW_START_URNS = 100
+
 
 def get_utc_now():
     return datetime.now(tz=pytz.utc)
@@ -64,6 +69,158 @@ def update_rapidpro_contact(urn, fields):
     rapidpro.update_contact(urn, fields=fields)
 
 
+def coalesce_rapidpro_contact_update(urn, fields):
+    """
+    Updates the contact fields in RapidPro, skipping any field that we've recently
+    set to the same value, and merging all the updates for a contact that happen
+    within the debounce window into a single request
+    """
+    redis = get_redis_connection("redis")
+    cached = redis.mget([f"rapidpro_contact_field:{urn}:{field}" for field in fields])
+    changed = {}
+    for (field, value), cached_value in zip(fields.items(), cached):
+        value = json.dumps(value)
+        if cached_value is None or cached_value.decode() != value:
+            changed[field] = value
+    if not changed:
+        return
+
+    redis.hset(f"rapidpro_contact_pending:{urn}", mapping=changed)
+    # Only the first update in the window schedules the flush
+    debounce = settings.RAPIDPRO_CONTACT_UPDATE_DEBOUNCE
+    if redis.set(f"rapidpro_contact_debounce:{urn}", 1, nx=True, ex=debounce + 60):
+        flush_rapidpro_contact_update.apply_async((urn,), countdown=debounce)
+
+
+def forget_rapidpro_contact_fields(urn, fields):
+    """
+    Forgets the values that we've set for the contact fields. Flows can change these
+    fields in RapidPro, so this should be called when starting those flows, so that
+    the next update for the field isn't skipped
+    """
+    redis = get_redis_connection("redis")
+    redis.delete(*(f"rapidpro_contact_field:{urn}:{field}" for field in fields))
+
+
+@app.task(
+    autoretry_for=(SoftTimeLimitExceeded,),
+    retry_backoff=True,
+    max_retries=15,
+    acks_late=True,
+    soft_time_limit=10,
+    time_limit=15,
+)
+def flush_rapidpro_contact_update(urn):
+    redis = get_redis_connection("redis")
+    pending_key = f"rapidpro_contact_pending:{urn}"
+    pipe = redis.pipeline()
+    pipe.hgetall(pending_key)
+    pipe.delete(pending_key, f"rapidpro_contact_debounce:{urn}")
+    pending, _ = pipe.execute()
+    if not pending:
+        return
+
+    fields = {k.decode(): json.loads(v) for k, v in pending.items()}
+    (
+        update_rapidpro_contact.si(urn, fields)
+        | cache_rapidpro_contact_fields.si(urn, fields)
+    ).delay()
+
+
+@app.task(acks_late=True, soft_time_limit=10, time_limit=15)
+def cache_rapidpro_contact_fields(urn, fields):
+    """
+    Remembers the values that we've set for the contact fields, so that we can skip
+    updating them again to the same value
+    """
+    redis = get_redis_connection("redis")
+    pipe = redis.pipeline()
+    for field, value in fields.items():
+        pipe.set(
+            f"rapidpro_contact_field:{urn}:{field}",
+            json.dumps(value),
+            ex=settings.RAPIDPRO_CONTACT_FIELD_CACHE_TTL,
+        )
+    pipe.execute()
+
+
+def dispatch_flow_start(flow, urns, extra):
+    """
+    Starts the flow for the URNs. If buffering is enabled, the start is buffered and
+    combined with other starts of the same flow with the same extra
+    """
+    if not settings.ENABLE_RAPIDPRO_BUFFERING:
+        return async_create_flow_start.delay(extra=extra, flow=flow, urns=urns)
+
+    redis = get_redis_connection("redis")
+    spec = json.dumps({"flow": flow, "extra": extra}, sort_keys=True)
+    spec_id = hashlib.sha256(spec.encode()).hexdigest()
+    pipe = redis.pipeline()
+    pipe.hset("rapidpro_buffered_flow_starts", spec_id, spec)
+    pipe.sadd(f"rapidpro_buffered_flow_start_urns:{spec_id}", *urns)
+    pipe.execute()
+
+
+def dispatch_contact_update(urn, fields):
+    """
+    Updates the contact fields. If buffering is enabled, the update is buffered and
+    combined with other updates for the same contact
+    """
+    if not settings.ENABLE_RAPIDPRO_BUFFERING:
+        return update_rapidpro_contact.delay(urn, fields)
+
+    redis = get_redis_connection("redis")
+    pipe = redis.pipeline()
+    pipe.hset(
+        f"rapidpro_buffered_fields:{urn}",
+        mapping={k: json.dumps(v) for k, v in fields.items()},
+    )
+    pipe.sadd("rapidpro_buffered_field_urns", urn)
+    pipe.execute()
+
+
+@app.task(acks_late=True, soft_time_limit=60, time_limit=75)
+def flush_rapidpro_buffers():
+    """
+    Sends all the buffered flow starts and contact updates to RapidPro. The requests
+    go through the usual tasks, so that they have the same retry behaviour
+    """
+    redis = get_redis_connection("redis")
+
+    for spec_id, spec in redis.hgetall("rapidpro_buffered_flow_starts").items():
+        spec_id = spec_id.decode()
+        urns_key = f"rapidpro_buffered_flow_start_urns:{spec_id}"
+        pipe = redis.pipeline()
+        pipe.smembers(urns_key)
+        pipe.delete(urns_key)
+        pipe.hdel("rapidpro_buffered_flow_starts", spec_id)
+        urns, _, _ = pipe.execute()
+
+        spec = json.loads(spec)
+        urns = sorted(urn.decode() for urn in urns)
+        while urns:
+            batch, urns = (
+                urns[:RAPIDPRO_MAX_FLOW_START_URNS],
+                urns[RAPIDPRO_MAX_FLOW_START_URNS:],
+            )
+            async_create_flow_start.delay(
+                extra=spec["extra"], flow=spec["flow"], urns=batch
+            )
+
+    for urn in redis.smembers("rapidpro_buffered_field_urns"):
+        urn = urn.decode()
+        fields_key = f"rapidpro_buffered_fields:{urn}"
+        pipe = redis.pipeline()
+        pipe.hgetall(fields_key)
+        pipe.delete(fields_key)
+        pipe.srem("rapidpro_buffered_field_urns", urn)
+        fields, _, _ = pipe.execute()
+        if fields:
+            update_rapidpro_contact.delay(
+                urn, {k.decode(): json.loads(v) for k, v in fields.items()}
+            )
+
+
 @app.task(
     autoretry_for=(RequestException, SoftTimeLimitExceeded, TembaHttpError),
     retry_backoff=True,
@@ -145,43 +302,52 @@ def delete_contact_pii(contact):
     except (TypeError, KeyError):
         return
 
-    MSISDNSwitch.objects.filter(contact_id=contact_uuid).update(
-        old_msisdn="", new_msisdn="", data={}
-    )
-    IdentificationSwitch.objects.filter(contact_id=contact_uuid).update(
-        old_id_number="",
-        new_id_number="",
-        old_passport_number="",
-        new_passport_number="",
-        data={},
-    )
-    CHWRegistration.objects.filter(contact_id=contact_uuid).update(
-        id_number="", passport_number="", data={}
-    )
-    PrebirthRegistration.objects.filter(contact_id=contact_uuid).update(
-        id_number="", passport_number="", data={}
-    )
-    PostbirthRegistration.objects.filter(contact_id=contact_uuid).update(
-        id_number="", passport_number="", data={}
-    )
-    OptOut.objects.filter(contact_id=contact_uuid).update(data={})
-    BabySwitch.objects.filter(contact_id=contact_uuid).update(data={})
-    ChannelSwitch.objects.filter(contact_id=contact_uuid).update(data={})
-    LanguageSwitch.objects.filter(contact_id=contact_uuid).update(data={})
-    ResearchOptinSwitch.objects.filter(contact_id=contact_uuid).update(data={})
-    PublicRegistration.objects.filter(contact_id=contact_uuid).update(data={})
-    PMTCTRegistration.objects.filter(contact_id=contact_uuid).update(data={})
-    EddSwitch.objects.filter(contact_id=contact_uuid).update(data={})
-    BabyDobSwitch.objects.filter(contact_id=contact_uuid).update(data={})
-
     try:
         _, msisdn = contact["urns"][0].split(":")
         msisdn = msisdn.lstrip("+")
     except (KeyError, IndexError, ValueError, AttributeError):
-        return contact_uuid
+        msisdn = None
 
-    Message.objects.filter(contact_id=msisdn).update(contact_id=contact_uuid, data={})
-    Event.objects.filter(recipient_id=msisdn).update(recipient_id=contact_uuid)
+    # All of these are index lookups on contact_id, so erase everything in a single
+    # transaction, so that a retry never sees a partially erased contact
+    with transaction.atomic():
+        MSISDNSwitch.objects.filter(contact_id=contact_uuid).update(
+            old_msisdn="", new_msisdn="", data={}
+        )
+        IdentificationSwitch.objects.filter(contact_id=contact_uuid).update(
+            old_id_number="",
+            new_id_number="",
+            old_passport_number="",
+            new_passport_number="",
+            data={},
+        )
+        CHWRegistration.objects.filter(contact_id=contact_uuid).update(
+            id_number="", passport_number="", data={}
+        )
+        PrebirthRegistration.objects.filter(contact_id=contact_uuid).update(
+            id_number="", passport_number="", data={}
+        )
+        PostbirthRegistration.objects.filter(contact_id=contact_uuid).update(
+            id_number="", passport_number="", data={}
+        )
+        for model in (
+            OptOut,
+            BabySwitch,
+            ChannelSwitch,
+            LanguageSwitch,
+            ResearchOptinSwitch,
+            PublicRegistration,
+            PMTCTRegistration,
+            EddSwitch,
+            BabyDobSwitch,
+        ):
+            model.objects.filter(contact_id=contact_uuid).update(data={})
+
+        if msisdn:
+            Message.objects.filter(contact_id=msisdn).update(
+                contact_id=contact_uuid, data={}
+            )
+            Event.objects.filter(recipient_id=msisdn).update(recipient_id=contact_uuid)
     return contact_uuid
 
 
@@ -305,7 +471,7 @@ def send_undelivered_sms(context):
         }
     )
 
-    r = requests.post(
+    r = get_http_session().post(
         urljoin(settings.TURN_URL, "v1/messages"), headers=headers, data=data
     )
     r.raise_for_status()
@@ -353,9 +519,16 @@ async_handle_whatsapp_delivery_error = (
 def mark_turn_contact_healthcheck_complete(msisdn):
     if settings.HC_TURN_URL is None or settings.HC_TURN_TOKEN is None:
         return
+    window = settings.HC_TURN_COMPLETE_DEDUPLICATION_WINDOW
+    key = f"turn_healthcheck_complete:{msisdn}"
+    redis = get_redis_connection("redis")
+    if window and redis.exists(key):
+        # Already marked complete recently
+        return
+
     contact_id = msisdn.lstrip("+")
     url = urljoin(settings.HC_TURN_URL, f"v1/contacts/{contact_id}/profile")
-    response = requests.patch(
+    response = get_http_session().patch(
         url,
         json={"healthcheck_completed": True},
         headers={
@@ -365,6 +538,40 @@ def mark_turn_contact_healthcheck_complete(msisdn):
     )
     response.raise_for_status()
 
+    if window:
+        # Only set after a successful request, so that retries aren't skipped
+        redis.set(key, 1, ex=window)
+
+
+@app.task(
+    autoretry_for=(RequestException, SoftTimeLimitExceeded),
+    retry_backoff=True,
+    max_retries=15,
+    acks_late=True,
+    soft_time_limit=60,
+    time_limit=75,
+    bind=True,
+)
+def mark_turn_contacts_healthcheck_complete(self, msisdns):
+    """
+    Marks the healthcheck as complete for a batch of up to
+    HC_TURN_COMPLETE_BATCH_SIZE msisdns, in a single task. The msisdns that are
+    done are remembered, so that retries only send the rest.
+    """
+    redis = get_redis_connection("redis")
+    key = f"turn_healthcheck_complete_batch:{self.request.id}"
+    done = set()
+    if self.request.id:
+        done = {m.decode() for m in redis.smembers(key)}
+
+    for msisdn in sorted(set(msisdns) - done):
+        mark_turn_contact_healthcheck_complete(msisdn)
+        if self.request.id:
+            pipe = redis.pipeline()
+            pipe.sadd(key, msisdn)
+            pipe.expire(key, 60 * 60 * 24)
+            pipe.execute()
+
 
 @app.task(
     autoretry_for=(RequestException, SoftTimeLimitExceeded),
@@ -383,7 +590,7 @@ def archive_turn_conversation(urn, message_id, reason):
 
     data = json.dumps({"before": message_id, "reason": reason})
 
-    r = requests.post(
+    r = get_http_session().post(
         urljoin(settings.TURN_URL, f"v1/chats/{urn}/archive"),
         headers=headers,
         data=data,
@@ -455,3 +662,23 @@ def reset_delivery_failure(contact_uuid):
 
     if wa_id:
         DeliveryFailure.objects.filter(contact_id=wa_id).update(number_of_failures=0)
+
+
+@app.task(acks_late=True, soft_time_limit=300, time_limit=330)
+def manage_event_partitions(months_ahead=None, retention_months=None):
+    """
+    Creates the event partitions for the coming months, and detaches the partitions
+    that are older than the retention period. A retention period of 0 keeps all
+    partitions.
+    """
+    if months_ahead is None:
+        months_ahead = settings.EVENTSTORE_EVENT_PARTITIONS_AHEAD
+    if retention_months is None:
+        retention_months = settings.EVENTSTORE_EVENT_RETENTION_MONTHS
+
+    created = Event.objects.create_partitions(months_ahead)
+    detached = []
+    if retention_months:
+        before = add_months(timezone.now(), -retention_months)
+        detached = Event.objects.detach_partitions(before)
+    return created, detached
@@ -1,6 +1,22 @@
-from django.test import TestCase
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from unittest.mock import patch
 
-from eventstore.models import Covid19Triage, Event, HealthCheckUserProfile, Message
+from django.core.cache import caches
+from django.db import connection, connections
+from django.test import TestCase, TransactionTestCase
+from django.utils import timezone
+from django_redis import get_redis_connection
+
+from eventstore.models import (
+    BulkUpsertManager,
+    Covid19Triage,
+    DeliveryFailure,
+    Event,
+    HealthCheckUserProfile,
+    Message,
+    add_months,
+)
 
 
 class MessageTests(TestCase):
@@ -43,6 +59,232 @@ class MessageTests(TestCase):
         msg.fallback_channel = False
         self.assertFalse(msg.has_label("Label1"))
 
+    def test_bulk_upsert(self):
+        """
+        Should create new messages, update existing ones, and return whether each
+        message was created
+        """
+        Message.objects.create(
+            id="existing", contact_id="27820001001", message_direction=Message.INBOUND
+        )
+        result = Message.objects.bulk_upsert(
+            [
+                Message(
+                    id="new",
+                    contact_id="27820001002",
+                    message_direction=Message.INBOUND,
+                    data={"text": {"body": "first"}},
+                ),
+                Message(
+                    id="existing",
+                    contact_id="27820001003",
+                    message_direction=Message.INBOUND,
+                ),
+                Message(
+                    id="new",
+                    contact_id="27820001002",
+                    message_direction=Message.INBOUND,
+                    data={"text": {"body": "second"}},
+                ),
+            ]
+        )
+        self.assertEqual(
+            [(msg.id, created) for msg, created in result],
+            [("new", True), ("existing", False)],
+        )
+        self.assertEqual(Message.objects.count(), 2)
+        self.assertEqual(
+            Message.objects.get(id="new").data, {"text": {"body": "second"}}
+        )
+        self.assertEqual(Message.objects.get(id="existing").contact_id, "27820001003")
+
+    def test_bulk_upsert_update_fields(self):
+        """
+        Should only update the given fields on existing messages
+        """
+        Message.objects.create(
+            id="existing", contact_id="27820001001", message_direction=Message.INBOUND
+        )
+        Message.objects.bulk_upsert(
+            [
+                Message(
+                    id="existing",
+                    contact_id="27820001002",
+                    message_direction=Message.OUTBOUND,
+                )
+            ],
+            update_fields=["contact_id"],
+        )
+        msg = Message.objects.get(id="existing")
+        self.assertEqual(msg.contact_id, "27820001002")
+        self.assertEqual(msg.message_direction, Message.INBOUND)
+
+    def test_bulk_upsert_parameter_limit(self):
+        """
+        Should split the upsert into as many queries as Postgres's parameter limit
+        needs
+        """
+        fields = len(Message._meta.concrete_fields)
+        messages = [
+            Message(id=f"message{i}", message_direction=Message.INBOUND)
+            for i in range(5)
+        ]
+        with patch.object(BulkUpsertManager, "MAX_QUERY_PARAMS", fields * 2):
+            with self.assertNumQueries(3):
+                result = Message.objects.bulk_upsert(messages)
+        self.assertEqual(
+            [(msg.id, created) for msg, created in result],
+            [(f"message{i}", True) for i in range(5)],
+        )
+        self.assertEqual(Message.objects.count(), 5)
+
+    def test_bulk_upsert_empty(self):
+        """
+        Should not make any queries if there are no messages
+        """
+        with self.assertNumQueries(0):
+            self.assertEqual(Message.objects.bulk_upsert([]), [])
+
+
+class DeliveryFailureTests(TestCase):
+    def test_record_failure_new_contact(self):
+        """
+        Should create the delivery failure with a single query
+        """
+        with self.assertNumQueries(1):
+            count = DeliveryFailure.objects.record_failure(
+                "27820001001", timezone.now()
+            )
+        self.assertEqual(count, 1)
+        df = DeliveryFailure.objects.get(contact_id="27820001001")
+        self.assertEqual(df.number_of_failures, 1)
+
+    def test_record_failure_once_per_day(self):
+        """
+        Should only count one failure per day
+        """
+        DeliveryFailure.objects.create(contact_id="27820001001", number_of_failures=2)
+
+        count = DeliveryFailure.objects.record_failure(
+            "27820001001", timezone.now() + timedelta(hours=23)
+        )
+        self.assertIsNone(count)
+
+        count = DeliveryFailure.objects.record_failure(
+            "27820001001", timezone.now() + timedelta(days=1, minutes=1)
+        )
+        self.assertEqual(count, 3)
+        df = DeliveryFailure.objects.get(contact_id="27820001001")
+        self.assertEqual(df.number_of_failures, 3)
+
+    def test_record_failure_forgets_zero(self):
+        """
+        Should forget that the contact is at 0 failures, even if the failure wasn't
+        counted
+        """
+        redis = get_redis_connection("redis")
+        redis.set("delivery_failure_zero:27820001001", 1)
+        DeliveryFailure.objects.record_failure("27820001001", timezone.now())
+        self.assertIsNone(redis.get("delivery_failure_zero:27820001001"))
+
+        redis.set("delivery_failure_zero:27820001001", 1)
+        self.assertIsNone(
+            DeliveryFailure.objects.record_failure("27820001001", timezone.now())
+        )
+        self.assertIsNone(redis.get("delivery_failure_zero:27820001001"))
+
+    def test_record_failure_after_reset(self):
+        """
+        Shouldn't count failures within a day of the last reset, even if the reset
+        was only recorded in the contact's marker
+        """
+        redis = get_redis_connection("redis")
+        self.addCleanup(redis.delete, "delivery_failure_zero:27820001001")
+        DeliveryFailure.objects.create(contact_id="27820001001", number_of_failures=2)
+        DeliveryFailure.objects.update(timestamp=timezone.now() - timedelta(days=2))
+
+        redis.set("delivery_failure_zero:27820001001", timezone.now().timestamp())
+        self.assertIsNone(
+            DeliveryFailure.objects.record_failure("27820001001", timezone.now())
+        )
+
+        count = DeliveryFailure.objects.record_failure("27820001001", timezone.now())
+        self.assertEqual(count, 3)
+
+    def test_reset_failures(self):
+        """
+        Should reset the existing contacts and create the missing ones, with a
+        single query
+        """
+        DeliveryFailure.objects.create(contact_id="27820001001", number_of_failures=2)
+        timestamp = timezone.now()
+        with self.assertNumQueries(1):
+            DeliveryFailure.objects.reset_failures(
+                ["27820001001", "27820001002"], timestamp
+            )
+        self.assertEqual(
+            sorted(
+                DeliveryFailure.objects.values_list(
+                    "contact_id", "number_of_failures", "timestamp"
+                )
+            ),
+            [("27820001001", 0, timestamp), ("27820001002", 0, timestamp)],
+        )
+
+
+class ConcurrentUpsertTests(TransactionTestCase):
+    """
+    Each thread gets its own database connection, so these can't run inside the
+    test case's transaction
+    """
+
+    def run_concurrently(self, func, count):
+        def run(i):
+            try:
+                return func(i)
+            finally:
+                connections.close_all()
+
+        with ThreadPoolExecutor(8) as pool:
+            return list(pool.map(run, range(count)))
+
+    def test_record_failure_concurrent(self):
+        """
+        Every concurrent failure should be counted, and each caller should get a
+        different count
+        """
+        timestamp = timezone.now() + timedelta(days=2)
+        counts = self.run_concurrently(
+            lambda i: DeliveryFailure.objects.record_failure("27820001001", timestamp),
+            20,
+        )
+        self.assertEqual(sorted(counts), list(range(1, 21)))
+        df = DeliveryFailure.objects.get(contact_id="27820001001")
+        self.assertEqual(df.number_of_failures, 20)
+
+    def test_bulk_upsert_concurrent(self):
+        """
+        Concurrently upserting the same messages should not raise integrity errors,
+        and each message should only be created once
+        """
+        results = self.run_concurrently(
+            lambda i: Message.objects.bulk_upsert(
+                [
+                    Message(
+                        id=f"message-{j}",
+                        contact_id="27820001001",
+                        message_direction=Message.INBOUND,
+                        data={"thread": i},
+                    )
+                    for j in range(10)
+                ]
+            ),
+            20,
+        )
+        created = [msg.id for result in results for msg, c in result if c]
+        self.assertEqual(sorted(created), sorted(f"message-{j}" for j in range(10)))
+        self.assertEqual(Message.objects.count(), 10)
+
 
 class EventTests(TestCase):
     def test_is_hsm_error(self):
@@ -99,6 +341,86 @@ class EventTests(TestCase):
         self.assertFalse(event.is_whatsapp_failed_delivery_event)
 
 
+class AddMonthsTests(TestCase):
+    def test_add_months(self):
+        """
+        Should return the start of the month, the given number of months later
+        """
+        timestamp = datetime(2020, 12, 15, 10, 30, tzinfo=timezone.utc)
+        self.assertEqual(
+            add_months(timestamp, 0), datetime(2020, 12, 1, tzinfo=timezone.utc)
+        )
+        self.assertEqual(
+            add_months(timestamp, 1), datetime(2021, 1, 1, tzinfo=timezone.utc)
+        )
+        self.assertEqual(
+            add_months(timestamp, -12), datetime(2019, 12, 1, tzinfo=timezone.utc)
+        )
+
+
+class EventPartitionTests(TestCase):
+    def get_partition(self, event):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT tableoid::regclass::text FROM eventstore_event WHERE id = %s",
+                [event.id],
+            )
+            [(partition,)] = cursor.fetchall()
+        return partition
+
+    def test_create_partitions(self):
+        """
+        Should create the monthly partitions following on from the last partition,
+        and new events should be stored in them
+        """
+        [(_, end), default] = Event.objects.get_partitions()
+        self.assertEqual(default, ("eventstore_event_default", None))
+
+        created = Event.objects.create_partitions(1, now=end)
+        self.assertEqual(
+            created,
+            [
+                f"eventstore_event_p{end:%Y_%m}",
+                f"eventstore_event_p{add_months(end, 1):%Y_%m}",
+            ],
+        )
+        self.assertEqual(Event.objects.create_partitions(1, now=end), [])
+
+        event = Event.objects.create(timestamp=end + timedelta(days=1))
+        self.assertEqual(self.get_partition(event), f"eventstore_event_p{end:%Y_%m}")
+        event = Event.objects.create(timestamp=end - timedelta(days=1))
+        self.assertEqual(self.get_partition(event), "eventstore_event_legacy")
+
+    def test_create_partitions_moves_default_events(self):
+        """
+        Should move the events for the new partitions out of the default partition
+        """
+        [(_, end), _] = Event.objects.get_partitions()
+        event = Event.objects.create(timestamp=end + timedelta(days=1))
+        later = Event.objects.create(timestamp=add_months(end, 3))
+        self.assertEqual(self.get_partition(event), "eventstore_event_default")
+
+        Event.objects.create_partitions(0, now=end)
+
+        self.assertEqual(self.get_partition(event), f"eventstore_event_p{end:%Y_%m}")
+        self.assertEqual(self.get_partition(later), "eventstore_event_default")
+        self.assertEqual(Event.objects.get(id=event.id).timestamp, event.timestamp)
+
+    def test_detach_partitions(self):
+        """
+        Should detach only the partitions that end before the given timestamp
+        """
+        [(_, end), _] = Event.objects.get_partitions()
+        Event.objects.create_partitions(1, now=end)
+        event = Event.objects.create(timestamp=end - timedelta(days=1))
+
+        detached = Event.objects.detach_partitions(add_months(end, 1))
+        self.assertEqual(
+            detached, ["eventstore_event_legacy", f"eventstore_event_p{end:%Y_%m}"]
+        )
+        self.assertFalse(Event.objects.filter(id=event.id).exists())
+
+
 class HealthCheckUserProfileTests(TestCase):
     def test_update_from_healthcheck(self):
         """
@@ -148,6 +470,7 @@ class HealthCheckUserProfileTests(TestCase):
         """
         profile = HealthCheckUserProfile.objects.get_or_prefill("+27820001001")
         self.assertEqual(profile.msisdn, "")
+        self.assertFalse(HealthCheckUserProfile.objects.exists())
 
     def test_get_or_prefill_existing_healthchecks(self):
         """
@@ -176,3 +499,63 @@ class HealthCheckUserProfileTests(TestCase):
         self.assertEqual(profile.first_name, "oldfirst")
         self.assertEqual(profile.last_name, "newlast")
         self.assertEqual(profile.preexisting_condition, "no")
+        # Should save the prefilled profile, so the history isn't replayed again
+        self.assertTrue(
+            HealthCheckUserProfile.objects.filter(msisdn="+27820001001").exists()
+        )
+
+    def test_get_cached(self):
+        """
+        Should cache the profile until it is saved, and not cache missing profiles
+        """
+        caches["locmem"].clear()
+        self.assertIsNone(HealthCheckUserProfile.objects.get_cached("+27820001001"))
+
+        profile = HealthCheckUserProfile.objects.create(
+            msisdn="+27820001001", city="old"
+        )
+        self.assertEqual(
+            HealthCheckUserProfile.objects.get_cached("+27820001001").city, "old"
+        )
+        HealthCheckUserProfile.objects.filter(msisdn="+27820001001").update(city="new")
+        self.assertEqual(
+            HealthCheckUserProfile.objects.get_cached("+27820001001").city, "old"
+        )
+        profile.city = "new"
+        profile.save()
+        self.assertEqual(
+            HealthCheckUserProfile.objects.get_cached("+27820001001").city, "new"
+        )
+
+    def test_bulk_update_from_healthchecks(self):
+        """
+        Should update existing profiles, and create new profiles prefilled from the
+        historical healthchecks
+        """
+        HealthCheckUserProfile.objects.create(msisdn="+27820001001", city="old")
+        Covid19Triage.objects.create(
+            msisdn="+27820001002",
+            first_name="oldfirst",
+            fever=False,
+            cough=False,
+            sore_throat=False,
+            tracing=True,
+        )
+        healthchecks = [
+            Covid19Triage.objects.create(
+                msisdn=msisdn,
+                city="new",
+                fever=False,
+                cough=False,
+                sore_throat=False,
+                tracing=True,
+            )
+            for msisdn in ["+27820001001", "+27820001002"]
+        ]
+        HealthCheckUserProfile.objects.bulk_update_from_healthchecks(healthchecks)
+
+        profile = HealthCheckUserProfile.objects.get(msisdn="+27820001001")
+        self.assertEqual(profile.city, "new")
+        profile = HealthCheckUserProfile.objects.get(msisdn="+27820001002")
+        self.assertEqual(profile.city, "new")
+        self.assertEqual(profile.first_name, "oldfirst")
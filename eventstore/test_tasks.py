@@ -1,11 +1,14 @@
 import datetime
 import json
+from unittest.mock import call, patch
 
 import responses
 from django.test import TestCase, override_settings
+from django_redis import get_redis_connection
 from temba_client.v2 import TembaClient
 
 from eventstore import tasks
+from eventstore.models import Event, Message, MSISDNSwitch, OptOut
 
 
 def override_get_today():
@@ -13,6 +16,13 @@ def override_get_today():
 
 
 class MarkTurnContactHealthCheckCompleteTests(TestCase):
+    def setUp(self):
+        redis = get_redis_connection("redis")
+        redis.delete(
+            "turn_healthcheck_complete:+27820001001",
+            "turn_healthcheck_complete:+27820001002",
+        )
+
     @override_settings(HC_TURN_URL=None, HC_TURN_TOKEN=None)
     @responses.activate
     def test_skips_when_no_settings(self):
@@ -37,6 +47,78 @@ class MarkTurnContactHealthCheckCompleteTests(TestCase):
         self.assertEqual(call.request.headers["Authorization"], "Bearer token")
         self.assertEqual(call.request.headers["Accept"], "application/vnd.v1+json")
 
+    @override_settings(HC_TURN_URL="https://turn", HC_TURN_TOKEN="token")
+    @responses.activate
+    def test_send_multiple(self):
+        """
+        Should send once for each unique MSISDN
+        """
+        responses.add(
+            responses.PATCH, "https://turn/v1/contacts/27820001001/profile", json={}
+        )
+        responses.add(
+            responses.PATCH, "https://turn/v1/contacts/27820001002/profile", json={}
+        )
+        tasks.mark_turn_contacts_healthcheck_complete(
+            ["+27820001001", "+27820001002", "+27820001001"]
+        )
+        self.assertEqual(len(responses.calls), 2)
+
+    @override_settings(HC_TURN_URL="https://turn", HC_TURN_TOKEN="token")
+    @responses.activate
+    def test_send_multiple_retry(self):
+        """
+        Retries should only send for the MSISDNs that weren't sent yet
+        """
+        self.addCleanup(
+            get_redis_connection("redis").delete,
+            "turn_healthcheck_complete_batch:test-task",
+        )
+        responses.add(
+            responses.PATCH, "https://turn/v1/contacts/27820001001/profile", json={}
+        )
+        responses.add(
+            responses.PATCH, "https://turn/v1/contacts/27820001002/profile", status=500
+        )
+        responses.add(
+            responses.PATCH, "https://turn/v1/contacts/27820001002/profile", json={}
+        )
+        tasks.mark_turn_contacts_healthcheck_complete.apply(
+            args=[["+27820001001", "+27820001002"]], task_id="test-task"
+        )
+        self.assertEqual(
+            [c.request.url for c in responses.calls],
+            [
+                "https://turn/v1/contacts/27820001001/profile",
+                "https://turn/v1/contacts/27820001002/profile",
+                "https://turn/v1/contacts/27820001002/profile",
+            ],
+        )
+
+    @override_settings(
+        HC_TURN_URL="https://turn",
+        HC_TURN_TOKEN="token",
+        HC_TURN_COMPLETE_DEDUPLICATION_WINDOW=60,
+    )
+    @responses.activate
+    def test_deduplication_window(self):
+        """
+        Should only send once within the deduplication window
+        """
+        responses.add(
+            responses.PATCH, "https://turn/v1/contacts/27820001001/profile", status=500
+        )
+        responses.add(
+            responses.PATCH, "https://turn/v1/contacts/27820001001/profile", json={}
+        )
+        # Failures shouldn't count towards the window
+        with self.assertRaises(Exception):
+            tasks.mark_turn_contact_healthcheck_complete("+27820001001")
+
+        tasks.mark_turn_contact_healthcheck_complete("+27820001001")
+        tasks.mark_turn_contact_healthcheck_complete("+27820001001")
+        self.assertEqual(len(responses.calls), 2)
+
 
 class HandleOldWaitingForHelpdeskContactsTests(TestCase):
     def setUp(self):
@@ -202,3 +284,129 @@ class HandleOldWaitingForHelpdeskContactsTests(TestCase):
                 }
             },
         )
+
+
+@override_settings(ENABLE_RAPIDPRO_BUFFERING=True)
+class RapidproBufferingTests(TestCase):
+    def setUp(self):
+        self.redis = get_redis_connection("redis")
+        self.addCleanup(self.clear_buffers)
+
+    def clear_buffers(self):
+        keys = self.redis.keys("rapidpro_buffered_*")
+        if keys:
+            self.redis.delete(*keys)
+
+    def test_flow_starts_are_combined(self):
+        """
+        Flow starts for the same flow with the same extra should be combined, with
+        at most 100 URNs per start
+        """
+        urns = [f"whatsapp:278200{i:05d}" for i in range(150)]
+        with patch("eventstore.tasks.rapidpro") as p:
+            for urn in urns:
+                tasks.dispatch_flow_start("flow-uuid", [urn], {"key": "value"})
+            tasks.dispatch_flow_start("flow-uuid", [urns[0]], {"key": "other"})
+            p.create_flow_start.assert_not_called()
+
+            tasks.flush_rapidpro_buffers()
+
+        self.assertCountEqual(
+            p.create_flow_start.call_args_list,
+            [
+                call(extra={"key": "value"}, flow="flow-uuid", urns=urns[:100]),
+                call(extra={"key": "value"}, flow="flow-uuid", urns=urns[100:]),
+                call(extra={"key": "other"}, flow="flow-uuid", urns=urns[:1]),
+            ],
+        )
+
+    def test_contact_updates_are_combined(self):
+        """
+        Field updates for the same contact should be combined into a single update
+        """
+        with patch("eventstore.tasks.rapidpro") as p:
+            tasks.dispatch_contact_update("whatsapp:27820001001", {"a": "1", "b": "1"})
+            tasks.dispatch_contact_update("whatsapp:27820001001", {"b": "2"})
+            tasks.dispatch_contact_update("whatsapp:27820001002", {"a": None})
+            p.update_contact.assert_not_called()
+
+            tasks.flush_rapidpro_buffers()
+            tasks.flush_rapidpro_buffers()
+
+        self.assertCountEqual(
+            p.update_contact.call_args_list,
+            [
+                call("whatsapp:27820001001", fields={"a": "1", "b": "2"}),
+                call("whatsapp:27820001002", fields={"a": None}),
+            ],
+        )
+
+    @override_settings(ENABLE_RAPIDPRO_BUFFERING=False)
+    def test_buffering_disabled(self):
+        """
+        If buffering is disabled, the requests should be sent immediately
+        """
+        with patch("eventstore.tasks.rapidpro") as p:
+            tasks.dispatch_flow_start("flow-uuid", ["whatsapp:27820001001"], {})
+            tasks.dispatch_contact_update("whatsapp:27820001001", {"a": "1"})
+
+        p.create_flow_start.assert_called_once_with(
+            extra={}, flow="flow-uuid", urns=["whatsapp:27820001001"]
+        )
+        p.update_contact.assert_called_once_with(
+            "whatsapp:27820001001", fields={"a": "1"}
+        )
+
+
+class DeleteContactPIITests(TestCase):
+    def test_delete_pii(self):
+        """
+        Should remove the PII for the contact, and replace their MSISDN on messages
+        and events with their contact UUID
+        """
+        contact_uuid = "b2f9b6e4-4f6a-4b8a-8d2b-4b5e6b0d5b0e"
+        switch = MSISDNSwitch.objects.create(
+            contact_id=contact_uuid,
+            old_msisdn="+27820001001",
+            new_msisdn="+27820001002",
+            data={"test": "data"},
+        )
+        optout = OptOut.objects.create(contact_id=contact_uuid, data={"test": "data"})
+        message = Message.objects.create(
+            id="message-id", contact_id="27820001001", data={"text": "hi"}
+        )
+        event = Event.objects.create(
+            message_id="message-id", recipient_id="27820001001"
+        )
+
+        tasks.delete_contact_pii(
+            {"uuid": contact_uuid, "urns": ["whatsapp:27820001001"]}
+        )
+
+        switch.refresh_from_db()
+        self.assertEqual((switch.old_msisdn, switch.new_msisdn), ("", ""))
+        self.assertEqual(switch.data, {})
+        optout.refresh_from_db()
+        self.assertEqual(optout.data, {})
+        message.refresh_from_db()
+        self.assertEqual(message.contact_id, contact_uuid)
+        self.assertEqual(message.data, {})
+        event.refresh_from_db()
+        self.assertEqual(event.recipient_id, contact_uuid)
+
+    def test_no_urn(self):
+        """
+        Should still remove the PII on the contact's events if they have no URN
+        """
+        contact_uuid = "b2f9b6e4-4f6a-4b8a-8d2b-4b5e6b0d5b0e"
+        optout = OptOut.objects.create(contact_id=contact_uuid, data={"test": "data"})
+        message = Message.objects.create(id="message-id", contact_id="")
+
+        self.assertEqual(
+            tasks.delete_contact_pii({"uuid": contact_uuid, "urns": []}), contact_uuid
+        )
+
+        optout.refresh_from_db()
+        self.assertEqual(optout.data, {})
+        message.refresh_from_db()
+        self.assertEqual(message.contact_id, "")
@@ -9,8 +9,10 @@ from urllib.parse import urlencode
 import responses
 from django.contrib.auth import get_user_model
 from django.contrib.auth.models import Permission
+from django.core.cache import caches
 from django.test import override_settings
 from django.urls import reverse
+from django_redis import get_redis_connection
 from pytz import UTC
 from rest_framework import status
 from rest_framework.authtoken.models import Token
@@ -48,6 +50,7 @@ from eventstore.serializers import (
     Covid19TriageV2Serializer,
     Covid19TriageV3Serializer,
 )
+from eventstore.webhook_queue import WebhookQueue
 
 
 class BaseEventTestCase(object):
@@ -1457,6 +1460,133 @@ class MessagesViewSetTests(APITestCase):
 
         mock_handle_event.assert_called_with(event)
 
+    @mock.patch("eventstore.views.handle_inbound")
+    @override_settings(ENABLE_EVENTSTORE_WHATSAPP_ACTIONS=True)
+    def test_inbound_request_calls_handle_inbound_for_new_messages(
+        self, mock_handle_inbound
+    ):
+        """
+        Should call handle_inbound only for the messages that didn't exist yet
+        """
+        Message.objects.create(
+            id="existing-id",
+            contact_id="27820001001",
+            message_direction=Message.INBOUND,
+        )
+        user = get_user_model().objects.create_user("test")
+        user.user_permissions.add(Permission.objects.get(codename="add_message"))
+        self.client.force_authenticate(user)
+        data = {
+            "messages": [
+                {
+                    "id": message_id,
+                    "from": "27820001001",
+                    "timestamp": "1518694700",
+                    "type": "text",
+                    "text": {"body": "hi"},
+                }
+                for message_id in ["existing-id", "new-id"]
+            ]
+        }
+        response = self.client.post(
+            self.url,
+            data,
+            format="json",
+            HTTP_X_TURN_HOOK_SIGNATURE=self.generate_hmac_signature(data, "REPLACEME"),
+            HTTP_X_TURN_HOOK_SUBSCRIPTION="whatsapp",
+        )
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(Message.objects.count(), 2)
+        [(message,), _] = mock_handle_inbound.call_args
+        self.assertEqual(message.id, "new-id")
+        mock_handle_inbound.assert_called_once()
+
+    @mock.patch("eventstore.views.handle_event")
+    @override_settings(ENABLE_EVENTSTORE_WHATSAPP_ACTIONS=True)
+    def test_multiple_events_request(self, mock_handle_event):
+        """
+        Should store all the events in the request, and call handle_event for each
+        """
+        user = get_user_model().objects.create_user("test")
+        user.user_permissions.add(Permission.objects.get(codename="add_message"))
+        self.client.force_authenticate(user)
+        data = {
+            "statuses": [
+                {
+                    "id": "ABGGFlA5FpafAgo6tHcNmNjXmuSf",
+                    "recipient_id": "16315555555",
+                    "status": message_status,
+                    "timestamp": "1518694700",
+                }
+                for message_status in ["sent", "delivered", "read"]
+            ]
+        }
+        response = self.client.post(
+            self.url,
+            data,
+            format="json",
+            HTTP_X_TURN_HOOK_SIGNATURE=self.generate_hmac_signature(data, "REPLACEME"),
+            HTTP_X_TURN_HOOK_SUBSCRIPTION="whatsapp",
+        )
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(
+            sorted(Event.objects.values_list("status", flat=True)),
+            ["delivered", "read", "sent"],
+        )
+        self.assertEqual(mock_handle_event.call_count, 3)
+
+    @override_settings(
+        ENABLE_EVENTSTORE_WEBHOOK_QUEUE=True,
+        EVENTSTORE_WEBHOOK_QUEUE_STREAM="test_eventstore_webhooks",
+    )
+    def test_queued_request(self):
+        """
+        If the webhook queue is enabled, the webhook should be added to the queue
+        instead of being stored
+        """
+        self.addCleanup(
+            get_redis_connection("redis").delete, "test_eventstore_webhooks"
+        )
+        user = get_user_model().objects.create_user("test")
+        user.user_permissions.add(Permission.objects.get(codename="add_message"))
+        self.client.force_authenticate(user)
+        data = {
+            "statuses": [
+                {
+                    "id": "ABGGFlA5FpafAgo6tHcNmNjXmuSf",
+                    "recipient_id": "16315555555",
+                    "status": "read",
+                    "timestamp": "1518694700",
+                }
+            ]
+        }
+        response = self.client.post(
+            self.url,
+            data,
+            format="json",
+            HTTP_X_TURN_HOOK_SIGNATURE=self.generate_hmac_signature(data, "REPLACEME"),
+            HTTP_X_TURN_HOOK_SUBSCRIPTION="whatsapp",
+            HTTP_X_TURN_FALLBACK_CHANNEL="1",
+        )
+
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        self.assertFalse(Event.objects.exists())
+        queue = WebhookQueue()
+        queue.create_group()
+        [(_, webhook)] = queue.read("test", 10)
+        self.assertEqual(
+            webhook,
+            {
+                "type": WebhookQueue.WHATSAPP,
+                "data": data,
+                "created_by": "test",
+                "fallback_channel": True,
+                "message_id": "",
+            },
+        )
+
     def test_signature_required(self):
         """
         Should see if the signature hook is given,
@@ -1576,6 +1706,9 @@ class CHWRegistrationViewSetTests(APITestCase, BaseEventTestCase):
 class Covid19TriageViewSetTests(APITestCase, BaseEventTestCase):
     url = reverse("covid19triage-list")
 
+    def setUp(self):
+        caches["locmem"].clear()
+
     def test_data_validation(self):
         """
         The supplied data must be validated, and any errors returned
@@ -1661,6 +1794,105 @@ class Covid19TriageViewSetTests(APITestCase, BaseEventTestCase):
         response = self.client.post(self.url, data, format="json")
         self.assertEqual(response.status_code, status.HTTP_200_OK)
 
+    @mock.patch("eventstore.views.mark_turn_contacts_healthcheck_complete")
+    def test_bulk_create(self, task):
+        """
+        Should create all the triages that we don't have yet, update the profiles,
+        and mark the healthchecks as complete in a single task
+        """
+        user = get_user_model().objects.create_user("test")
+        user.user_permissions.add(Permission.objects.get(codename="add_covid19triage"))
+        self.client.force_authenticate(user)
+        data = {
+            "msisdn": "27820001001",
+            "source": "USSD",
+            "province": "ZA-WC",
+            "city": "cape town",
+            "age": Covid19Triage.AGE_18T40,
+            "fever": False,
+            "cough": False,
+            "sore_throat": False,
+            "exposure": Covid19Triage.EXPOSURE_NO,
+            "tracing": True,
+            "risk": Covid19Triage.RISK_LOW,
+        }
+        response = self.client.post(
+            self.url, {**data, "deduplication_id": "existing"}, format="json"
+        )
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        task.reset_mock()
+
+        response = self.client.post(
+            f"{self.url}bulk/",
+            [
+                {**data, "deduplication_id": "existing"},
+                {**data, "deduplication_id": "new", "city": "sandton"},
+                {**data, "deduplication_id": "new"},
+                {**data, "msisdn": "27820001002"},
+            ],
+            format="json",
+        )
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(len(response.data), 2)
+        self.assertEqual(Covid19Triage.objects.count(), 3)
+        self.assertEqual(
+            Covid19Triage.objects.get(deduplication_id="new").created_by, "test"
+        )
+        profile = HealthCheckUserProfile.objects.get(msisdn="+27820001001")
+        self.assertEqual(profile.city, "sandton")
+        self.assertTrue(
+            HealthCheckUserProfile.objects.filter(msisdn="+27820001002").exists()
+        )
+        task.delay.assert_called_once_with(["+27820001001", "+27820001002"])
+
+    @override_settings(HC_TURN_COMPLETE_BATCH_SIZE=2)
+    @mock.patch("eventstore.views.mark_turn_contacts_healthcheck_complete")
+    def test_bulk_create_batches(self, task):
+        """
+        Should split the healthchecks into batches to mark as complete
+        """
+        user = get_user_model().objects.create_user("test")
+        user.user_permissions.add(Permission.objects.get(codename="add_covid19triage"))
+        self.client.force_authenticate(user)
+        data = {
+            "source": "USSD",
+            "province": "ZA-WC",
+            "city": "cape town",
+            "age": Covid19Triage.AGE_18T40,
+            "fever": False,
+            "cough": False,
+            "sore_throat": False,
+            "exposure": Covid19Triage.EXPOSURE_NO,
+            "tracing": True,
+            "risk": Covid19Triage.RISK_LOW,
+        }
+        response = self.client.post(
+            f"{self.url}bulk/",
+            [{**data, "msisdn": f"2782000100{i}"} for i in range(1, 4)],
+            format="json",
+        )
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        task.delay.assert_has_calls(
+            [mock.call(["+27820001001", "+27820001002"]), mock.call(["+27820001003"])]
+        )
+        self.assertEqual(task.delay.call_count, 2)
+
+    def test_bulk_create_invalid(self):
+        """
+        Should not create anything if any of the triages are invalid
+        """
+        user = get_user_model().objects.create_user("test")
+        user.user_permissions.add(Permission.objects.get(codename="add_covid19triage"))
+        self.client.force_authenticate(user)
+        response = self.client.post(f"{self.url}bulk/", {}, format="json")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        response = self.client.post(
+            f"{self.url}bulk/", [{"msisdn": "27820001001"}], format="json"
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertFalse(Covid19Triage.objects.exists())
+
     def test_invalid_location_request(self):
         """
         Should create a new Covid19Triage object in the database
@@ -1935,7 +2167,7 @@ class Covid19TriageV2ViewSetTests(Covid19TriageViewSetTests):
     def test_returning_user(self):
         """
         Should create a new Covid19Triage object in the database using information
-        from the first entry in the database
+        from the user's profile
         """
         user = get_user_model().objects.create_user("test")
         user.user_permissions.add(Permission.objects.get(codename="add_covid19triage"))
@@ -1977,8 +2209,34 @@ class Covid19TriageV2ViewSetTests(Covid19TriageViewSetTests):
         self.assertEqual(response.status_code, status.HTTP_201_CREATED)
         triage_id = response.data["id"]
         covid19triage = Covid19Triage.objects.get(id=triage_id)
-        self.assertEqual(covid19triage.province, "ZA-WC")
-        self.assertEqual(covid19triage.city, "cape town")
+        self.assertEqual(covid19triage.province, "ZA-GT")
+        self.assertEqual(covid19triage.city, "sandton")
+
+    def test_returning_user_no_profile(self):
+        """
+        If there's no profile to fill the missing fields from, should return the
+        validation errors
+        """
+        user = get_user_model().objects.create_user("test")
+        user.user_permissions.add(Permission.objects.get(codename="add_covid19triage"))
+        self.client.force_authenticate(user)
+        response = self.client.post(
+            self.url,
+            {
+                "msisdn": "27820001001",
+                "source": "USSD",
+                "age": Covid19Triage.AGE_18T40,
+                "fever": False,
+                "cough": False,
+                "sore_throat": False,
+                "exposure": Covid19Triage.EXPOSURE_NO,
+                "tracing": True,
+                "risk": Covid19Triage.RISK_LOW,
+            },
+            format="json",
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn("province", response.data)
 
 
 class Covid19TriageV3ViewSetTests(Covid19TriageViewSetTests):
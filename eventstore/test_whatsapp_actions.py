@@ -14,7 +14,9 @@ from temba_client.v2 import TembaClient
 
 from eventstore import tasks
 from eventstore.models import DeliveryFailure, Event
+from eventstore.tasks import coalesce_rapidpro_contact_update
 from eventstore.whatsapp_actions import (
+    batch_delivery_failure_resets,
     handle_edd_message,
     handle_event,
     handle_fallback_event,
@@ -23,6 +25,7 @@ from eventstore.whatsapp_actions import (
     handle_outbound,
     handle_whatsapp_delivery_error,
     handle_whatsapp_hsm_error,
+    reset_delivery_failures,
     update_rapidpro_preferred_channel,
 )
 from registrations.models import JembiSubmission
@@ -177,6 +180,15 @@ class HandleInboundTests(DjangoTestCase):
 
 
 class UpdateRapidproPreferredChannelTests(DjangoTestCase):
+    def setUp(self):
+        self.redis = get_redis_connection("redis")
+        self.redis.delete(
+            "rapidpro_contact_field:whatsapp:27820001001:preferred_channel",
+            "rapidpro_contact_field:whatsapp:27820001001:wait_for_helpdesk",
+            "rapidpro_contact_pending:whatsapp:27820001001",
+            "rapidpro_contact_debounce:whatsapp:27820001001",
+        )
+
     def test_contact_update_is_called(self):
         """
         Updates the rapidpro contact with the correct info
@@ -193,6 +205,65 @@ class UpdateRapidproPreferredChannelTests(DjangoTestCase):
             "whatsapp:27820001001", fields={"preferred_channel": "WhatsApp"}
         )
 
+    def test_repeated_update_is_skipped(self):
+        """
+        If we've recently set the preferred channel to WhatsApp, we shouldn't set
+        it again
+        """
+        message = Mock()
+        message.contact_id = "27820001001"
+
+        with patch("eventstore.tasks.rapidpro") as p:
+            update_rapidpro_preferred_channel(message)
+            update_rapidpro_preferred_channel(message)
+
+        p.update_contact.assert_called_once_with(
+            "whatsapp:27820001001", fields={"preferred_channel": "WhatsApp"}
+        )
+
+    @override_settings(ENABLE_UNSENT_EVENT_ACTION=True)
+    def test_update_after_flow_start_is_not_skipped(self):
+        """
+        Flows can change the preferred channel, so starting one should forget the
+        value that we last set
+        """
+        message = Mock()
+        message.contact_id = "27820001001"
+        event = Mock()
+        event.recipient_id = "27820001001"
+        event.timestamp = timezone.now()
+
+        with patch("eventstore.tasks.rapidpro") as p:
+            update_rapidpro_preferred_channel(message)
+            handle_whatsapp_hsm_error(event)
+            update_rapidpro_preferred_channel(message)
+
+        self.assertEqual(p.update_contact.call_count, 2)
+
+    def test_updates_are_merged(self):
+        """
+        Updates for the same contact within the debounce window should be merged
+        into a single update
+        """
+        with patch("eventstore.tasks.flush_rapidpro_contact_update") as flush:
+            coalesce_rapidpro_contact_update(
+                "whatsapp:27820001001", {"preferred_channel": "WhatsApp"}
+            )
+            coalesce_rapidpro_contact_update(
+                "whatsapp:27820001001", {"wait_for_helpdesk": ""}
+            )
+        flush.apply_async.assert_called_once_with(
+            ("whatsapp:27820001001",), countdown=10
+        )
+
+        with patch("eventstore.tasks.rapidpro") as p:
+            tasks.flush_rapidpro_contact_update("whatsapp:27820001001")
+
+        p.update_contact.assert_called_once_with(
+            "whatsapp:27820001001",
+            fields={"preferred_channel": "WhatsApp", "wait_for_helpdesk": ""},
+        )
+
 
 class HandleEddLabelTests(DjangoTestCase):
     @override_settings(RAPIDPRO_EDD_LABEL_FLOW="test-flow-uuid")
@@ -212,6 +283,9 @@ class HandleEddLabelTests(DjangoTestCase):
 
 
 class HandleEventTests(DjangoTestCase):
+    def setUp(self):
+        get_redis_connection("redis").delete("delivery_failure_zero:27820001001")
+
     def test_expired_message(self):
         """
         If the event is an message expired error, then it should trigger the
@@ -422,6 +496,117 @@ class HandleEventTests(DjangoTestCase):
         df = DeliveryFailure.objects.get(contact_id="27820001001")
         self.assertEqual(df.number_of_failures, 0)
 
+    def test_fallback_channel_successful_known_zero(self):
+        """
+        If we've recently reset the delivery failures for the contact, then we
+        shouldn't reset them again, until there's another failure
+        """
+        event = Event(
+            fallback_channel=True,
+            status=Event.DELIVERED,
+            recipient_id="27820001001",
+            timestamp=timezone.now(),
+        )
+        handle_fallback_event(event)
+
+        with self.assertNumQueries(0):
+            handle_fallback_event(event)
+
+        failed_event = Event(
+            fallback_channel=True,
+            status=Event.FAILED,
+            recipient_id="27820001001",
+            timestamp=timezone.now(),
+        )
+        handle_fallback_event(failed_event)
+        handle_fallback_event(event)
+
+        df = DeliveryFailure.objects.get(contact_id="27820001001")
+        self.assertEqual(df.number_of_failures, 0)
+
+    def test_fallback_channel_failure_after_successful(self):
+        """
+        Failures within a day of a successful delivery shouldn't be counted, even
+        if the successful delivery was skipped because the contact was known to be
+        at 0 failures
+        """
+        delivered = Event(
+            fallback_channel=True,
+            status=Event.DELIVERED,
+            recipient_id="27820001001",
+            timestamp=timezone.now(),
+        )
+        handle_fallback_event(delivered)
+        DeliveryFailure.objects.update(timestamp=timezone.now() - timedelta(days=2))
+        handle_fallback_event(delivered)
+
+        handle_fallback_event(
+            Event(
+                fallback_channel=True,
+                status=Event.FAILED,
+                recipient_id="27820001001",
+                timestamp=timezone.now() + timedelta(hours=23),
+            )
+        )
+        df = DeliveryFailure.objects.get(contact_id="27820001001")
+        self.assertEqual(df.number_of_failures, 0)
+
+    def test_fallback_channel_failure_during_reset(self):
+        """
+        If a failure is recorded while the failures are being reset, then the
+        contact shouldn't be marked as being at 0 failures
+        """
+        reset_failures = DeliveryFailure.objects.reset_failures
+
+        def reset_then_fail(contact_ids, timestamp):
+            reset_failures(contact_ids, timestamp)
+            DeliveryFailure.objects.record_failure(
+                "27820001001", timestamp + timedelta(days=2)
+            )
+
+        with patch.object(
+            DeliveryFailure.objects, "reset_failures", side_effect=reset_then_fail
+        ):
+            reset_delivery_failures(["27820001001"])
+
+        self.assertIsNone(
+            get_redis_connection("redis").get("delivery_failure_zero:27820001001")
+        )
+        df = DeliveryFailure.objects.get(contact_id="27820001001")
+        self.assertEqual(df.number_of_failures, 1)
+
+    def test_batched_fallback_channel_resets(self):
+        """
+        Resets within a batch should be done together at the end of the batch, but
+        keep their order relative to failures for the same contact
+        """
+        DeliveryFailure.objects.create(contact_id="27820001001", number_of_failures=2)
+        DeliveryFailure.objects.create(contact_id="27820001002", number_of_failures=2)
+        get_redis_connection("redis").delete("delivery_failure_zero:27820001002")
+        timestamp = timezone.now() + timedelta(days=2)
+
+        with batch_delivery_failure_resets():
+            for recipient_id, status in [
+                ("27820001001", Event.READ),
+                ("27820001002", Event.DELIVERED),
+                ("27820001001", Event.FAILED),
+            ]:
+                handle_fallback_event(
+                    Event(
+                        fallback_channel=True,
+                        status=status,
+                        recipient_id=recipient_id,
+                        timestamp=timestamp,
+                    )
+                )
+            df = DeliveryFailure.objects.get(contact_id="27820001002")
+            self.assertEqual(df.number_of_failures, 2)
+
+        df = DeliveryFailure.objects.get(contact_id="27820001001")
+        self.assertEqual(df.number_of_failures, 1)
+        df = DeliveryFailure.objects.get(contact_id="27820001002")
+        self.assertEqual(df.number_of_failures, 0)
+
     def test_hsm_error(self):
         """
         If the event is an HSM error, then it should trigger the HSM error
@@ -1,12 +1,13 @@
 from datetime import datetime
 
 from django.conf import settings
-from django.db import IntegrityError
+from django.db import IntegrityError, transaction
 from django.http import Http404
 from django_filters import rest_framework as filters
 from pytz import UTC
 from rest_framework import serializers, status
 from rest_framework.authentication import TokenAuthentication
+from rest_framework.decorators import action
 from rest_framework.mixins import CreateModelMixin, ListModelMixin, RetrieveModelMixin
 from rest_framework.permissions import DjangoModelPermissions
 from rest_framework.response import Response
@@ -62,9 +63,16 @@ from eventstore.serializers import (
 from eventstore.tasks import (
     forget_contact,
     mark_turn_contact_healthcheck_complete,
+    mark_turn_contacts_healthcheck_complete,
     reset_delivery_failure,
 )
-from eventstore.whatsapp_actions import handle_event, handle_inbound, handle_outbound
+from eventstore.webhook_queue import WebhookQueue
+from eventstore.whatsapp_actions import (
+    batch_delivery_failure_resets,
+    handle_event,
+    handle_inbound,
+    handle_outbound,
+)
 from ndoh_hub.utils import TokenAuthQueryString, validate_signature
 from registrations.views import CursorPaginationFactory
 
@@ -82,6 +90,126 @@ class DjangoViewModelPermissions(DjangoModelPermissions):
     }
 
 
+def parse_whatsapp_webhook(data, created_by, fallback_channel):
+    """
+    Parses a WhatsApp webhook body into unsaved Message and Event objects
+    """
+    messages = []
+    for inbound in data.get("messages", []):
+        id = inbound.pop("id")
+        contact_id = inbound.pop("from")
+        type = inbound.pop("type")
+        timestamp = datetime.fromtimestamp(int(inbound.pop("timestamp")), tz=UTC)
+        messages.append(
+            Message(
+                id=id,
+                contact_id=contact_id,
+                type=type,
+                data=inbound,
+                message_direction=Message.INBOUND,
+                created_by=created_by,
+                timestamp=timestamp,
+                fallback_channel=fallback_channel,
+            )
+        )
+
+    events = []
+    for statuses in data.get("statuses", []):
+        message_id = statuses.pop("id")
+        recipient_id = statuses.pop("recipient_id")
+        timestamp = datetime.fromtimestamp(int(statuses.pop("timestamp")), tz=UTC)
+        message_status = statuses.pop("status")
+        events.append(
+            Event(
+                message_id=message_id,
+                recipient_id=recipient_id,
+                timestamp=timestamp,
+                status=message_status,
+                created_by=created_by,
+                data=statuses,
+                fallback_channel=fallback_channel,
+            )
+        )
+
+    return messages, events
+
+
+def save_messages_and_events(messages, events):
+    """
+    Writes the inbound messages and events to the database, without triggering their
+    actions. Returns the (message, created) tuples and the events.
+    """
+    # Write everything in one query per table, instead of one or more queries per
+    # item, since large status webhooks are common
+    with transaction.atomic():
+        messages = Message.objects.bulk_upsert(messages)
+        events = Event.objects.bulk_create(events)
+    return messages, events
+
+
+def handle_messages_and_events(messages, events, on_error=None):
+    """
+    Triggers the actions for the saved inbound messages and events. If `on_error` is
+    given, it is called with each action's exception instead of raising it, so that
+    one failure doesn't stop the rest of the actions.
+    """
+    if not settings.ENABLE_EVENTSTORE_WHATSAPP_ACTIONS:
+        return
+
+    def run(action, item):
+        if on_error is None:
+            return action(item)
+        try:
+            action(item)
+        except Exception as e:
+            on_error(e)
+
+    for msg, created in messages:
+        if created:
+            run(handle_inbound, msg)
+    with batch_delivery_failure_resets():
+        for event in events:
+            run(handle_event, event)
+
+
+def store_messages_and_events(messages, events):
+    """
+    Stores the inbound messages and events, and triggers their actions
+    """
+    handle_messages_and_events(*save_messages_and_events(messages, events))
+
+
+def save_turn_outbound(outbound, message_id, created_by, fallback_channel):
+    """
+    Writes the outbound message from a Turn webhook body to the database, without
+    triggering its actions. Returns a (message, created) tuple.
+    """
+    contact_id = outbound.pop("to")
+    type = outbound.pop("type", "")
+    return Message.objects.update_or_create(
+        id=message_id,
+        defaults={
+            "contact_id": contact_id,
+            "type": type,
+            "data": outbound,
+            "message_direction": Message.OUTBOUND,
+            "created_by": created_by,
+            "fallback_channel": fallback_channel,
+        },
+    )
+
+
+def store_turn_outbound(outbound, message_id, created_by, fallback_channel):
+    """
+    Stores the outbound message from a Turn webhook body, and triggers its actions
+    """
+    msg, created = save_turn_outbound(
+        outbound, message_id, created_by, fallback_channel
+    )
+    if settings.ENABLE_EVENTSTORE_WHATSAPP_ACTIONS and created:
+        handle_outbound(msg)
+
+
 class MessagesViewSet(GenericViewSet):
     """
     Receives webhooks in the [format specified by Turn][format] and stores them.
@@ -91,6 +219,9 @@ class MessagesViewSet(GenericViewSet):
     Requires authentication token, either in the `Authorization` header, or in the
     value of the `token` query string.
 
+    If the webhook queue is enabled, the webhooks are validated and queued, a
+    `202 Accepted` is returned, and the `flush_webhook_queue` command stores them.
+
     [format]: https://whatsapp.praekelt.org/docs/index.html#webhooks
     """
 
@@ -111,57 +242,14 @@ class MessagesViewSet(GenericViewSet):
 
         on_fallback_channel = request.headers.get("X-Turn-Fallback-Channel", "0") == "1"
         is_turn_event = request.headers.get("X-Turn-Event", "0") == "1"
+        message_id = ""
 
         if webhook_type == "whatsapp" or is_turn_event:
+            webhook_type = WebhookQueue.WHATSAPP
             WhatsAppWebhookSerializer(data=request.data).is_valid(raise_exception=True)
-            for inbound in request.data.get("messages", []):
-                id = inbound.pop("id")
-                contact_id = inbound.pop("from")
-                type = inbound.pop("type")
-                timestamp = datetime.fromtimestamp(
-                    int(inbound.pop("timestamp")), tz=UTC
-                )
-
-                msg, created = Message.objects.update_or_create(
-                    id=id,
-                    defaults={
-                        "contact_id": contact_id,
-                        "type": type,
-                        "data": inbound,
-                        "message_direction": Message.INBOUND,
-                        "created_by": request.user.username,
-                        "timestamp": timestamp,
-                        "fallback_channel": on_fallback_channel,
-                    },
-                )
-                if settings.ENABLE_EVENTSTORE_WHATSAPP_ACTIONS and created:
-                    handle_inbound(msg)
-
-            for statuses in request.data.get("statuses", []):
-                message_id = statuses.pop("id")
-                recipient_id = statuses.pop("recipient_id")
-                timestamp = datetime.fromtimestamp(
-                    int(statuses.pop("timestamp")), tz=UTC
-                )
-                message_status = statuses.pop("status")
-                event = Event.objects.create(
-                    message_id=message_id,
-                    recipient_id=recipient_id,
-                    timestamp=timestamp,
-                    status=message_status,
-                    created_by=request.user.username,
-                    data=statuses,
-                    fallback_channel=on_fallback_channel,
-                )
-
-                if settings.ENABLE_EVENTSTORE_WHATSAPP_ACTIONS:
-                    handle_event(event)
-
         elif webhook_type == "turn":
+            webhook_type = WebhookQueue.TURN
             TurnOutboundSerializer(data=request.data).is_valid(raise_exception=True)
-            outbound = request.data
-            contact_id = outbound.pop("to")
-            type = outbound.pop("type", "")
             try:
                 message_id = request.headers["X-WhatsApp-Id"]
             except KeyError:
@@ -169,20 +257,6 @@ class MessagesViewSet(GenericViewSet):
                     {"X-WhatsApp-Id": ["This header is required."]},
                     status.HTTP_400_BAD_REQUEST,
                 )
-
-            msg, created = Message.objects.update_or_create(
-                id=message_id,
-                defaults={
-                    "contact_id": contact_id,
-                    "type": type,
-                    "data": outbound,
-                    "message_direction": Message.OUTBOUND,
-                    "created_by": request.user.username,
-                    "fallback_channel": on_fallback_channel,
-                },
-            )
-            if settings.ENABLE_EVENTSTORE_WHATSAPP_ACTIONS and created:
-                handle_outbound(msg)
         else:
             return Response(
                 {
@@ -192,6 +266,27 @@ class MessagesViewSet(GenericViewSet):
                 },
                 status=status.HTTP_400_BAD_REQUEST,
             )
+
+        if settings.ENABLE_EVENTSTORE_WEBHOOK_QUEUE:
+            WebhookQueue().enqueue(
+                webhook_type,
+                request.data,
+                created_by=request.user.username,
+                fallback_channel=on_fallback_channel,
+                message_id=message_id,
+            )
+            return Response(status=status.HTTP_202_ACCEPTED)
+
+        if webhook_type == WebhookQueue.WHATSAPP:
+            store_messages_and_events(
+                *parse_whatsapp_webhook(
+                    request.data, request.user.username, on_fallback_channel
+                )
+            )
+        else:
+            store_turn_outbound(
+                request.data, message_id, request.user.username, on_fallback_channel
+            )
         return Response(status=status.HTTP_201_CREATED)
 
 
@@ -306,6 +401,19 @@ class Covid19TriageViewSet(GenericViewSet, CreateModelMixin, ListModelMixin):
     pagination_class = CursorPaginationFactory("timestamp")
     filter_backends = [filters.DjangoFilterBackend]
     filterset_class = Covid19TriageFilter
+    bulk_create_max_size = 1000
+
+    def _prepare_data(self, data):
+        """ Makes any changes to the data of a single triage before validation """
+        pass
+
+    def _update_dbe_profile(self, instance):
+        """ Updates the DBE on behalf of profile, if instance is for one """
+        if (
+            instance.created_by == "whatsapp_dbe_healthcheck"
+            and instance.data.get("profile") == "parent"
+        ):
+            DBEOnBehalfOfProfile.objects.update_or_create_from_healthcheck(instance)
 
     def perform_create(self, serializer):
         """
@@ -319,11 +427,7 @@ class Covid19TriageViewSet(GenericViewSet, CreateModelMixin, ListModelMixin):
         profile.update_from_healthcheck(instance)
         profile.save()
 
-        if (
-            instance.created_by == "whatsapp_dbe_healthcheck"
-            and instance.data.get("profile") == "parent"
-        ):
-            DBEOnBehalfOfProfile.objects.update_or_create_from_healthcheck(instance)
+        self._update_dbe_profile(instance)
 
         return instance
 
@@ -334,6 +438,59 @@ class Covid19TriageViewSet(GenericViewSet, CreateModelMixin, ListModelMixin):
             # We already have this entry
             return Response(status=status.HTTP_200_OK)
 
+    @action(detail=False, methods=["post"], url_path="bulk")
+    def bulk_create(self, request):
+        """
+        Creates a list of triages in a single request. Triages that we already have are
+        ignored, and the side effects are done once for the whole list
+        """
+        if not isinstance(request.data, list):
+            raise serializers.ValidationError(
+                {"non_field_errors": ["Expected a list of triages"]}
+            )
+        if len(request.data) > self.bulk_create_max_size:
+            raise serializers.ValidationError(
+                {
+                    "non_field_errors": [
+                        f"Cannot create more than {self.bulk_create_max_size} triages "
+                        "at once"
+                    ]
+                }
+            )
+        for data in request.data:
+            if isinstance(data, dict):
+                self._prepare_data(data)
+        serializer = self.get_serializer(data=request.data, many=True)
+        serializer.is_valid(raise_exception=True)
+
+        triages = {}
+        for validated_data in serializer.validated_data:
+            triage = Covid19Triage(created_by=request.user.username, **validated_data)
+            triages.setdefault(triage.deduplication_id, triage)
+
+        with transaction.atomic():
+            Covid19Triage.objects.bulk_create(triages.values(), ignore_conflicts=True)
+            # Triages with a deduplication_id that we already have don't get created
+            created_ids = set(
+                Covid19Triage.objects.filter(
+                    id__in=[t.id for t in triages.values()]
+                ).values_list("id", flat=True)
+            )
+            created = [t for t in triages.values() if t.id in created_ids]
+
+            HealthCheckUserProfile.objects.bulk_update_from_healthchecks(created)
+            for triage in created:
+                self._update_dbe_profile(triage)
+
+        msisdns = sorted({t.msisdn for t in created})
+        size = settings.HC_TURN_COMPLETE_BATCH_SIZE
+        for start in range(0, len(msisdns), size):
+            end = start + size
+            mark_turn_contacts_healthcheck_complete.delay(msisdns[start:end])
+
+        serializer = self.get_serializer(instance=created, many=True)
+        return Response(serializer.data, status=status.HTTP_201_CREATED)
+
     def get_throttles(self):
         """
         Set the throttle_scope dynamically to get different rates per action
@@ -364,21 +521,24 @@ class Covid19TriageV2ViewSet(Covid19TriageViewSet):
         serializer.is_valid(raise_exception=True)
         return serializer.validated_data["msisdn"]
 
-    def _update_data(self, data, triage):
-        """ Updates the data from the values in triage """
+    def _update_data(self, data, profile):
+        """ Updates the data from the values in profile """
         for field in self.returning_user_skipped_fields:
-            value = getattr(triage, field)
+            value = getattr(profile, field)
             if value:
                 data[field] = value
 
-    def create(self, request, *args, **kwargs):
+    def _prepare_data(self, data):
         # If all of the returning user skipped fields are missing
-        if all(not request.data.get(f) for f in self.returning_user_skipped_fields):
-            # Get those fields from a previous completed HealthCheck
-            msisdn = self._get_msisdn(request.data)
-            triage = Covid19Triage.objects.filter(msisdn=msisdn).earliest("timestamp")
-            if triage:
-                self._update_data(request.data, triage)
+        if all(not data.get(f) for f in self.returning_user_skipped_fields):
+            # Get those fields from the user's profile
+            msisdn = self._get_msisdn(data)
+            profile = HealthCheckUserProfile.objects.get_cached(msisdn)
+            if profile:
+                self._update_data(data, profile)
+
+    def create(self, request, *args, **kwargs):
+        self._prepare_data(request.data)
         return super().create(request, *args, **kwargs)
 
 
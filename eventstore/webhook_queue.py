@@ -0,0 +1,177 @@
+import json
+import time
+
+from django.conf import settings
+from django_redis import get_redis_connection
+from prometheus_client import Gauge
+from redis.exceptions import ResponseError
+
+
+class WebhookQueue(object):
+    """
+    A durable queue of received webhooks, stored in a Redis stream, so that webhooks
+    can be accepted immediately and written to the database later in batches.
+
+    Webhooks are read through a consumer group, and are only removed from the stream
+    once they are acknowledged, so a webhook that was read but not stored, eg. when
+    a consumer is killed, is read again by that consumer when it restarts, or is
+    claimed by another consumer once it has been idle for long enough.
+    """
+
+    WHATSAPP = "whatsapp"
+    TURN = "turn"
+    GROUP = "eventstore"
+
+    def __init__(self, stream=None):
+        self.redis = get_redis_connection("redis")
+        self.stream = stream or settings.EVENTSTORE_WEBHOOK_QUEUE_STREAM
+
+    @property
+    def dead_letter_stream(self):
+        return f"{self.stream}:dead"
+
+    def enqueue(self, webhook_type, data, created_by, fallback_channel, message_id=""):
+        """
+        Adds the webhook to the end of the queue
+        """
+        return self.redis.xadd(
+            self.stream,
+            {
+                "type": webhook_type,
+                "data": json.dumps(data),
+                "created_by": created_by,
+                "fallback_channel": int(fallback_channel),
+                "message_id": message_id,
+            },
+        )
+
+    def create_group(self):
+        """
+        Creates the consumer group, and the stream, if they don't exist yet
+        """
+        try:
+            self.redis.xgroup_create(self.stream, self.GROUP, id="0", mkstream=True)
+        except ResponseError as e:
+            if "BUSYGROUP" not in str(e):
+                raise
+
+    def read(self, consumer, count, block=None, pending=False):
+        """
+        Reads up to `count` webhooks for `consumer`, waiting for up to `block`
+        milliseconds for new webhooks.
+
+        If `pending` is True, instead returns the webhooks that were previously read
+        by `consumer`, but never acknowledged.
+
+        Returns a list of (id, webhook) tuples.
+        """
+        response = self.redis.xreadgroup(
+            self.GROUP,
+            consumer,
+            {self.stream: "0" if pending else ">"},
+            count=count,
+            block=None if pending else block,
+        )
+        webhooks = []
+        for _, entries in response or []:
+            webhooks.extend(self._parse(entries))
+        return webhooks
+
+    def claim_idle(self, consumer, count, min_idle_time):
+        """
+        Claims up to `count` webhooks that other consumers read, but haven't
+        acknowledged for at least `min_idle_time` milliseconds, eg. because the
+        consumer was stopped and never restarted under the same name.
+
+        Returns a list of (id, webhook) tuples, like `read`.
+        """
+        start = "-"
+        while True:
+            pending = self.redis.xpending_range(
+                self.stream, self.GROUP, start, "+", count
+            )
+            if not pending:
+                return []
+            ids = [
+                p["message_id"]
+                for p in pending
+                if p["consumer"].decode() != consumer
+                and p["time_since_delivered"] >= min_idle_time
+            ]
+            if ids:
+                entries = self.redis.xclaim(
+                    self.stream, self.GROUP, consumer, min_idle_time, ids
+                )
+                webhooks = self._parse(entries)
+                if webhooks:
+                    return webhooks
+            # Redis < 6.2 has no exclusive ranges, so start just after the last id
+            timestamp, sequence = pending[-1]["message_id"].decode().split("-")
+            start = f"{timestamp}-{int(sequence) + 1}"
+
+    def _parse(self, entries):
+        webhooks = []
+        for id, fields in entries:
+            if not fields:
+                # Entries that were deleted while still pending have no fields
+                self.ack([id])
+                continue
+            webhook = {k.decode(): v.decode() for k, v in fields.items()}
+            webhook["data"] = json.loads(webhook["data"])
+            webhook["fallback_channel"] = webhook["fallback_channel"] == "1"
+            webhooks.append((id, webhook))
+        return webhooks
+
+    def ack(self, ids):
+        """
+        Marks the webhooks as stored, and removes them from the queue
+        """
+        if not ids:
+            return
+        pipe = self.redis.pipeline()
+        pipe.xack(self.stream, self.GROUP, *ids)
+        pipe.xdel(self.stream, *ids)
+        pipe.execute()
+
+    def dead_letter(self, id, webhook):
+        """
+        Moves a webhook that cannot be stored out of the queue, so that it can be
+        inspected and replayed manually
+        """
+        self.redis.xadd(
+            self.dead_letter_stream,
+            {
+                **webhook,
+                "data": json.dumps(webhook["data"]),
+                "fallback_channel": int(webhook["fallback_channel"]),
+            },
+        )
+        self.ack([id])
+
+    def length(self):
+        """
+        The number of webhooks that haven't been stored yet
+        """
+        return self.redis.xlen(self.stream)
+
+    def lag(self):
+        """
+        The age, in seconds, of the oldest webhook that hasn't been stored yet
+        """
+        oldest = self.redis.xrange(self.stream, count=1)
+        if not oldest:
+            return 0
+        [(id, _)] = oldest
+        timestamp_ms, _ = id.decode().split("-")
+        return max(time.time() - int(timestamp_ms) / 1000, 0)
+
+
+if settings.ENABLE_EVENTSTORE_WEBHOOK_QUEUE:
+    Gauge(
+        "eventstore_webhook_queue_length",
+        "The number of queued webhooks that haven't been stored yet",
+    ).set_function(lambda: WebhookQueue().length())
+    Gauge(
+        "eventstore_webhook_queue_lag_seconds",
+        "The age of the oldest queued webhook that hasn't been stored yet",
+    ).set_function(lambda: WebhookQueue().lag())
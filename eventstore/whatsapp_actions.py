@@ -1,17 +1,28 @@
+import threading
+from contextlib import contextmanager
+
 from celery import chain
 from django.conf import settings
+from django.utils import timezone
+from django_redis import get_redis_connection
+from redis.exceptions import WatchError
 
 from changes.tasks import get_engage_inbound_and_reply
 from eventstore.models import DeliveryFailure, Event, OptOut
 from eventstore.tasks import (
-    async_create_flow_start,
     async_handle_whatsapp_delivery_error,
+    coalesce_rapidpro_contact_update,
+    dispatch_contact_update,
+    dispatch_flow_start,
+    forget_rapidpro_contact_fields,
     get_rapidpro_contact_by_msisdn,
     send_helpdesk_response_to_dhis2,
-    update_rapidpro_contact,
 )
 from ndoh_hub.utils import normalise_msisdn
 
+# Holds the state for batch_delivery_failure_resets
+_batch = threading.local()
+
 
 def handle_outbound(message):
     """
@@ -36,9 +47,7 @@ def handle_operator_message(message):
     ).delay(whatsapp_contact_id, message.id)
 
     # Clear the wait_for_helpdesk flag
-    update_rapidpro_contact.delay(
-        f"whatsapp:{msisdn.lstrip('+')}", {"wait_for_helpdesk": ""}
-    )
+    dispatch_contact_update(f"whatsapp:{msisdn.lstrip('+')}", {"wait_for_helpdesk": ""})
 
 
 def handle_inbound(message):
@@ -53,7 +62,8 @@ def handle_inbound(message):
 
 
 def update_rapidpro_preferred_channel(message):
-    update_rapidpro_contact.delay(
+    # Active users send many inbounds, and the channel is usually already WhatsApp
+    coalesce_rapidpro_contact_update(
         urn=f"whatsapp:{message.contact_id}", fields={"preferred_channel": "WhatsApp"}
     )
 
@@ -62,7 +72,7 @@ def handle_edd_message(message):
     whatsapp_contact_id = message.data["_vnd"]["v1"]["chat"]["owner"]
     # This should be in "+27xxxxxxxxx" format, but just in case it isn't
     msisdn = normalise_msisdn(whatsapp_contact_id)
-    async_create_flow_start.delay(
+    dispatch_flow_start(
         extra={},
         flow=settings.RAPIDPRO_EDD_LABEL_FLOW,
         urns=[f"whatsapp:{msisdn.lstrip('+')}"],
@@ -88,17 +98,21 @@ def handle_fallback_event(event):
         if settings.DISABLE_SMS_FAILURE_OPTOUTS:
             return
 
-        df, created = DeliveryFailure.objects.get_or_create(
-            contact_id=event.recipient_id, defaults={"number_of_failures": 0}
-        )
+        # Keep the order of a reset and failure for the same contact in one batch
+        pending_resets = getattr(_batch, "pending_resets", None)
+        if pending_resets and event.recipient_id in pending_resets:
+            pending_resets.remove(event.recipient_id)
+            reset_delivery_failures([event.recipient_id])
 
-        if not created and (event.timestamp - df.timestamp).days <= 0:
-            return
-
-        df.number_of_failures += 1
-        df.save()
-        if df.number_of_failures == 5:
-            async_create_flow_start.delay(
+        number_of_failures = DeliveryFailure.objects.record_failure(
+            event.recipient_id, event.timestamp
+        )
+        # Only one concurrent caller can get each count, so this only happens once
+        if number_of_failures == 5:
+            forget_rapidpro_contact_fields(
+                f"whatsapp:{event.recipient_id}", ["preferred_channel"]
+            )
+            dispatch_flow_start(
                 extra={
                     "optout_reason": OptOut.SMS_FAILURE_REASON,
                     "timestamp": event.timestamp.timestamp(),
@@ -111,18 +125,81 @@ def handle_fallback_event(event):
                 urns=[f"whatsapp:{event.recipient_id}"],
             )
     elif event.status == Event.READ or event.status == Event.DELIVERED:
-        df = DeliveryFailure.objects.update_or_create(
-            contact_id=event.recipient_id, defaults={"number_of_failures": 0}
-        )
+        pending_resets = getattr(_batch, "pending_resets", None)
+        if pending_resets is not None:
+            pending_resets.add(event.recipient_id)
+        else:
+            reset_delivery_failures([event.recipient_id])
+
+
+def reset_delivery_failures(contact_ids):
+    """
+    Resets the number of delivery failures for the contacts to 0, in a single query.
+
+    Almost every SMS delivery receipt causes a reset, and the number of failures is
+    usually already 0, so we remember which contacts are at 0 failures, and skip
+    them. The marker holds the time of their last reset, which `record_failure` uses
+    instead of the database timestamp, so that failures in the day after a
+    successful delivery still aren't counted.
+    """
+    contact_ids = sorted(set(contact_ids))
+    if not contact_ids:
+        return
+
+    now = timezone.now()
+    zero_keys = [f"delivery_failure_zero:{c}" for c in contact_ids]
+    with get_redis_connection("redis").pipeline() as pipe:
+        try:
+            # Recording a failure for any of these contacts changes its version, so
+            # we don't mark a contact with a new failure as being at 0 failures
+            pipe.watch(*(f"delivery_failure_version:{c}" for c in contact_ids))
+            known_zero = pipe.mget(zero_keys)
+            contact_ids = [
+                c for c, zero in zip(contact_ids, known_zero) if zero is None
+            ]
+            if contact_ids:
+                DeliveryFailure.objects.reset_failures(contact_ids, now)
+
+            pipe.multi()
+            for key in zero_keys:
+                pipe.set(
+                    key, now.timestamp(), ex=settings.DELIVERY_FAILURE_ZERO_CACHE_TTL
+                )
+            pipe.execute()
+        except WatchError:
+            # Leave the markers as they were. The contact with the new failure no
+            # longer has one, so its next reset is written to the database.
+            pass
+
+
+@contextmanager
+def batch_delivery_failure_resets():
+    """
+    Collects all the delivery failure resets from the events handled within this
+    context, and does them all together at the end
+    """
+    _batch.pending_resets = set()
+    try:
+        yield
+    finally:
+        pending_resets, _batch.pending_resets = _batch.pending_resets, None
+        reset_delivery_failures(pending_resets)
 
 
 def handle_whatsapp_delivery_error(event):
+    # The contact can reply to switch to SMS, which changes their preferred channel
+    forget_rapidpro_contact_fields(
+        f"whatsapp:{event.recipient_id}", ["preferred_channel"]
+    )
     async_handle_whatsapp_delivery_error.delay(f"whatsapp:{event.recipient_id}")
 
 
 def handle_whatsapp_hsm_error(event):
     if settings.ENABLE_UNSENT_EVENT_ACTION:
-        async_create_flow_start.delay(
+        forget_rapidpro_contact_fields(
+            f"whatsapp:{event.recipient_id}", ["preferred_channel"]
+        )
+        dispatch_flow_start(
             extra={
                 "popi_ussd": settings.POPI_USSD_CODE,
                 "optout_ussd": settings.OPTOUT_USSD_CODE,
@@ -210,6 +210,7 @@ REST_FRAMEWORK = {
     "DEFAULT_THROTTLE_CLASSES": ["rest_framework.throttling.ScopedRateThrottle"],
     "DEFAULT_THROTTLE_RATES": {
         "covid19triage.create": "30/second",
+        "covid19triage.bulk_create": "5/second",
         "covid19triage.list": "60/minute",
     },
 }
@@ -255,7 +256,23 @@ CELERYBEAT_SCHEDULE = {
     "handle_expired_helpdesk_contacts": {
         "task": "eventstore.tasks.handle_expired_helpdesk_contacts",
         "schedule": crontab(minute="0", hour=HANDLE_EXPIRED_HELPDESK_CONTACTS_HOUR),
-    }
+    },
+    "flush_rapidpro_buffers": {
+        "task": "eventstore.tasks.flush_rapidpro_buffers",
+        "schedule": env.float("RAPIDPRO_BUFFER_FLUSH_INTERVAL", 10.0),
+    },
+    "manage_event_partitions": {
+        "task": "eventstore.tasks.manage_event_partitions",
+        "schedule": crontab(minute="30", hour="1"),
+    },
+    "submit_jembi_batch": {
+        "task": "registrations.tasks.submit_jembi_batch",
+        "schedule": env.float("JEMBI_BATCH_SUBMISSION_INTERVAL", 60.0),
+    },
+    "prune_whatsapp_contacts": {
+        "task": "registrations.tasks.prune_whatsapp_contacts",
+        "schedule": crontab(minute="15"),
+    },
 }
 
 REDIS_URL = os.environ.get("REDIS_URL", "redis://localhost:6379/0")
@@ -288,6 +305,18 @@ JUNEBUG_PASSWORD = os.environ.get("JUNEBUG_PASSWORD", "REPLACEME")
 WHATSAPP_CHANNEL_TYPE = os.environ.get("WHATSAPP_CHANNEL_TYPE", "wassup")
 ENGAGE_URL = os.environ.get("WASSUP_URL", "http://engage")
 ENGAGE_TOKEN = os.environ.get("WASSUP_TOKEN", "engage-token")
+# The maximum number of MSISDNs to send in each WhatsApp contact check request
+WHATSAPP_CONTACT_CHECK_BATCH_SIZE = env.int("WHATSAPP_CONTACT_CHECK_BATCH_SIZE", 100)
+# The batches are sent at most this many at a time, each timing out after this many
+# seconds
+WHATSAPP_CONTACT_CHECK_MAX_CONCURRENT_REQUESTS = env.int(
+    "WHATSAPP_CONTACT_CHECK_MAX_CONCURRENT_REQUESTS", 5
+)
+WHATSAPP_CONTACT_CHECK_TIMEOUT = env.float("WHATSAPP_CONTACT_CHECK_TIMEOUT", 10.0)
+# Old WhatsApp contact check results are deleted this many at a time, for at most
+# this many seconds per run
+WHATSAPP_CONTACT_PRUNE_BATCH_SIZE = env.int("WHATSAPP_CONTACT_PRUNE_BATCH_SIZE", 1000)
+WHATSAPP_CONTACT_PRUNE_DURATION = env.int("WHATSAPP_CONTACT_PRUNE_DURATION", 200)
 TURN_URL = os.environ.get("TURN_URL", "http://turn")
 TURN_TOKEN = os.environ.get("TURN_TOKEN", "turn-token")
 
@@ -302,6 +331,11 @@ TURN_HMAC_SECRET = os.environ.get("TURN_HMAC_SECRET", "REPLACEME")
 
 ENABLE_UNSENT_EVENT_ACTION = env("ENABLE_UNSENT_EVENT_ACTION")
 ENABLE_JEMBI_EVENTS = env.bool("ENABLE_JEMBI_EVENTS", True)
+# Submit events to Jembi in batches with the submit_jembi_batch task, instead of
+# one at a time as they happen
+ENABLE_JEMBI_BATCH_SUBMISSION = env.bool("ENABLE_JEMBI_BATCH_SUBMISSION", False)
+JEMBI_BATCH_SIZE = env.int("JEMBI_BATCH_SIZE", 500)
+JEMBI_MAX_CONCURRENT_REQUESTS = env.int("JEMBI_MAX_CONCURRENT_REQUESTS", 10)
 
 CACHES = {
     "default": env.cache(default="locmemcache://"),
@@ -330,10 +364,75 @@ if ENABLE_EVENTSTORE_WHATSAPP_ACTIONS:
     RAPIDPRO_OPTOUT_FLOW = env.str("RAPIDPRO_OPTOUT_FLOW")
     RAPIDPRO_EDD_LABEL_FLOW = env.str("RAPIDPRO_EDD_LABEL_FLOW")
 
+ENABLE_EVENTSTORE_WEBHOOK_QUEUE = env.bool("ENABLE_EVENTSTORE_WEBHOOK_QUEUE", False)
+EVENTSTORE_WEBHOOK_QUEUE_STREAM = env.str(
+    "EVENTSTORE_WEBHOOK_QUEUE_STREAM", "eventstore_webhooks"
+)
+EVENTSTORE_WEBHOOK_QUEUE_BATCH_SIZE = env.int(
+    "EVENTSTORE_WEBHOOK_QUEUE_BATCH_SIZE", 100
+)
+EVENTSTORE_WEBHOOK_QUEUE_MAX_WAIT = env.float("EVENTSTORE_WEBHOOK_QUEUE_MAX_WAIT", 1.0)
+# Webhooks read by a consumer that haven't been stored after this many seconds are
+# claimed by the next consumer to start, since their consumer has probably stopped
+EVENTSTORE_WEBHOOK_QUEUE_CLAIM_IDLE = env.float(
+    "EVENTSTORE_WEBHOOK_QUEUE_CLAIM_IDLE", 300.0
+)
+
+# The number of monthly event partitions to create ahead of time, and the number of
+# months of event partitions to keep attached. 0 keeps all of them
+EVENTSTORE_EVENT_PARTITIONS_AHEAD = env.int("EVENTSTORE_EVENT_PARTITIONS_AHEAD", 3)
+EVENTSTORE_EVENT_RETENTION_MONTHS = env.int("EVENTSTORE_EVENT_RETENTION_MONTHS", 0)
+
+# Buffer flow starts and contact updates, and send them in batches
+ENABLE_RAPIDPRO_BUFFERING = env.bool("ENABLE_RAPIDPRO_BUFFERING", False)
+
+# How long to wait to merge contact field updates, and how long to remember the
+# values set, so that repeated updates to the same value can be skipped
+RAPIDPRO_CONTACT_UPDATE_DEBOUNCE = env.int("RAPIDPRO_CONTACT_UPDATE_DEBOUNCE", 10)
+RAPIDPRO_CONTACT_FIELD_CACHE_TTL = env.int("RAPIDPRO_CONTACT_FIELD_CACHE_TTL", 60 * 60)
+
 DISABLE_SMS_FAILURE_OPTOUTS = env.bool("DISABLE_SMS_FAILURE_OPTOUTS", False)
+# How long to remember that a contact has no delivery failures
+DELIVERY_FAILURE_ZERO_CACHE_TTL = env.int("DELIVERY_FAILURE_ZERO_CACHE_TTL", 60 * 60)
+
+# How long to cache Identity Store identities for, in seconds. 0 to disable the cache
+IDENTITY_CACHE_TIMEOUT = env.int("IDENTITY_CACHE_TIMEOUT", 60)
+
+# How long to cache subscription check responses for, in seconds. They're removed
+# from the cache when one of the identity's registrations or changes is validated,
+# and again once it has been implemented. 0 to disable the cache
+SUBSCRIPTION_CHECK_CACHE_TIMEOUT = env.int("SUBSCRIPTION_CHECK_CACHE_TIMEOUT", 60)
+
+# Engage context identities and subscriptions are served from the cache without
+# refreshing for ENGAGE_CONTEXT_CACHE_MAX_AGE seconds, and after that are served
+# while being refreshed in the background, until they expire after
+# ENGAGE_CONTEXT_CACHE_TIMEOUT seconds. 0 to disable the cache
+ENGAGE_CONTEXT_CACHE_MAX_AGE = env.int("ENGAGE_CONTEXT_CACHE_MAX_AGE", 60)
+ENGAGE_CONTEXT_CACHE_TIMEOUT = env.int("ENGAGE_CONTEXT_CACHE_TIMEOUT", 24 * 60 * 60)
+
+# How long to cache the Stage Based Messaging messagesets and schedules for, in
+# seconds. 0 to disable the cache
+SBM_CATALOGUE_CACHE_TIMEOUT = env.int("SBM_CATALOGUE_CACHE_TIMEOUT", 60 * 60)
+
+# The maximum number of concurrent subscription updates to Stage Based Messaging,
+# for each change
+SBM_MAX_CONCURRENT_REQUESTS = env.int("SBM_MAX_CONCURRENT_REQUESTS", 5)
+
+# The maximum number of kept alive connections per host, for each process
+HTTP_POOL_MAXSIZE = env.int("HTTP_POOL_MAXSIZE", 10)
 
 HELPDESK_TIMEOUT_DAYS = env.int("HELPDESK_TIMEOUT_DAYS", 10)
 
 # HealthCheck
 HC_TURN_URL = env.str("HC_TURN_URL", None)
 HC_TURN_TOKEN = env.str("HC_TURN_TOKEN", None)
+# How long each process caches HealthCheck user profiles for, in seconds
+HEALTHCHECK_PROFILE_CACHE_TIMEOUT = env.int("HEALTHCHECK_PROFILE_CACHE_TIMEOUT", 60)
+# Only mark a contact's healthcheck as complete in Turn once in this many seconds.
+# 0 to mark it complete for every healthcheck
+HC_TURN_COMPLETE_DEDUPLICATION_WINDOW = env.int(
+    "HC_TURN_COMPLETE_DEDUPLICATION_WINDOW", 0
+)
+# How many contacts each task marks the healthcheck as complete for, for bulk
+# healthchecks
+HC_TURN_COMPLETE_BATCH_SIZE = env.int("HC_TURN_COMPLETE_BATCH_SIZE", 50)
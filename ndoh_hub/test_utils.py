@@ -1,10 +1,16 @@
-from unittest import TestCase
+from unittest import TestCase, mock
 
 import responses
+from django.core.cache import caches
+from django.test import override_settings
+from django_redis import get_redis_connection
 
 from ndoh_hub.utils import (
+    CachedIdentityStoreApiClient,
+    get_http_session,
     get_messageset_schedule_sequence,
     get_messageset_short_name,
+    messageset_catalogue,
     normalise_msisdn,
 )
 from ndoh_hub.utils_tests import mock_get_messageset_by_shortname, mock_get_schedule
@@ -193,3 +199,129 @@ class TestNormaliseMsisdn(TestCase):
         self.assertEqual(normalise_msisdn("082 000 1001"), "+27820001001")
         self.assertEqual(normalise_msisdn("27820001001"), "+27820001001")
         self.assertEqual(normalise_msisdn("+27820001001"), "+27820001001")
+
+
+class GetHttpSessionTests(TestCase):
+    def test_reuses_session(self):
+        """
+        Should return the same session within a process, and a new one after forking
+        """
+        session = get_http_session()
+        self.assertIs(get_http_session(), session)
+        with mock.patch("ndoh_hub.utils.os.getpid", return_value=-1):
+            self.assertIsNot(get_http_session(), session)
+
+
+@override_settings(SBM_CATALOGUE_CACHE_TIMEOUT=60)
+class MessagesetCatalogueTests(TestCase):
+    def setUp(self):
+        messageset_catalogue.invalidate()
+
+    def tearDown(self):
+        messageset_catalogue.invalidate()
+
+    @responses.activate
+    def test_get_messagesets(self):
+        """
+        Should fetch the messagesets once, and use them for lookups by id and short
+        name
+        """
+        responses.add(
+            responses.GET,
+            "http://sbm/api/v1/messageset/",
+            json={"results": [{"id": 1, "short_name": "ms1"}]},
+        )
+        self.assertEqual(
+            messageset_catalogue.get_messagesets(), [{"id": 1, "short_name": "ms1"}]
+        )
+        self.assertEqual(messageset_catalogue.get_messageset_short_names(), {1: "ms1"})
+        self.assertEqual(
+            messageset_catalogue.get_messageset(1), {"id": 1, "short_name": "ms1"}
+        )
+        self.assertEqual(
+            messageset_catalogue.get_messageset_by_short_name("ms1"),
+            {"id": 1, "short_name": "ms1"},
+        )
+        self.assertEqual(len(responses.calls), 1)
+
+    @responses.activate
+    def test_invalidate(self):
+        """
+        Should fetch the messageset again after the catalogue is invalidated
+        """
+        mock_get_messageset_by_shortname("pmtct_prebirth.patient.1")
+        mock_get_messageset_by_shortname("pmtct_prebirth.patient.1")
+        messageset_catalogue.get_messageset_by_short_name("pmtct_prebirth.patient.1")
+        messageset_catalogue.get_messageset_by_short_name("pmtct_prebirth.patient.1")
+        self.assertEqual(len(responses.calls), 1)
+
+        messageset_catalogue.invalidate()
+        messageset_catalogue.get_messageset_by_short_name("pmtct_prebirth.patient.1")
+        self.assertEqual(len(responses.calls), 2)
+
+
+@override_settings(IDENTITY_CACHE_TIMEOUT=60)
+class CachedIdentityStoreApiClientTests(TestCase):
+    def setUp(self):
+        self.client = CachedIdentityStoreApiClient(
+            api_url="http://is/api/v1", auth_token="token"
+        )
+        caches["redis"].delete(self.client.cache_key("identity-uuid"))
+        get_redis_connection("redis").delete(
+            self.client.stats_key("hits"), self.client.stats_key("misses")
+        )
+
+    def add_identity_response(self):
+        responses.add(
+            responses.GET,
+            "http://is/api/v1/identities/identity-uuid/",
+            json={"id": "identity-uuid", "details": {}},
+        )
+
+    @responses.activate
+    def test_get_identity(self):
+        """
+        Should only fetch the identity once, and count the hits and misses
+        """
+        self.add_identity_response()
+        for _ in range(3):
+            self.assertEqual(
+                self.client.get_identity("identity-uuid"),
+                {"id": "identity-uuid", "details": {}},
+            )
+        self.assertEqual(len(responses.calls), 1)
+
+        redis = get_redis_connection("redis")
+        self.assertEqual(int(redis.get(self.client.stats_key("hits"))), 2)
+        self.assertEqual(int(redis.get(self.client.stats_key("misses"))), 1)
+
+    @responses.activate
+    def test_update_identity(self):
+        """
+        Updating the identity should remove it from the cache
+        """
+        self.add_identity_response()
+        responses.add(
+            responses.PATCH,
+            "http://is/api/v1/identities/identity-uuid/",
+            json={"id": "identity-uuid", "details": {"foo": "bar"}},
+        )
+        self.client.get_identity("identity-uuid")
+        self.client.update_identity("identity-uuid", {"details": {"foo": "bar"}})
+        self.client.get_identity("identity-uuid")
+        self.assertEqual(len(responses.calls), 3)
+
+    @responses.activate
+    @mock.patch("ndoh_hub.utils.engage_context_cache")
+    def test_forget_optout(self, engage_context_cache):
+        """
+        Forgetting the identity's details should remove them from the Engage context
+        cache too
+        """
+        responses.add(
+            responses.POST, "http://is/api/v1/optout/", json={"id": 1}, status=201
+        )
+        self.client.create_optout(
+            {"identity": "identity-uuid", "optout_type": "forget"}
+        )
+        engage_context_cache.invalidate.assert_called_once_with("identity-uuid")
@@ -17,3 +17,9 @@ REST_FRAMEWORK["PAGE_SIZE"] = 2
 
 IDENTITY_STORE_URL = "http://is/api/v1"
 STAGE_BASED_MESSAGING_URL = "http://sbm/api/v1"
+
+# Tests mock different messagesets and identities for the same ids
+SBM_CATALOGUE_CACHE_TIMEOUT = 0
+IDENTITY_CACHE_TIMEOUT = 0
+SUBSCRIPTION_CHECK_CACHE_TIMEOUT = 0
+ENGAGE_CONTEXT_CACHE_TIMEOUT = 0
@@ -4,13 +4,19 @@ import base64
 import datetime
 import hmac
 import json
+import os
 from hashlib import sha256
 
 import phonenumbers
 import pkg_resources
+import requests
 import six
 from django.conf import settings
+from django.core.cache import caches
 from django_redis import get_redis_connection
+from prometheus_client import REGISTRY
+from prometheus_client.core import CounterMetricFamily
+from requests.adapters import HTTPAdapter
 from rest_framework.exceptions import AuthenticationFailed
 from seed_services_client.identity_store import IdentityStoreApiClient
 from seed_services_client.message_sender import MessageSenderApiClient
@@ -33,7 +39,104 @@ sbm_client = StageBasedMessagingApiClient(
     auth_token=settings.STAGE_BASED_MESSAGING_TOKEN,
 )
 
-is_client = IdentityStoreApiClient(
+
+class CachedIdentityStoreApiClient(IdentityStoreApiClient):
+    """
+    An Identity Store client that caches identities in Redis for
+    IDENTITY_CACHE_TIMEOUT seconds, so that the tasks for a single registration or
+    change, which usually run one after the other, only fetch the identity once.
+
+    Changes made to an identity through this client, including forgetting its
+    details, remove it from this cache and from the Engage context cache. A timeout
+    of 0 disables the cache.
+    """
+
+    PREFIX = "identity_cache"
+
+    @classmethod
+    def cache_key(cls, identity_id):
+        return "{}:{}".format(cls.PREFIX, identity_id)
+
+    @classmethod
+    def stats_key(cls, name):
+        return "{}_stats:{}".format(cls.PREFIX, name)
+
+    def invalidate(self, identity_id):
+        caches["redis"].delete(self.cache_key(identity_id))
+        # The Engage context includes some of the identity's details
+        engage_context_cache.invalidate(identity_id)
+
+    def get_identity(self, identity):
+        timeout = settings.IDENTITY_CACHE_TIMEOUT
+        if not timeout:
+            return super().get_identity(identity)
+
+        result = caches["redis"].get(self.cache_key(identity))
+        if result is not None:
+            redis.incr(self.stats_key("hits"))
+            return result
+
+        redis.incr(self.stats_key("misses"))
+        result = super().get_identity(identity)
+        if result is not None:
+            caches["redis"].set(self.cache_key(identity), result, timeout)
+        return result
+
+    def update_identity(self, identity, data=None):
+        try:
+            return super().update_identity(identity, data=data)
+        finally:
+            self.invalidate(identity)
+
+    def create_identity(self, identity):
+        result = super().create_identity(identity)
+        if result and result.get("id"):
+            self.invalidate(result["id"])
+        return result
+
+    def create_optout(self, optout):
+        try:
+            return super().create_optout(optout)
+        finally:
+            if optout.get("identity"):
+                self.invalidate(optout["identity"])
+
+    def create_optin(self, optin):
+        try:
+            return super().create_optin(optin)
+        finally:
+            if optin.get("identity"):
+                self.invalidate(optin["identity"])
+
+
+class IdentityCacheCollector(object):
+    """
+    Exports the identity cache hits and misses of all processes, which are counted in
+    Redis
+    """
+
+    def metric(self):
+        return CounterMetricFamily(
+            "identity_store_cache_lookups",
+            "The number of identity lookups, by whether they were cached",
+            labels=["result"],
+        )
+
+    def describe(self):
+        yield self.metric()
+
+    def collect(self):
+        key = CachedIdentityStoreApiClient.stats_key
+        hits, misses = redis.mget(key("hits"), key("misses"))
+        metric = self.metric()
+        metric.add_metric(["hit"], int(hits or 0))
+        metric.add_metric(["miss"], int(misses or 0))
+        yield metric
+
+
+REGISTRY.register(IdentityCacheCollector())
+
+is_client = CachedIdentityStoreApiClient(
     api_url=settings.IDENTITY_STORE_URL, auth_token=settings.IDENTITY_STORE_TOKEN
 )
 
@@ -41,6 +144,199 @@ ms_client = MessageSenderApiClient(
     api_url=settings.MESSAGE_SENDER_URL, auth_token=settings.MESSAGE_SENDER_TOKEN
 )
 
+
+class MessagesetCatalogue(object):
+    """
+    A cache of the Stage Based Messaging messagesets and schedules, which rarely
+    change, indexed by id and short name. It is stored in the Redis cache, so that it
+    is shared between all processes, and can be cleared for all of them with
+    `invalidate`.
+
+    A timeout of 0 disables the cache.
+    """
+
+    PREFIX = "sbm_catalogue"
+
+    def __init__(self, client, cache_alias="redis"):
+        self.client = client
+        self.cache_alias = cache_alias
+
+    @property
+    def cache(self):
+        return caches[self.cache_alias]
+
+    @property
+    def timeout(self):
+        return settings.SBM_CATALOGUE_CACHE_TIMEOUT
+
+    def _key(self, *parts):
+        return ":".join(str(p) for p in (self.PREFIX,) + parts)
+
+    def _get(self, key, fetch):
+        if not self.timeout:
+            return fetch()
+        value = self.cache.get(key)
+        if value is None:
+            value = fetch()
+            if value is not None:
+                self.cache.set(key, value, self.timeout)
+        return value
+
+    def get_messagesets(self):
+        """
+        Returns a list of all the messagesets
+        """
+
+        def fetch():
+            messagesets = list(self.client.get_messagesets()["results"])
+            if self.timeout:
+                # Also index them, so that lookups don't need another request
+                self.cache.set_many(
+                    {
+                        **{self._key("messageset", ms["id"]): ms for ms in messagesets},
+                        **{
+                            self._key("messageset_short_name", ms["short_name"]): ms
+                            for ms in messagesets
+                        },
+                    },
+                    self.timeout,
+                )
+            return messagesets
+
+        return self._get(self._key("messagesets"), fetch)
+
+    def get_messageset_short_names(self):
+        """
+        Returns a dictionary mapping messageset ids to short names
+        """
+        return {ms["id"]: ms["short_name"] for ms in self.get_messagesets()}
+
+    def get_messageset(self, messageset_id):
+        return self._get(
+            self._key("messageset", messageset_id),
+            lambda: self.client.get_messageset(messageset_id),
+        )
+
+    def get_messageset_by_short_name(self, short_name):
+        """
+        Returns the messageset with the short name, or None if there isn't one
+        """
+
+        def fetch():
+            results = self.client.get_messagesets({"short_name": short_name})
+            return next(results["results"], None)
+
+        return self._get(self._key("messageset_short_name", short_name), fetch)
+
+    def get_schedule(self, schedule_id):
+        return self._get(
+            self._key("schedule", schedule_id),
+            lambda: self.client.get_schedule(schedule_id),
+        )
+
+    def invalidate(self):
+        """
+        Removes everything from the catalogue, for all processes
+        """
+        self.cache.delete_pattern(self._key("*"))
+
+
+messageset_catalogue = MessagesetCatalogue(sbm_client)
+
+
+class EngageContextCache(object):
+    """
+    A cache of the remote parts of the Engage context, the identity details that the
+    context shows and the active subscriptions, by MSISDN. Entries are fresh for
+    ENGAGE_CONTEXT_CACHE_MAX_AGE seconds, after which they can still be served while
+    they are refreshed in the background, until they expire after
+    ENGAGE_CONTEXT_CACHE_TIMEOUT seconds.
+
+    Entries are removed for an identity with `invalidate`. A timeout of 0 disables
+    the cache.
+    """
+
+    PREFIX = "engage_context"
+
+    def __init__(self, cache_alias="redis"):
+        self.cache_alias = cache_alias
+
+    @property
+    def cache(self):
+        return caches[self.cache_alias]
+
+    @property
+    def timeout(self):
+        return settings.ENGAGE_CONTEXT_CACHE_TIMEOUT
+
+    def _key(self, *parts):
+        return ":".join(str(p) for p in (self.PREFIX,) + parts)
+
+    def get(self, msisdn):
+        """
+        Returns the cached entry for the MSISDN, or None if there isn't one. The
+        entry's "fresh" key is False if it should be refreshed.
+        """
+        if not self.timeout:
+            return None
+        entry = self.cache.get(self._key("msisdn", msisdn))
+        if entry is not None:
+            age = datetime.datetime.now().timestamp() - entry["timestamp"]
+            entry["fresh"] = age < settings.ENGAGE_CONTEXT_CACHE_MAX_AGE
+        return entry
+
+    def set(self, msisdn, identity, subscriptions):
+        if not self.timeout:
+            return
+        identity_key = self._key("identity", identity["id"])
+        msisdns = self.cache.get(identity_key) or []
+        if msisdn not in msisdns:
+            msisdns.append(msisdn)
+        self.cache.set_many(
+            {
+                identity_key: msisdns,
+                self._key("msisdn", msisdn): {
+                    "identity": identity,
+                    "subscriptions": subscriptions,
+                    "timestamp": datetime.datetime.now().timestamp(),
+                },
+            },
+            self.timeout,
+        )
+
+    def start_refresh(self, msisdn):
+        """
+        Returns True if the entry for the MSISDN isn't already being refreshed, and
+        marks it as being refreshed
+        """
+        return self.cache.add(
+            self._key("refreshing", msisdn),
+            True,
+            settings.ENGAGE_CONTEXT_CACHE_MAX_AGE or None,
+        )
+
+    def finish_refresh(self, msisdn):
+        """
+        Unmarks the entry for the MSISDN as being refreshed. Should only be called by
+        whoever marked it with `start_refresh`.
+        """
+        self.cache.delete(self._key("refreshing", msisdn))
+
+    def invalidate(self, identity_id):
+        """
+        Removes the entries for all of the identity's MSISDNs, for all processes
+        """
+        if not self.timeout:
+            return
+        identity_key = self._key("identity", identity_id)
+        msisdns = self.cache.get(identity_key) or []
+        self.cache.delete_many(
+            [identity_key] + [self._key("msisdn", msisdn) for msisdn in msisdns]
+        )
+
+
+engage_context_cache = EngageContextCache()
+
 wab_client = WABClient(url=settings.ENGAGE_URL)
 wab_client.connection.set_token(settings.ENGAGE_TOKEN)
 
@@ -52,6 +348,28 @@ VERSION = pkg_resources.require("ndoh-hub")[0].version
 
 redis = get_redis_connection("redis")
 
+_http_session = None
+_http_session_pid = None
+
+
+def get_http_session():
+    """
+    Returns the HTTP session for this process. Connections in the session's pool are
+    kept alive and reused between requests, so that we don't do a new TCP and TLS
+    handshake for every request.
+
+    Sessions aren't shared between processes, so a new session is created after
+    forking, eg. for each celery worker process.
+    """
+    global _http_session, _http_session_pid
+    if _http_session is None or _http_session_pid != os.getpid():
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_maxsize=settings.HTTP_POOL_MAXSIZE)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        _http_session, _http_session_pid = session, os.getpid()
+    return _http_session
+
 
 def get_identity_msisdn(registrant_id):
     """
@@ -253,11 +571,11 @@ def get_messageset_short_name(reg_type, authority, weeks):
 
 def get_messageset_schedule_sequence(short_name, weeks):
     # get messageset
-    messageset = next(sbm_client.get_messagesets({"short_name": short_name})["results"])
+    messageset = messageset_catalogue.get_messageset_by_short_name(short_name)
 
     if "prebirth" in short_name or "postbirth" in short_name:
         # get schedule
-        schedule = sbm_client.get_schedule(messageset["default_schedule"])
+        schedule = messageset_catalogue.get_schedule(messageset["default_schedule"])
         # get schedule days of week: comma-seperated str e.g. '1,3' for Mon&Wed
         days_of_week = schedule["day_of_week"]
         # determine how many times a week messages are sent e.g. 2 for '1,3'
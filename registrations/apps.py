@@ -7,10 +7,16 @@ class RegistrationsAppConfig(AppConfig):
     name = "registrations"
 
     def ready(self):
-        from .signals import psh_validate_subscribe
+        from .signals import psh_validate_subscribe, update_subscription_summary
 
         post_save.connect(
             psh_validate_subscribe,
             sender="registrations.Registration",
             dispatch_uid="psh_validate_subscribe",
         )
+        for sender in ("registrations.Registration", "changes.Change"):
+            post_save.connect(
+                update_subscription_summary,
+                sender=sender,
+                dispatch_uid="update_subscription_summary_{}".format(sender),
+            )
@@ -0,0 +1,92 @@
+import gzip
+import json
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils import timezone
+
+from registrations.models import JembiSubmission
+
+
+class Command(BaseCommand):
+    help = (
+        "Deletes submitted Jembi submissions older than the given number of days, in "
+        "batches, first writing them to a gzipped JSON lines file. Submissions that "
+        "haven't been submitted yet are never deleted."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--days",
+            type=int,
+            required=True,
+            help="Archive submissions older than this many days",
+        )
+        parser.add_argument(
+            "--output",
+            default=None,
+            help="The file to write the archived submissions to, eg. jembi.jsonl.gz",
+        )
+        parser.add_argument(
+            "--no-archive",
+            action="store_true",
+            help="Delete the submissions without writing them to a file",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=1000,
+            help="The number of submissions to delete in each query",
+        )
+
+    def get_batches(self, cutoff, batch_size):
+        """
+        Yields batches of old submitted submissions, paging by primary key
+        """
+        submissions = (
+            JembiSubmission.objects.filter(submitted=True, timestamp__lt=cutoff)
+            .order_by("pk")
+            .values()
+        )
+        last_pk = 0
+        while True:
+            batch = list(submissions.filter(pk__gt=last_pk)[:batch_size])
+            if not batch:
+                return
+            yield batch
+            last_pk = batch[-1]["id"]
+
+    def handle(self, *args, **options):
+        if not options["output"] and not options["no_archive"]:
+            raise CommandError("One of --output or --no-archive is required")
+
+        cutoff = timezone.now() - timedelta(days=options["days"])
+        output = None
+        if options["output"]:
+            output = gzip.open(options["output"], "at")
+
+        total = 0
+        start, d_print = time.time(), time.time()
+        try:
+            for batch in self.get_batches(cutoff, options["batch_size"]):
+                if output is not None:
+                    for submission in batch:
+                        output.write(json.dumps(submission, cls=DjangoJSONEncoder))
+                        output.write("\n")
+                    # Make sure they're written before we delete them
+                    output.flush()
+                JembiSubmission.objects.filter(pk__in=[s["id"] for s in batch]).delete()
+                total += len(batch)
+                if time.time() - d_print > 1:
+                    self.stdout.write(
+                        f"\rArchived {total} at {total/(time.time() - start):.0f}/s",
+                        ending="",
+                    )
+                    d_print = time.time()
+        finally:
+            if output is not None:
+                output.close()
+
+        self.stdout.write(f"\rArchived {total} submissions")
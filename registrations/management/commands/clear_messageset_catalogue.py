@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from ndoh_hub.utils import messageset_catalogue
+
+
+class Command(BaseCommand):
+    help = (
+        "Clears the cached Stage Based Messaging messagesets and schedules, so that "
+        "changes to them are picked up immediately"
+    )
+
+    def handle(self, *args, **options):
+        messageset_catalogue.invalidate()
+        self.stdout.write("Cleared the messageset catalogue")
@@ -1,8 +1,13 @@
+import time
+
+from django.conf import settings
 from django.core.management import BaseCommand
+from django.db.models import Max
 from django.utils import timezone
 from django.utils.dateparse import parse_datetime
+from django_redis import get_redis_connection
 
-from registrations.tasks import push_to_jembi_api
+from registrations.tasks import submit_jembi_submissions
 
 
 class Command(BaseCommand):
@@ -36,6 +41,39 @@ class Command(BaseCommand):
             action="store_true",
             help="Actually submits the events to Jembi, instead of doing a dry run",
         )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=settings.JEMBI_BATCH_SIZE,
+            help="The number of events to submit at a time",
+        )
+        parser.add_argument(
+            "--rate",
+            type=float,
+            default=0,
+            help="The maximum number of events to submit per second. 0 for no limit",
+        )
+        parser.add_argument(
+            "--checkpoint",
+            default=None,
+            help=(
+                "Name of the checkpoint to resume from, and to save progress to, so "
+                "that an interrupted run can be continued with the same command"
+            ),
+        )
+
+    def checkpoint_key(self, name):
+        return f"jembi_submit_events:checkpoint:{name}"
+
+    def get_checkpoint(self, name):
+        if not name:
+            return 0
+        checkpoint = get_redis_connection("redis").get(self.checkpoint_key(name))
+        return int(checkpoint or 0)
+
+    def set_checkpoint(self, name, pk):
+        if name:
+            get_redis_connection("redis").set(self.checkpoint_key(name), pk)
 
     def handle(self, *args, **options):
         from registrations.models import JembiSubmission
@@ -50,11 +88,47 @@ class Command(BaseCommand):
         if options["until"]:
             events = events.filter(timestamp__lte=timezone.make_aware(options["until"]))
 
-        self.stdout.write(f"Submitting {events.count()} events.")
+        # Use the primary key range instead of a count, which is a full table scan
+        last_pk = self.get_checkpoint(options["checkpoint"])
+        events = events.filter(pk__gt=last_pk).order_by("pk")
+        max_pk = events.aggregate(max_pk=Max("pk"))["max_pk"]
+        if max_pk is None:
+            self.stdout.write("No events to submit.")
+            return
+
+        self.stdout.write(f"Submitting events with IDs {last_pk + 1} to {max_pk}.")
 
         if not options["submit"]:
             self.stdout.write("WARNING: --submit not specified, not submitting events")
             return
 
-        for event in events.values_list("pk", "path", "request_data").iterator():
-            push_to_jembi_api.delay(event)
+        total = submitted = 0
+        start, d_print = time.time(), time.time()
+        first_pk = last_pk
+        while True:
+            batch = list(events.filter(pk__gt=last_pk)[: options["batch_size"]])
+            if not batch:
+                break
+            submitted += submit_jembi_submissions(batch)
+            total += len(batch)
+            last_pk = batch[-1].pk
+            self.set_checkpoint(options["checkpoint"], last_pk)
+
+            if options["rate"]:
+                # Sleep until we're back down to the target rate
+                time.sleep(max(total / options["rate"] - (time.time() - start), 0))
+
+            if time.time() - d_print > 1:
+                elapsed = time.time() - start
+                # Estimate the time remaining from how far through the IDs we are
+                progress = (last_pk - first_pk) / (max_pk - first_pk)
+                eta = elapsed / progress - elapsed
+                self.stdout.write(
+                    f"\rProcessed {total} at {total/elapsed:.0f}/s, "
+                    f"{progress:.0%} done, ETA {eta:.0f}s",
+                    ending="",
+                )
+                d_print = time.time()
+        self.stdout.write("")
+
+        self.stdout.write(f"Submitted {submitted} of {total} events.")
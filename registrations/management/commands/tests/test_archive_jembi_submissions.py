@@ -0,0 +1,60 @@
+import gzip
+import json
+import os
+import tempfile
+from datetime import timedelta
+
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.test import TestCase
+from django.utils import timezone
+
+from registrations.models import JembiSubmission
+
+
+class ArchiveJembiSubmissionsTests(TestCase):
+    def create_submission(self, days_ago, submitted=True):
+        s = JembiSubmission.objects.create(
+            path="test", request_data={"cmsisdn": "+27820001001"}, submitted=submitted
+        )
+        s.timestamp = timezone.now() - timedelta(days=days_ago)
+        s.save()
+        return s
+
+    def test_archive(self):
+        """
+        Should write old submitted submissions to the file, and delete them
+        """
+        old = self.create_submission(10)
+        new = self.create_submission(1)
+        unsubmitted = self.create_submission(10, submitted=False)
+
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, "jembi.jsonl.gz")
+            call_command("archive_jembi_submissions", days=5, output=path, batch_size=1)
+            with gzip.open(path, "rt") as f:
+                [archived] = [json.loads(line) for line in f]
+
+        self.assertEqual(archived["id"], old.id)
+        self.assertEqual(archived["request_data"], {"cmsisdn": "+27820001001"})
+        self.assertEqual(
+            set(JembiSubmission.objects.values_list("id", flat=True)),
+            {new.id, unsubmitted.id},
+        )
+
+    def test_no_archive(self):
+        """
+        Should delete without writing a file if --no-archive is specified
+        """
+        self.create_submission(10)
+        call_command("archive_jembi_submissions", days=5, no_archive=True)
+        self.assertFalse(JembiSubmission.objects.exists())
+
+    def test_output_required(self):
+        """
+        Should not delete anything if neither --output or --no-archive is specified
+        """
+        self.create_submission(10)
+        with self.assertRaises(CommandError):
+            call_command("archive_jembi_submissions", days=5)
+        self.assertTrue(JembiSubmission.objects.exists())
@@ -1,15 +1,21 @@
 from datetime import datetime
-from unittest.mock import patch
+from unittest.mock import call, patch
+from uuid import uuid4
 
 import pytz
 from django.core.management import call_command
 from django.test import TestCase
+from django_redis import get_redis_connection
 
 from registrations.models import JembiSubmission
 
 
 class JembiSubmitEventsTests(TestCase):
-    @patch("registrations.management.commands.jembi_submit_events.push_to_jembi_api")
+    @patch(
+        "registrations.management.commands.jembi_submit_events."
+        "submit_jembi_submissions",
+        return_value=0,
+    )
     def test_since_filter(self, task):
         """
         Should not submit any events before the "since" date
@@ -20,9 +26,13 @@ class JembiSubmitEventsTests(TestCase):
         call_command(
             "jembi_submit_events", since=datetime(2016, 1, 2), submit=True, all=True
         )
-        task.delay.assert_not_called()
+        task.assert_not_called()
 
-    @patch("registrations.management.commands.jembi_submit_events.push_to_jembi_api")
+    @patch(
+        "registrations.management.commands.jembi_submit_events."
+        "submit_jembi_submissions",
+        return_value=0,
+    )
     def test_until_filter(self, task):
         """
         Should not submit any events after the "until" date
@@ -33,31 +43,80 @@ class JembiSubmitEventsTests(TestCase):
         call_command(
             "jembi_submit_events", until=datetime(2016, 1, 1), submit=True, all=True
         )
-        task.delay.assert_not_called()
+        task.assert_not_called()
 
-    @patch("registrations.management.commands.jembi_submit_events.push_to_jembi_api")
+    @patch(
+        "registrations.management.commands.jembi_submit_events."
+        "submit_jembi_submissions",
+        return_value=0,
+    )
     def test_all_filter(self, task):
         """
         Should not submit already submitted events if "--all" is not specified
         """
         JembiSubmission.objects.create(request_data={}, submitted=True)
         call_command("jembi_submit_events", submit=True, all=False)
-        task.delay.assert_not_called()
+        task.assert_not_called()
 
-    @patch("registrations.management.commands.jembi_submit_events.push_to_jembi_api")
+    @patch(
+        "registrations.management.commands.jembi_submit_events."
+        "submit_jembi_submissions",
+        return_value=0,
+    )
     def test_submit_filter(self, task):
         """
         If submit isn't specified, then we should not submit the events
         """
         JembiSubmission.objects.create(request_data={})
         call_command("jembi_submit_events")
-        task.delay.assert_not_called()
+        task.assert_not_called()
 
-    @patch("registrations.management.commands.jembi_submit_events.push_to_jembi_api")
+    @patch(
+        "registrations.management.commands.jembi_submit_events."
+        "submit_jembi_submissions",
+        return_value=0,
+    )
     def test_submit_event(self, task):
         """
         If the event should be submitted, then we should submit it
         """
         s = JembiSubmission.objects.create(path="test", request_data={"test": "data"})
         call_command("jembi_submit_events", submit=True)
-        task.delay.assert_called_once_with((s.id, "test", {"test": "data"}))
+        task.assert_called_once_with([s])
+
+    @patch(
+        "registrations.management.commands.jembi_submit_events."
+        "submit_jembi_submissions",
+        return_value=0,
+    )
+    def test_batches(self, task):
+        """
+        Should submit the events in batches of batch size, in ID order
+        """
+        s1 = JembiSubmission.objects.create(request_data={})
+        s2 = JembiSubmission.objects.create(request_data={})
+        s3 = JembiSubmission.objects.create(request_data={})
+        call_command("jembi_submit_events", submit=True, batch_size=2)
+        self.assertEqual(task.call_args_list, [call([s1, s2]), call([s3])])
+
+    @patch(
+        "registrations.management.commands.jembi_submit_events."
+        "submit_jembi_submissions",
+        return_value=0,
+    )
+    def test_checkpoint(self, task):
+        """
+        Should resume from where the previous run with the same checkpoint stopped
+        """
+        checkpoint = str(uuid4())
+        s1 = JembiSubmission.objects.create(request_data={})
+        call_command("jembi_submit_events", submit=True, checkpoint=checkpoint)
+        task.assert_called_once_with([s1])
+
+        task.reset_mock()
+        s2 = JembiSubmission.objects.create(request_data={})
+        call_command("jembi_submit_events", submit=True, checkpoint=checkpoint)
+        task.assert_called_once_with([s2])
+        get_redis_connection("redis").delete(
+            f"jembi_submit_events:checkpoint:{checkpoint}"
+        )
@@ -0,0 +1,45 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    atomic = False
+
+    dependencies = [("registrations", "0027_auto_20200922_1041")]
+
+    operations = [
+        migrations.SeparateDatabaseAndState(
+            database_operations=[
+                migrations.RunSQL(
+                    sql="""
+                    CREATE INDEX CONCURRENTLY IF NOT EXISTS
+                    "registratio_unsubmitted_idx"
+                    ON "registrations_jembisubmission" ("id")
+                    WHERE NOT "submitted";
+                    """,
+                    reverse_sql="""
+                    DROP INDEX CONCURRENTLY IF EXISTS "registratio_unsubmitted_idx";
+                    """,
+                )
+            ],
+            state_operations=[
+                migrations.AddIndex(
+                    model_name="jembisubmission",
+                    index=models.Index(
+                        condition=models.Q(submitted=False),
+                        fields=["id"],
+                        name="registratio_unsubmitted_idx",
+                    ),
+                )
+            ],
+        ),
+        # Expression indexes can't be declared on the model in this Django version
+        migrations.RunSQL(
+            sql="""
+            CREATE INDEX CONCURRENTLY IF NOT EXISTS "registratio_cmsisdn_idx"
+            ON "registrations_jembisubmission" ((request_data->>'cmsisdn'));
+            """,
+            reverse_sql="""
+            DROP INDEX CONCURRENTLY IF EXISTS "registratio_cmsisdn_idx";
+            """,
+        ),
+    ]
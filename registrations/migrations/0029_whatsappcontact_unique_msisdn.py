@@ -0,0 +1,39 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    """
+    Keeps only one, the latest, contact check result per MSISDN. The contacts table
+    only holds the last 7 days of results, so this runs in a single transaction,
+    blocking writes while the duplicates are removed and the constraint is added.
+    """
+
+    dependencies = [("registrations", "0028_jembisubmission_indexes")]
+
+    operations = [
+        migrations.RunSQL(
+            sql="""
+            LOCK TABLE "registrations_whatsappcontact" IN SHARE ROW EXCLUSIVE MODE;
+            DELETE FROM "registrations_whatsappcontact" a
+            USING "registrations_whatsappcontact" b
+            WHERE a.msisdn = b.msisdn AND (a.created, a.id) < (b.created, b.id);
+            """,
+            reverse_sql=migrations.RunSQL.noop,
+        ),
+        migrations.AddConstraint(
+            model_name="whatsappcontact",
+            constraint=models.UniqueConstraint(
+                fields=["msisdn"], name="registratio_msisdn_uniq"
+            ),
+        ),
+        # The unique constraint's index covers lookups by MSISDN
+        migrations.RemoveIndex(
+            model_name="whatsappcontact", name="registratio_msisdn_856962_idx"
+        ),
+        migrations.AddIndex(
+            model_name="whatsappcontact",
+            index=models.Index(
+                fields=["created"], name="registratio_created_e0a20e_idx"
+            ),
+        ),
+    ]
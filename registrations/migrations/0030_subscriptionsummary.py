@@ -0,0 +1,38 @@
+import django.contrib.postgres.fields
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [("registrations", "0029_whatsappcontact_unique_msisdn")]
+
+    operations = [
+        migrations.CreateModel(
+            name="SubscriptionSummary",
+            fields=[
+                (
+                    "identity_id",
+                    models.CharField(max_length=36, primary_key=True, serialize=False),
+                ),
+                (
+                    "edds",
+                    django.contrib.postgres.fields.ArrayField(
+                        base_field=models.DateTimeField(),
+                        blank=True,
+                        default=list,
+                        size=None,
+                    ),
+                ),
+                (
+                    "baby_dobs",
+                    django.contrib.postgres.fields.ArrayField(
+                        base_field=models.DateTimeField(),
+                        blank=True,
+                        default=list,
+                        size=None,
+                    ),
+                ),
+                ("updated_at", models.DateTimeField(auto_now=True)),
+            ],
+        )
+    ]
@@ -0,0 +1,14 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [("registrations", "0030_subscriptionsummary")]
+
+    operations = [
+        migrations.AddField(
+            model_name="jembisubmission",
+            name="claimed_until",
+            field=models.DateTimeField(default=None, null=True),
+        )
+    ]
@@ -1,9 +1,14 @@
 import uuid
+from datetime import datetime, timedelta
 
+from django.conf import settings
 from django.contrib.auth.models import User
-from django.contrib.postgres.fields import JSONField
-from django.db import models
+from django.contrib.postgres.fields import ArrayField, JSONField
+from django.core.cache import caches
+from django.db import connections, models
+from django.utils import timezone
 from django.utils.encoding import python_2_unicode_compatible
+from django_redis import get_redis_connection
 from simple_history.models import HistoricalRecords
 
 
@@ -220,9 +225,57 @@ class PositionTracker(models.Model):
         return "{}: {}".format(self.label, self.position)
 
 
+class WhatsAppContactManager(models.Manager):
+    def get_recent(self, msisdns):
+        """
+        Returns the contact check result from the last 7 days for each of the
+        MSISDNs that have one, as a dict keyed by MSISDN, in a single query
+        """
+        contacts = self.filter(
+            msisdn__in=msisdns, created__gt=timezone.now() - timedelta(days=7)
+        )
+        return {contact.msisdn: contact for contact in contacts}
+
+    def upsert(self, contacts):
+        """
+        Stores the contact check results, replacing any existing result for the
+        same MSISDN, in a single INSERT ... ON CONFLICT (msisdn) DO UPDATE query.
+        The created timestamp of replaced results is reset to now.
+        """
+        # Postgres cannot update the same row twice in a single statement, so if
+        # the same MSISDN is repeated, the last one wins
+        unique = {contact.msisdn: contact for contact in contacts}
+        if not unique:
+            return []
+
+        now = timezone.now()
+        params = []
+        for contact in unique.values():
+            contact.created = now
+            params.extend([contact.msisdn, contact.whatsapp_id, now])
+
+        connection = connections[self.db]
+        qn = connection.ops.quote_name
+        sql = """
+            INSERT INTO {table} (msisdn, whatsapp_id, created) VALUES {values}
+            ON CONFLICT (msisdn) DO UPDATE SET
+                whatsapp_id = EXCLUDED.whatsapp_id, created = EXCLUDED.created
+            RETURNING msisdn, id
+        """.format(
+            table=qn(self.model._meta.db_table),
+            values=", ".join(["(%s, %s, %s)"] * len(unique)),
+        )
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            for msisdn, id in cursor.fetchall():
+                unique[msisdn].id = id
+        return list(unique.values())
+
+
 class WhatsAppContact(models.Model):
     """
-    Caches the results of the WhatsApp contact check
+    Caches the results of the WhatsApp contact check. There is only one, the
+    latest, result for each MSISDN.
     """
 
     msisdn = models.CharField(max_length=100, help_text="The MSISDN of the contact")
@@ -231,6 +284,8 @@ class WhatsAppContact(models.Model):
     )
     created = models.DateTimeField(auto_now_add=True)
 
+    objects = WhatsAppContactManager()
+
     @property
     def api_format(self):
         if self.whatsapp_id:
@@ -240,7 +295,11 @@ class WhatsAppContact(models.Model):
     class Meta:
         permissions = (("can_prune_whatsappcontact", "Can prune WhatsApp contact"),)
         verbose_name = "WhatsApp Contact"
-        indexes = [models.Index(fields=["msisdn"])]
+        constraints = [
+            models.UniqueConstraint(fields=["msisdn"], name="registratio_msisdn_uniq")
+        ]
+        # For pruning old results
+        indexes = [models.Index(fields=["created"])]
 
 
 class ClinicCode(models.Model):
@@ -261,3 +320,169 @@ class JembiSubmission(models.Model):
     response_status_code = models.IntegerField(null=True, default=None)
     response_headers = JSONField(default=dict)
     response_body = models.TextField(blank=True, default="")
+    # Set while a batch is posting the submission, so that other batches skip it
+    claimed_until = models.DateTimeField(null=True, default=None)
+
+    class Meta:
+        indexes = [
+            # For finding the submissions that still need to be submitted
+            models.Index(
+                fields=["id"],
+                name="registratio_unsubmitted_idx",
+                condition=models.Q(submitted=False),
+            )
+        ]
+
+
+class SubscriptionSummaryManager(models.Manager):
+    OPTOUT_ACTIONS = (
+        "baby_switch",
+        "pmtct_loss_switch",
+        "pmtct_loss_optout",
+        "pmtct_nonloss_optout",
+        "momconnect_loss_switch",
+        "momconnect_loss_optout",
+        "momconnect_nonloss_optout",
+    )
+    REG_TYPES = (
+        "momconnect_prebirth",
+        "momconnect_postbirth",
+        "whatsapp_prebirth",
+        "whatsapp_postbirth",
+    )
+
+    def refresh(self, identity_id):
+        """
+        Recalculates and stores the summary for the identity from its validated
+        registrations and changes
+        """
+        # changes.models imports this module, so we can't import it at the top
+        from changes.models import Change
+
+        changes = Change.objects.filter(registrant_id=identity_id, validated=True)
+        epoch = timezone.utc.localize(datetime.min)
+        last_optout = (
+            changes.filter(action__in=self.OPTOUT_ACTIONS)
+            .order_by("-created_at")
+            .values_list("created_at", flat=True)
+            .first()
+        ) or epoch
+        last_baby_switch = (
+            changes.filter(action="baby_switch")
+            .order_by("-created_at")
+            .values_list("created_at", flat=True)
+            .first()
+        ) or epoch
+
+        registrations = Registration.objects.filter(
+            registrant_id=identity_id,
+            reg_type__in=self.REG_TYPES,
+            created_at__gte=max((last_optout, last_baby_switch)),
+            validated=True,
+        )
+        edds, baby_dobs = [], []
+        for registration in registrations:
+            for field, dates in (("edd", edds), ("baby_dob", baby_dobs)):
+                try:
+                    dates.append(
+                        datetime.strptime(registration.data[field], "%Y-%m-%d").replace(
+                            tzinfo=timezone.utc
+                        )
+                    )
+                except (KeyError, TypeError, ValueError):
+                    pass
+        baby_dobs.extend(
+            changes.filter(
+                action="baby_switch", created_at__gte=last_optout
+            ).values_list("created_at", flat=True)
+        )
+
+        summary, _ = self.update_or_create(
+            identity_id=identity_id, defaults={"edds": edds, "baby_dobs": baby_dobs}
+        )
+        return summary
+
+    def get_or_refresh(self, identity_id):
+        """
+        Returns the summary for the identity, calculating it if it doesn't exist yet
+        """
+        try:
+            return self.get(identity_id=identity_id)
+        except self.model.DoesNotExist:
+            return self.refresh(identity_id)
+
+
+class SubscriptionSummary(models.Model):
+    """
+    The expected and actual birth dates for an identity's current MomConnect
+    subscriptions, updated whenever one of its registrations or changes is
+    validated, so that the subscription check doesn't have to work them out.
+    """
+
+    identity_id = models.CharField(max_length=36, primary_key=True)
+    edds = ArrayField(models.DateTimeField(), default=list, blank=True)
+    baby_dobs = ArrayField(models.DateTimeField(), default=list, blank=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    objects = SubscriptionSummaryManager()
+
+    # Subscription check responses are cached by MSISDN, and we keep track of which
+    # MSISDNs have been cached for each identity in a Redis set, so that we can
+    # invalidate them
+    CACHE_PREFIX = "subscription_check"
+
+    @classmethod
+    def response_cache_key(cls, msisdn):
+        return "{}:msisdn:{}".format(cls.CACHE_PREFIX, msisdn)
+
+    @classmethod
+    def identity_cache_key(cls, identity_id):
+        return "{}:identity:{}".format(cls.CACHE_PREFIX, identity_id)
+
+    @classmethod
+    def cache_response(cls, identity_id, msisdn, response):
+        timeout = settings.SUBSCRIPTION_CHECK_CACHE_TIMEOUT
+        if not timeout:
+            return
+        # Added to the identity's set first, so that it's invalidated along with it
+        key = cls.identity_cache_key(identity_id)
+        pipe = get_redis_connection("redis").pipeline()
+        pipe.sadd(key, msisdn)
+        pipe.expire(key, timeout)
+        pipe.execute()
+        caches["redis"].set(cls.response_cache_key(msisdn), response, timeout)
+
+    @classmethod
+    def get_cached_response(cls, msisdn):
+        if not settings.SUBSCRIPTION_CHECK_CACHE_TIMEOUT:
+            return None
+        return caches["redis"].get(cls.response_cache_key(msisdn))
+
+    @classmethod
+    def invalidate_responses(cls, identity_id):
+        if not settings.SUBSCRIPTION_CHECK_CACHE_TIMEOUT:
+            return
+        key = cls.identity_cache_key(identity_id)
+        pipe = get_redis_connection("redis").pipeline()
+        pipe.smembers(key)
+        pipe.delete(key)
+        msisdns, _ = pipe.execute()
+        if msisdns:
+            caches["redis"].delete_many(
+                [cls.response_cache_key(msisdn.decode()) for msisdn in msisdns]
+            )
+
+    @property
+    def description(self):
+        """
+        A human readable string of the details of the current subscriptions
+        """
+        now = timezone.now()
+        # Messaging continues for 2 weeks after edd before being switched
+        dates = [edd + timedelta(weeks=2) if edd < now else edd for edd in self.edds]
+        dates.extend(self.baby_dobs)
+        # Filter out expired subscriptions
+        cutoff = now - timedelta(weeks=37 + 104)
+        return ", ".join(
+            "baby born on {:%Y-%m-%d}".format(d) for d in sorted(dates) if d > cutoff
+        )
@@ -8,3 +8,15 @@ def psh_validate_subscribe(sender, instance, created, **kwargs):
         from .tasks import validate_subscribe
 
         validate_subscribe.apply_async(kwargs={"registration_id": str(instance.id)})
+
+
+def update_subscription_summary(sender, instance, **kwargs):
+    """ Post save hook to keep the registrant's subscription summary up to date,
+        and remove their cached subscription checks, when a Registration or
+        Change is validated
+    """
+    if instance.validated and instance.registrant_id:
+        from .models import SubscriptionSummary
+
+        SubscriptionSummary.objects.refresh(instance.registrant_id)
+        SubscriptionSummary.invalidate_responses(instance.registrant_id)
@@ -1,7 +1,10 @@
 import json
 import random
 import re
+import time
 import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
 from datetime import datetime, timedelta
 from functools import partial
 
@@ -14,9 +17,11 @@ from celery.utils.log import get_task_logger
 from demands import HTTPServiceError
 from django.conf import settings
 from django.contrib.auth.models import User
+from django.contrib.postgres.fields.jsonb import KeyTextTransform
+from django.db import transaction
+from django.db.models import Q
 from django.utils import timezone, translation
 from requests.exceptions import ConnectionError, HTTPError, RequestException
-from seed_services_client.identity_store import IdentityStoreApiClient
 from seed_services_client.service_rating import ServiceRatingApiClient
 from temba_client.exceptions import TembaHttpError
 from wabclient.exceptions import AddressException
@@ -25,7 +30,14 @@ from ndoh_hub import utils
 from ndoh_hub.celery import app
 from ndoh_hub.utils import rapidpro, redis
 
-from .models import ClinicCode, JembiSubmission, Registration, Source, WhatsAppContact
+from .models import (
+    ClinicCode,
+    JembiSubmission,
+    Registration,
+    Source,
+    SubscriptionSummary,
+    WhatsAppContact,
+)
 
 try:
     from urlparse import urljoin
@@ -33,7 +45,7 @@ except ImportError:
     from urllib.parse import urljoin
 
 
-is_client = IdentityStoreApiClient(
+is_client = utils.CachedIdentityStoreApiClient(
     api_url=settings.IDENTITY_STORE_URL, auth_token=settings.IDENTITY_STORE_TOKEN
 )
 
@@ -543,6 +555,7 @@ class ValidateSubscribe(Task):
             task = chain(
                 jembi_task.si(str(registration.pk)),
                 remove_personally_identifiable_fields.si(str(registration.pk)),
+                invalidate_subscription_check_cache.si(registration.registrant_id),
             )
             task.delay()
 
@@ -556,6 +569,21 @@ class ValidateSubscribe(Task):
 validate_subscribe = ValidateSubscribe()
 
 
+@app.task(acks_late=True, soft_time_limit=10, time_limit=15)
+def invalidate_subscription_check_cache(identity_id):
+    """
+    Removes the identity's cached subscription check responses again, once the
+    tasks that update its identity and subscriptions have finished. Responses
+    cached while those tasks were running could be out of date.
+
+    Stage Based Messaging creates the subscriptions from the subscription requests
+    in its own time, so a response can still be out of date for up to
+    SUBSCRIPTION_CHECK_CACHE_TIMEOUT seconds after that.
+    """
+    if identity_id:
+        SubscriptionSummary.invalidate_responses(identity_id)
+
+
 @app.task()
 def remove_personally_identifiable_fields(registration_id):
     """
@@ -813,8 +841,7 @@ class ValidateSubscribeJembiAppRegistration(HTTPRetryMixin, ValidateSubscribe):
         active_subs = utils.sbm_client.get_subscriptions(
             {"identity": identity["id"], "active": True}
         )["results"]
-        messagesets = utils.sbm_client.get_messagesets()["results"]
-        messagesets = {ms["id"]: ms["short_name"] for ms in messagesets}
+        messagesets = utils.messageset_catalogue.get_messageset_short_names()
         for sub in active_subs:
             short_name = messagesets[sub["messageset"]]
             if re.search(regex, short_name):
@@ -1317,27 +1344,138 @@ def get_whatsapp_contact(msisdn):
     """
     with redis.lock(f"wacontact:{msisdn}", timeout=10):
         # Try to get existing
-        try:
-            contact = (
-                WhatsAppContact.objects.filter(
-                    created__gt=timezone.now() - timedelta(days=7)
-                )
-                .filter(msisdn=msisdn)
-                .latest("created")
-            )
+        contact = WhatsAppContact.objects.get_recent([msisdn]).get(msisdn)
+        if contact is not None:
             return contact.api_format
-        except WhatsAppContact.DoesNotExist:
-            pass
 
-        # If no existing, fetch status from API and create
+        # If no existing, fetch status from API and store
         try:
             whatsapp_id = utils.wab_client.get_address(msisdn)
         except AddressException:
             whatsapp_id = ""
-        contact = WhatsAppContact.objects.create(msisdn=msisdn, whatsapp_id=whatsapp_id)
+        [contact] = WhatsAppContact.objects.upsert(
+            [WhatsAppContact(msisdn=msisdn, whatsapp_id=whatsapp_id)]
+        )
         return contact.api_format
 
 
+@app.task(
+    autoretry_for=(RequestException, SoftTimeLimitExceeded),
+    retry_backoff=True,
+    max_retries=15,
+    acks_late=True,
+    soft_time_limit=30,
+    time_limit=35,
+)
+def get_whatsapp_contacts(msisdns):
+    """
+    Fetches the whatsapp contact IDs for all of the MSISDNs from the API, in batches
+    of WHATSAPP_CONTACT_CHECK_BATCH_SIZE, with at most
+    WHATSAPP_CONTACT_CHECK_MAX_CONCURRENT_REQUESTS requests at a time, and stores
+    them in the database.
+
+    Like get_whatsapp_contact, each MSISDN is locked while it's being checked, and
+    MSISDNs that another check stored while we waited for the lock are not checked
+    again.
+
+    Args:
+        msisdns (list): The MSISDNs to perform the lookup for.
+
+    Returns:
+        A dict of the contact check result for each MSISDN
+    """
+    # Always lock in the same order, so that overlapping checks can't deadlock
+    msisdns = sorted(set(msisdns))
+    with ExitStack() as locks:
+        for msisdn in msisdns:
+            locks.enter_context(redis.lock(f"wacontact:{msisdn}", timeout=40))
+
+        results = {
+            msisdn: contact.api_format
+            for msisdn, contact in WhatsAppContact.objects.get_recent(msisdns).items()
+        }
+        missing = [m for m in msisdns if m not in results]
+        batch_size = settings.WHATSAPP_CONTACT_CHECK_BATCH_SIZE
+        batches = []
+        for start in range(0, len(missing), batch_size):
+            end = start + batch_size
+            batches.append(missing[start:end])
+
+        def check(batch):
+            response = utils.get_http_session().post(
+                urljoin(settings.ENGAGE_URL, "v1/contacts"),
+                json={"blocking": "wait", "contacts": batch},
+                headers={"Authorization": "Bearer {}".format(settings.ENGAGE_TOKEN)},
+                timeout=settings.WHATSAPP_CONTACT_CHECK_TIMEOUT,
+            )
+            response.raise_for_status()
+            return response.json()["contacts"]
+
+        contacts = []
+        if batches:
+            workers = min(
+                settings.WHATSAPP_CONTACT_CHECK_MAX_CONCURRENT_REQUESTS, len(batches)
+            )
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                for batch in pool.map(check, batches):
+                    for contact in batch:
+                        whatsapp_id = ""
+                        if contact["status"] == "valid":
+                            whatsapp_id = contact["wa_id"]
+                        contacts.append(
+                            WhatsAppContact(
+                                msisdn=contact["input"], whatsapp_id=whatsapp_id
+                            )
+                        )
+
+        WhatsAppContact.objects.upsert(contacts)
+    results.update({contact.msisdn: contact.api_format for contact in contacts})
+    return results
+
+
+@app.task(acks_late=True, soft_time_limit=240, time_limit=300)
+def prune_whatsapp_contacts():
+    """
+    Deletes contact check results older than 7 days, in batches of
+    WHATSAPP_CONTACT_PRUNE_BATCH_SIZE so that each delete only holds its locks
+    briefly. Stops after WHATSAPP_CONTACT_PRUNE_DURATION seconds, leaving anything
+    left over for the next run.
+
+    Returns:
+        The number of contacts deleted
+    """
+    cutoff = timezone.now() - timedelta(days=7)
+    deadline = time.monotonic() + settings.WHATSAPP_CONTACT_PRUNE_DURATION
+    batch_size = settings.WHATSAPP_CONTACT_PRUNE_BATCH_SIZE
+    total = 0
+    while time.monotonic() < deadline:
+        ids = list(
+            WhatsAppContact.objects.filter(created__lt=cutoff).values_list(
+                "id", flat=True
+            )[:batch_size]
+        )
+        if not ids:
+            break
+        deleted, _ = WhatsAppContact.objects.filter(id__in=ids).delete()
+        total += deleted
+    return total
+
+
+@app.task(soft_time_limit=10, time_limit=15)
+def refresh_engage_context_cache(msisdn):
+    """
+    Refreshes the cached Engage context identity and subscriptions for the MSISDN.
+    If the refresh fails, the stale entry is kept until the next refresh.
+
+    Args:
+        msisdn (str): The E164 MSISDN to refresh the context for
+    """
+    # The views import this module, so we can't import them at the top
+    from .views import EngageContextView
+
+    EngageContextView().refresh_cached_context(msisdn, refreshing=True)
+
+
 @app.task(
     autoretry_for=(RequestException, HTTPServiceError, SoftTimeLimitExceeded),
     retry_backoff=True,
@@ -1566,13 +1704,7 @@ def push_to_jembi_api(args):
     if not settings.ENABLE_JEMBI_EVENTS:
         return
     db_id, url, json_doc = args
-    r = requests.post(
-        url=urljoin(settings.JEMBI_BASE_URL, url),
-        headers={"Content-Type": "application/json"},
-        data=json.dumps(json_doc),
-        auth=(settings.JEMBI_USERNAME, settings.JEMBI_PASSWORD),
-        verify=False,
-    )
+    r = post_to_jembi(url, json_doc)
     r.raise_for_status()
     JembiSubmission.objects.filter(pk=db_id).update(
         submitted=True,
@@ -1582,15 +1714,117 @@ def push_to_jembi_api(args):
     )
 
 
-if settings.ENABLE_JEMBI_EVENTS:
+def post_to_jembi(url, json_doc):
+    return utils.get_http_session().post(
+        url=urljoin(settings.JEMBI_BASE_URL, url),
+        headers={"Content-Type": "application/json"},
+        data=json.dumps(json_doc),
+        auth=(settings.JEMBI_USERNAME, settings.JEMBI_PASSWORD),
+        verify=False,
+    )
+
+
+def submit_jembi_submissions(submissions):
+    """
+    Posts the JembiSubmissions to Jembi, with at most JEMBI_MAX_CONCURRENT_REQUESTS
+    requests at a time over the pooled HTTP session, and then saves all of the
+    responses in a single query.
+
+    Returns the number of submissions that were successfully submitted.
+    """
+    submissions = list(submissions)
+    if not submissions:
+        return 0
+
+    def submit(submission):
+        try:
+            return post_to_jembi(submission.path, submission.request_data)
+        except RequestException:
+            # Leave it to be retried in a later batch
+            return None
+
+    workers = min(settings.JEMBI_MAX_CONCURRENT_REQUESTS, len(submissions))
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        results = list(pool.map(submit, submissions))
+
+    submitted = 0
+    for submission, r in zip(submissions, results):
+        submission.claimed_until = None
+        if r is None:
+            continue
+        submission.submitted = r.ok
+        submission.response_status_code = r.status_code
+        submission.response_headers = dict(r.headers)
+        submission.response_body = r.text
+        submitted += r.ok
+
+    JembiSubmission.objects.bulk_update(
+        submissions,
+        fields=(
+            "submitted",
+            "response_status_code",
+            "response_headers",
+            "response_body",
+            "claimed_until",
+        ),
+    )
+    return submitted
+
+
+def claim_jembi_batch(size, timeout):
+    """
+    Claims the oldest `size` unsubmitted JembiSubmissions for `timeout` seconds, and
+    returns them. Claimed submissions are skipped by other batches, so the claim is
+    committed straight away, and the submissions can be posted outside of a
+    transaction.
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        # Skip rows locked by a concurrent claim, so that they get different rows
+        pks = list(
+            JembiSubmission.objects.filter(submitted=False)
+            .exclude(response_status_code__gte=400, response_status_code__lt=500)
+            .filter(Q(claimed_until__isnull=True) | Q(claimed_until__lt=now))
+            .order_by("pk")
+            .select_for_update(skip_locked=True)
+            .values_list("pk", flat=True)[:size]
+        )
+        JembiSubmission.objects.filter(pk__in=pks).update(
+            claimed_until=now + timedelta(seconds=timeout)
+        )
+    return JembiSubmission.objects.filter(pk__in=pks).order_by("pk")
+
+
+@app.task(acks_late=True, soft_time_limit=240, time_limit=300)
+def submit_jembi_batch():
+    """
+    Submits the oldest batch of JembiSubmissions that haven't been submitted yet.
+    Submissions that Jembi rejected as invalid are skipped, those can be resubmitted
+    with the jembi_submit_events command once they're fixed.
+    """
+    if not settings.ENABLE_JEMBI_EVENTS or not settings.ENABLE_JEMBI_BATCH_SUBMISSION:
+        return 0
+
+    # If this task is killed, the claim expires along with the time limit
+    submissions = claim_jembi_batch(
+        settings.JEMBI_BATCH_SIZE, submit_jembi_batch.time_limit
+    )
+    return submit_jembi_submissions(submissions)
+
+
+if settings.ENABLE_JEMBI_EVENTS and not settings.ENABLE_JEMBI_BATCH_SUBMISSION:
     request_to_jembi_api = store_jembi_request.s() | push_to_jembi_api.s()
 else:
+    # When batch submission is enabled, the submit_jembi_batch task submits them
     request_to_jembi_api = store_jembi_request.s()
 
 
 @app.task
 def delete_jembi_pii(msisdn):
-    JembiSubmission.objects.filter(request_data__cmsisdn=msisdn).delete()
+    # Compare as text, so that the lookup can use the request_data->>'cmsisdn' index
+    JembiSubmission.objects.annotate(
+        cmsisdn=KeyTextTransform("cmsisdn", "request_data")
+    ).filter(cmsisdn=msisdn).delete()
 
 
 @app.task(
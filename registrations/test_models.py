@@ -1,4 +1,7 @@
+from datetime import timedelta
+
 from django.test import TestCase
+from django.utils import timezone
 
 from registrations.models import Registration, WhatsAppContact
 
@@ -67,3 +70,41 @@ class WhatsAppContactTests(TestCase):
             contact.api_format,
             {"input": "+27820001001", "status": "valid", "wa_id": "27820001001"},
         )
+
+    def test_upsert(self):
+        """
+        upsert should create new contacts, and replace the result and created
+        timestamp of existing ones
+        """
+        existing = WhatsAppContact.objects.create(msisdn="+27820001001")
+        WhatsAppContact.objects.filter(pk=existing.pk).update(
+            created=timezone.now() - timedelta(days=8)
+        )
+
+        contacts = WhatsAppContact.objects.upsert(
+            [
+                WhatsAppContact(msisdn="+27820001001", whatsapp_id="27820001001"),
+                WhatsAppContact(msisdn="+27820001002"),
+            ]
+        )
+
+        self.assertEqual(contacts[0].id, existing.id)
+        self.assertEqual(WhatsAppContact.objects.count(), 2)
+        contact = WhatsAppContact.objects.get(msisdn="+27820001001")
+        self.assertEqual(contact.whatsapp_id, "27820001001")
+        self.assertGreater(contact.created, timezone.now() - timedelta(days=1))
+
+    def test_get_recent(self):
+        """
+        get_recent should only return results from the last 7 days
+        """
+        WhatsAppContact.objects.create(msisdn="+27820001001")
+        old = WhatsAppContact.objects.create(msisdn="+27820001002")
+        WhatsAppContact.objects.filter(pk=old.pk).update(
+            created=timezone.now() - timedelta(days=8)
+        )
+
+        contacts = WhatsAppContact.objects.get_recent(
+            ["+27820001001", "+27820001002", "+27820001003"]
+        )
+        self.assertEqual(list(contacts), ["+27820001001"])
@@ -1,4 +1,5 @@
 import json
+from datetime import timedelta
 from unittest import mock
 from urllib.parse import urlencode
 from uuid import uuid4
@@ -6,11 +7,13 @@ from uuid import uuid4
 import responses
 from django.contrib.auth.models import User
 from django.db.models.signals import post_save
-from django.test import TestCase
+from django.test import TestCase, override_settings
+from django.utils import timezone
 
 from ndoh_hub import utils_tests
 from registrations.models import (
     ClinicCode,
+    JembiSubmission,
     Registration,
     Source,
     SubscriptionRequest,
@@ -21,12 +24,18 @@ from registrations.signals import psh_validate_subscribe
 from registrations.tasks import (
     _create_rapidpro_clinic_registration,
     _create_rapidpro_public_registration,
+    claim_jembi_batch,
     create_rapidpro_clinic_registration,
     create_rapidpro_public_registration,
+    delete_jembi_pii,
     get_or_create_identity_from_msisdn,
     get_whatsapp_contact,
+    get_whatsapp_contacts,
     opt_in_identity,
+    prune_whatsapp_contacts,
     send_welcome_message,
+    submit_jembi_batch,
+    submit_jembi_submissions,
     update_identity_from_rapidpro_clinic_registration,
     update_identity_from_rapidpro_public_registration,
     validate_subscribe,
@@ -1137,6 +1146,123 @@ class GetWhatsAppContactTests(TestCase):
         self.assertEqual(contact.whatsapp_id, "27820001001")
 
 
+class GetWhatsAppContactsTests(TestCase):
+    def add_contacts_callback(self):
+        def callback(request):
+            contacts = json.loads(request.body)["contacts"]
+            results = [
+                {"input": m, "status": "valid", "wa_id": m.lstrip("+")}
+                if m.endswith("1")
+                else {"input": m, "status": "invalid"}
+                for m in contacts
+            ]
+            return (200, {}, json.dumps({"contacts": results}))
+
+        responses.add_callback(
+            responses.POST, "http://engage/v1/contacts", callback=callback
+        )
+
+    @override_settings(WHATSAPP_CONTACT_CHECK_BATCH_SIZE=2)
+    @responses.activate
+    def test_contacts_returned(self):
+        """
+        Should look up the contacts in batches, and save the results in the database
+        """
+        self.add_contacts_callback()
+
+        result = get_whatsapp_contacts(["+27820001001", "+27820001002", "+27820001003"])
+
+        self.assertEqual(
+            result,
+            {
+                "+27820001001": {
+                    "input": "+27820001001",
+                    "status": "valid",
+                    "wa_id": "27820001001",
+                },
+                "+27820001002": {"input": "+27820001002", "status": "invalid"},
+                "+27820001003": {"input": "+27820001003", "status": "invalid"},
+            },
+        )
+        self.assertEqual(
+            sorted(
+                json.loads(call.request.body)["contacts"] for call in responses.calls
+            ),
+            [["+27820001001", "+27820001002"], ["+27820001003"]],
+        )
+        self.assertEqual(
+            sorted(WhatsAppContact.objects.values_list("msisdn", "whatsapp_id")),
+            [
+                ("+27820001001", "27820001001"),
+                ("+27820001002", ""),
+                ("+27820001003", ""),
+            ],
+        )
+
+    @responses.activate
+    def test_existing_contacts_not_checked(self):
+        """
+        Contacts that were stored by another check, while we waited for the lock,
+        shouldn't be looked up again
+        """
+        self.add_contacts_callback()
+        WhatsAppContact.objects.create(msisdn="+27820001002", whatsapp_id="")
+
+        result = get_whatsapp_contacts(["+27820001001", "+27820001002"])
+
+        self.assertEqual(
+            result["+27820001002"], {"input": "+27820001002", "status": "invalid"}
+        )
+        [call] = responses.calls
+        self.assertEqual(json.loads(call.request.body)["contacts"], ["+27820001001"])
+
+    @mock.patch("registrations.tasks.redis")
+    @responses.activate
+    def test_contacts_locked(self, redis):
+        """
+        Should lock each contact while it's checked, always in the same order
+        """
+        self.add_contacts_callback()
+
+        get_whatsapp_contacts(["+27820001002", "+27820001001"])
+
+        self.assertEqual(
+            redis.lock.call_args_list,
+            [
+                mock.call("wacontact:+27820001001", timeout=40),
+                mock.call("wacontact:+27820001002", timeout=40),
+            ],
+        )
+
+
+class PruneWhatsAppContactsTests(TestCase):
+    @override_settings(WHATSAPP_CONTACT_PRUNE_BATCH_SIZE=2)
+    def test_prune(self):
+        """
+        Should delete all the contacts older than 7 days, in batches
+        """
+        contact = WhatsAppContact.objects.create(msisdn="+27820001001")
+        for i in range(2, 7):
+            old = WhatsAppContact.objects.create(msisdn=f"+2782000100{i}")
+            old.created = timezone.now() - timedelta(days=8)
+            old.save()
+
+        self.assertEqual(prune_whatsapp_contacts(), 5)
+        self.assertEqual(list(WhatsAppContact.objects.all()), [contact])
+
+    @override_settings(WHATSAPP_CONTACT_PRUNE_DURATION=0)
+    def test_prune_time_limit(self):
+        """
+        Should leave the remaining contacts for the next run once the time is up
+        """
+        old = WhatsAppContact.objects.create(msisdn="+27820001001")
+        old.created = timezone.now() - timedelta(days=8)
+        old.save()
+
+        self.assertEqual(prune_whatsapp_contacts(), 0)
+        self.assertEqual(WhatsAppContact.objects.count(), 1)
+
+
 class GetOrCreateIdentityFromMsisdnTaskTests(TestCase):
     @responses.activate
     def test_identity_exists(self):
@@ -1873,3 +1999,124 @@ class OptInIdentityTestCase(TestCase):
                 "requestor_source_id": source.id,
             },
         )
+
+
+class SubmitJembiSubmissionsTests(TestCase):
+    @responses.activate
+    def test_submissions_saved(self):
+        """
+        Should post each submission to Jembi, and save the responses
+        """
+        responses.add(responses.POST, "http://jembi/ws/rest/v1/ok", json={"ok": 1})
+        responses.add(responses.POST, "http://jembi/ws/rest/v1/bad", status=400)
+        ok = JembiSubmission.objects.create(path="ok", request_data={"test": "ok"})
+        bad = JembiSubmission.objects.create(path="bad", request_data={"test": "bad"})
+
+        self.assertEqual(submit_jembi_submissions([ok, bad]), 1)
+
+        ok.refresh_from_db()
+        self.assertTrue(ok.submitted)
+        self.assertEqual(ok.response_status_code, 200)
+        self.assertEqual(ok.response_body, '{"ok": 1}')
+        bad.refresh_from_db()
+        self.assertFalse(bad.submitted)
+        self.assertEqual(bad.response_status_code, 400)
+        self.assertEqual(
+            sorted(json.loads(c.request.body) for c in responses.calls),
+            [{"test": "bad"}, {"test": "ok"}],
+        )
+
+    @responses.activate
+    def test_connection_error(self):
+        """
+        Submissions that couldn't be posted should be left to be retried
+        """
+        s = JembiSubmission.objects.create(path="test", request_data={})
+
+        self.assertEqual(submit_jembi_submissions([s]), 0)
+
+        s.refresh_from_db()
+        self.assertFalse(s.submitted)
+        self.assertIsNone(s.response_status_code)
+
+    @override_settings(ENABLE_JEMBI_BATCH_SUBMISSION=True, JEMBI_BATCH_SIZE=1)
+    @responses.activate
+    def test_submit_batch(self):
+        """
+        Should submit the oldest unsubmitted batch, skipping invalid submissions
+        """
+        responses.add(responses.POST, "http://jembi/ws/rest/v1/test")
+        JembiSubmission.objects.create(path="test", request_data={}, submitted=True)
+        JembiSubmission.objects.create(
+            path="test", request_data={}, response_status_code=400
+        )
+        s1 = JembiSubmission.objects.create(path="test", request_data={})
+        s2 = JembiSubmission.objects.create(path="test", request_data={})
+
+        self.assertEqual(submit_jembi_batch(), 1)
+
+        s1.refresh_from_db()
+        self.assertTrue(s1.submitted)
+        s2.refresh_from_db()
+        self.assertFalse(s2.submitted)
+
+    def test_claim_batch(self):
+        """
+        Should skip submissions claimed by another batch, unless that claim expired
+        """
+        JembiSubmission.objects.create(
+            path="test",
+            request_data={},
+            claimed_until=timezone.now() + timedelta(minutes=5),
+        )
+        expired = JembiSubmission.objects.create(
+            path="test",
+            request_data={},
+            claimed_until=timezone.now() - timedelta(minutes=5),
+        )
+        new = JembiSubmission.objects.create(path="test", request_data={})
+
+        self.assertEqual(list(claim_jembi_batch(10, 300)), [expired, new])
+        self.assertEqual(list(claim_jembi_batch(10, 300)), [])
+        new.refresh_from_db()
+        self.assertGreater(new.claimed_until, timezone.now())
+
+    @responses.activate
+    def test_submission_claim_released(self):
+        """
+        Should release the claim on submissions, whether they were posted or not
+        """
+        responses.add(responses.POST, "http://jembi/ws/rest/v1/ok")
+        claim = timezone.now() + timedelta(minutes=5)
+        ok = JembiSubmission.objects.create(
+            path="ok", request_data={}, claimed_until=claim
+        )
+        error = JembiSubmission.objects.create(
+            path="error", request_data={}, claimed_until=claim
+        )
+
+        self.assertEqual(submit_jembi_submissions([ok, error]), 1)
+
+        ok.refresh_from_db()
+        self.assertIsNone(ok.claimed_until)
+        error.refresh_from_db()
+        self.assertIsNone(error.claimed_until)
+        self.assertFalse(error.submitted)
+
+    def test_submit_batch_disabled(self):
+        """
+        Should not submit anything unless batch submission is enabled
+        """
+        JembiSubmission.objects.create(path="test", request_data={})
+        self.assertEqual(submit_jembi_batch(), 0)
+
+
+class DeleteJembiPIITests(TestCase):
+    def test_delete_submissions(self):
+        """
+        Should delete only the submissions for the given MSISDN
+        """
+        JembiSubmission.objects.create(request_data={"cmsisdn": "+27820001001"})
+        other = JembiSubmission.objects.create(request_data={"cmsisdn": "+27820001002"})
+        delete_jembi_pii("+27820001001")
+        self.assertEqual(list(JembiSubmission.objects.all()), [other])
@@ -23,12 +23,14 @@ from temba_client.v2 import TembaClient
 
 from changes.models import Change
 from changes.signals import psh_validate_implement
+from ndoh_hub.utils import engage_context_cache
 from registrations.models import (
     ClinicCode,
     JembiSubmission,
     PositionTracker,
     Registration,
     Source,
+    SubscriptionSummary,
     WhatsAppContact,
 )
 from registrations.serializers import (
@@ -519,19 +521,47 @@ class EngageContextViewTests(APITestCase):
         h = hmac.new(key.encode(), data, sha256)
         return base64.b64encode(h.digest()).decode()
 
-    def test_get_identity_no_msisdn(self):
+    @responses.activate
+    def test_fetch_identity_no_results(self):
         """
-        If no msisdn is presented, then no request for the identity should be made.
+        If there are no results for the specifed MSISDN, then None should be returned
         """
-        self.assertIsNone(EngageContextView().get_identity(None))
+        self.add_identity_lookup_by_address_fixture(msisdn="+27820001001")
+        self.assertIsNone(EngageContextView().fetch_identity(msisdn="+27820001001"))
 
     @responses.activate
-    def test_get_identity_no_results(self):
+    def test_remote_context_identity_failure(self):
         """
-        If there are no results for the specifed MSISDN, then None should be returned
+        If the identity can't be fetched, then there should be no identity and no
+        subscriptions
         """
-        self.add_identity_lookup_by_address_fixture(msisdn="+27820001001")
-        self.assertIsNone(EngageContextView().get_identity(msisdn="+27820001001"))
+        responses.add(responses.GET, "http://is/api/v1/identities/search/", status=500)
+        self.assertEqual(
+            EngageContextView().get_remote_context("+27820001001"), (None, [])
+        )
+
+    @responses.activate
+    @override_settings(ENGAGE_CONTEXT_CACHE_TIMEOUT=60)
+    def test_remote_context_subscriptions_failure(self):
+        """
+        If only the subscriptions can't be fetched, then the identity should be
+        returned with no subscriptions, and not cached
+        """
+        self.addCleanup(engage_context_cache.invalidate, "mother-uuid")
+        self.add_identity_lookup_by_address_fixture(
+            msisdn="+27820001001",
+            identity_uuid="mother-uuid",
+            details={"faccode": "123456"},
+        )
+        responses.add(responses.GET, "http://sbm/api/v1/subscriptions/", status=500)
+
+        identity, subscriptions = EngageContextView().get_remote_context("+27820001001")
+
+        self.assertEqual(
+            identity, {"id": "mother-uuid", "details": {"faccode": "123456"}}
+        )
+        self.assertEqual(subscriptions, [])
+        self.assertIsNone(engage_context_cache.get("+27820001001"))
 
     def get_registrations_no_identity(self):
         """
@@ -1207,6 +1237,142 @@ class EngageContextViewTests(APITestCase):
         )
         self.assertTrue(change.validated)
 
+    def post_context(self, msisdn="+27820001001"):
+        data = {"chat": {"owner": msisdn}}
+        response = self.client.post(
+            reverse("engage-context"),
+            data,
+            format="json",
+            HTTP_X_ENGAGE_HOOK_SIGNATURE=self.generate_hmac_signature(
+                data, "hmac-secret"
+            ),
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response.json()["context_objects"]
+
+    @responses.activate
+    @override_settings(
+        ENGAGE_CONTEXT_HMAC_SECRET="hmac-secret",
+        ENGAGE_CONTEXT_CACHE_TIMEOUT=60,
+        ENGAGE_CONTEXT_CACHE_MAX_AGE=60,
+    )
+    def test_cached_context(self):
+        """
+        Should only fetch the identity and subscriptions once, until they are
+        invalidated
+        """
+        self.addCleanup(engage_context_cache.invalidate, "mother-uuid")
+        self.add_authorization_token()
+        self.add_identity_lookup_by_address_fixture(
+            msisdn="+27820001001", identity_uuid="mother-uuid", details={}
+        )
+        self.add_subscription_lookup(
+            identity_uuid="mother-uuid", subscriptions=["MomConnect Pregnancy WhatsApp"]
+        )
+
+        for _ in range(2):
+            context = self.post_context()
+            self.assertEqual(
+                context["subscriptions"], ["MomConnect Pregnancy WhatsApp"]
+            )
+        self.assertEqual(len(responses.calls), 2)
+
+        engage_context_cache.invalidate("mother-uuid")
+        self.post_context()
+        self.assertEqual(len(responses.calls), 4)
+
+    @responses.activate
+    @mock.patch("registrations.views.refresh_engage_context_cache")
+    @override_settings(
+        ENGAGE_CONTEXT_HMAC_SECRET="hmac-secret",
+        ENGAGE_CONTEXT_CACHE_TIMEOUT=60,
+        ENGAGE_CONTEXT_CACHE_MAX_AGE=0,
+    )
+    def test_stale_context(self, refresh):
+        """
+        Should serve stale context straight away, and refresh it in the background
+        """
+        self.addCleanup(engage_context_cache.invalidate, "mother-uuid")
+        self.addCleanup(engage_context_cache.finish_refresh, "+27820001001")
+        self.add_authorization_token()
+        engage_context_cache.set(
+            "+27820001001",
+            {"id": "mother-uuid", "details": {}},
+            ["MomConnect Pregnancy WhatsApp"],
+        )
+
+        context = self.post_context()
+        self.assertEqual(context["subscriptions"], ["MomConnect Pregnancy WhatsApp"])
+        self.assertEqual(len(responses.calls), 0)
+        refresh.delay.assert_called_once_with("+27820001001")
+
+    @responses.activate
+    @override_settings(ENGAGE_CONTEXT_CACHE_TIMEOUT=60)
+    def test_refresh_cached_context(self):
+        """
+        Should fetch the identity and subscriptions at the same time, and update the
+        cache
+        """
+        self.addCleanup(engage_context_cache.invalidate, "mother-uuid")
+        engage_context_cache.set(
+            "+27820001001", {"id": "mother-uuid", "details": {}}, []
+        )
+        self.add_identity_lookup_by_address_fixture(
+            msisdn="+27820001001", identity_uuid="mother-uuid", details={}
+        )
+        self.add_subscription_lookup(
+            identity_uuid="mother-uuid", subscriptions=["MomConnect Baby WhatsApp"]
+        )
+
+        EngageContextView().refresh_cached_context("+27820001001")
+
+        self.assertEqual(
+            engage_context_cache.get("+27820001001")["subscriptions"],
+            ["MomConnect Baby WhatsApp"],
+        )
+
+    @responses.activate
+    @override_settings(ENGAGE_CONTEXT_CACHE_TIMEOUT=60, ENGAGE_CONTEXT_CACHE_MAX_AGE=60)
+    def test_refresh_cached_context_keeps_other_refresh(self):
+        """
+        Fetching the context for a request shouldn't unmark a background refresh
+        that is in progress
+        """
+        self.addCleanup(engage_context_cache.invalidate, "mother-uuid")
+        self.addCleanup(engage_context_cache.finish_refresh, "+27820001001")
+        self.add_identity_lookup_by_address_fixture(
+            msisdn="+27820001001", identity_uuid="mother-uuid", details={}
+        )
+        self.add_subscription_lookup(identity_uuid="mother-uuid", subscriptions=[])
+        self.assertTrue(engage_context_cache.start_refresh("+27820001001"))
+
+        EngageContextView().refresh_cached_context("+27820001001")
+        self.assertFalse(engage_context_cache.start_refresh("+27820001001"))
+
+        EngageContextView().refresh_cached_context("+27820001001", refreshing=True)
+        self.assertTrue(engage_context_cache.start_refresh("+27820001001"))
+
+    @responses.activate
+    @override_settings(ENGAGE_CONTEXT_CACHE_TIMEOUT=60)
+    def test_refresh_cached_context_identity_fields(self):
+        """
+        Should only cache the identity details that the context uses
+        """
+        self.addCleanup(engage_context_cache.invalidate, "mother-uuid")
+        self.add_identity_lookup_by_address_fixture(
+            msisdn="+27820001001",
+            identity_uuid="mother-uuid",
+            details={"faccode": "123456", "sa_id_no": "8108015001051"},
+        )
+        self.add_subscription_lookup(identity_uuid="mother-uuid", subscriptions=[])
+
+        EngageContextView().refresh_cached_context("+27820001001")
+
+        self.assertEqual(
+            engage_context_cache.get("+27820001001")["identity"],
+            {"id": "mother-uuid", "details": {"faccode": "123456"}},
+        )
+
 
 class WhatsAppContactCheckViewTests(AuthenticatedAPITestCase):
     def setUp(self):
@@ -1230,7 +1396,7 @@ class WhatsAppContactCheckViewTests(AuthenticatedAPITestCase):
         response = self.normalclient.post(url)
         self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
 
-    @mock.patch("registrations.views.get_whatsapp_contact")
+    @mock.patch("registrations.views.get_whatsapp_contacts")
     def test_get_statuses(self, task):
         """
         Contacts without whatsapp IDs should return invalid, with IDs valid, and no
@@ -1239,7 +1405,7 @@ class WhatsAppContactCheckViewTests(AuthenticatedAPITestCase):
         url = reverse("whatsappcontact-list")
         WhatsAppContact.objects.create(msisdn="0820001001")
         WhatsAppContact.objects.create(msisdn="0820001002", whatsapp_id="27820001002")
-        task.return_value = {"input": "0820001003", "status": "invalid"}
+        task.return_value = {"0820001003": {"input": "0820001003", "status": "invalid"}}
 
         self.normaluser.user_permissions.add(
             Permission.objects.get(name="Can add WhatsApp Contact")
@@ -1261,7 +1427,7 @@ class WhatsAppContactCheckViewTests(AuthenticatedAPITestCase):
                 ]
             },
         )
-        task.assert_called_once_with(msisdn="0820001003")
+        task.assert_called_once_with(["0820001003"])
 
         task.reset_mock()
         response = self.normalclient.post(
@@ -1283,9 +1449,64 @@ class WhatsAppContactCheckViewTests(AuthenticatedAPITestCase):
         )
 
         task.assert_not_called()
-        task.delay.assert_called_once_with(msisdn="0820001003")
+        task.delay.assert_called_once_with(["0820001003"])
 
-    def test_prune_contacts_permission_required(self):
+    @mock.patch("registrations.views.get_whatsapp_contacts")
+    def test_get_statuses_expired(self, task):
+        """
+        Should look up contacts whose results are older than 7 days again, and look
+        up repeated contacts only once
+        """
+        url = reverse("whatsappcontact-list")
+        contact = WhatsAppContact.objects.create(msisdn="0820001001")
+        contact.created = timezone.now() - datetime.timedelta(days=8)
+        contact.save()
+        task.return_value = {
+            "0820001001": {
+                "input": "0820001001",
+                "status": "valid",
+                "wa_id": "27820001001",
+            }
+        }
+
+        self.normaluser.user_permissions.add(
+            Permission.objects.get(name="Can add WhatsApp Contact")
+        )
+        response = self.normalclient.post(
+            url, data={"blocking": "wait", "contacts": ["0820001001", "0820001001"]}
+        )
+        self.assertEqual(
+            json.loads(response.content),
+            {
+                "contacts": [
+                    {"input": "0820001001", "status": "valid", "wa_id": "27820001001"},
+                    {"input": "0820001001", "status": "valid", "wa_id": "27820001001"},
+                ]
+            },
+        )
+        task.assert_called_once_with(["0820001001"])
+
+    @mock.patch("registrations.views.get_whatsapp_contacts")
+    def test_get_statuses_missing_result(self, task):
+        """
+        If the API doesn't return a result for a contact, it should be failed
+        """
+        url = reverse("whatsappcontact-list")
+        task.return_value = {}
+
+        self.normaluser.user_permissions.add(
+            Permission.objects.get(name="Can add WhatsApp Contact")
+        )
+        response = self.normalclient.post(
+            url, data={"blocking": "wait", "contacts": ["0820001001"]}
+        )
+        self.assertEqual(
+            json.loads(response.content),
+            {"contacts": [{"input": "0820001001", "status": "failed"}]},
+        )
+
+    @mock.patch("registrations.views.prune_whatsapp_contacts")
+    def test_prune_contacts_permission_required(self, task):
         """
         You need to be authenticated and have the correct permission to be able to prune
         whatsapp contacts from the database
@@ -1298,30 +1519,20 @@ class WhatsAppContactCheckViewTests(AuthenticatedAPITestCase):
             Permission.objects.get(name="Can prune WhatsApp contact")
         )
         response = self.normalclient.post(url)
-        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
 
-    def test_prune_contacts(self):
+    @mock.patch("registrations.views.prune_whatsapp_contacts")
+    def test_prune_contacts(self, task):
         """
-        The prune action should delete all contacts older than 7 days from the database
+        The prune action should queue the task to delete old contacts
         """
-        contact1 = WhatsAppContact.objects.create(
-            msisdn="0820001001", whatsapp_id="27820001001"
-        )
-        contact2 = WhatsAppContact.objects.create(
-            msisdn="0820001002", whatsapp_id="27820001002"
-        )
-        contact2.created = timezone.now() - datetime.timedelta(days=7)
-        contact2.save()
-
         self.normaluser.user_permissions.add(
             Permission.objects.get(name="Can prune WhatsApp contact")
         )
         url = reverse("whatsappcontact-prune")
         response = self.normalclient.post(url)
-        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
-
-        [contact] = WhatsAppContact.objects.all()
-        self.assertEqual(contact, contact1)
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        task.delay.assert_called_once_with()
 
 
 class SubscriptionCheckViewTests(APITestCase):
@@ -1585,6 +1796,56 @@ class SubscriptionCheckViewTests(APITestCase):
             {"subscription_status": "none", "opted_out": False},
         )
 
+    @override_settings(SUBSCRIPTION_CHECK_CACHE_TIMEOUT=60)
+    @mock.patch("registrations.views.SubscriptionCheckView.get_identity")
+    @mock.patch("registrations.views.SubscriptionCheckView.get_subscriptions")
+    def test_get_cached(self, get_subscriptions, get_identity):
+        """
+        Should cache the response for the msisdn until the identity changes
+        """
+        SubscriptionSummary.invalidate_responses("test-identity-uuid")
+        get_subscriptions.return_value = ["whatsapp_momconnect_prebirth.hw_full.1"]
+        get_identity.return_value = {"id": "test-identity-uuid"}
+        user = User.objects.create_user("test")
+        user.user_permissions.add(
+            Permission.objects.get(name="Can perform a subscription check")
+        )
+        self.client.force_authenticate(user)
+        url = "{}?{}".format(
+            reverse("subscription-check"), urlencode({"msisdn": "+27820001001"})
+        )
+        expected = {
+            "subscription_status": "clinic",
+            "opted_out": False,
+            "subscription_description": "",
+        }
+
+        for _ in range(2):
+            response = self.client.get(url)
+            self.assertEqual(json.loads(response.content), expected)
+        get_identity.assert_called_once_with("+27820001001")
+
+        SubscriptionSummary.invalidate_responses("test-identity-uuid")
+        response = self.client.get(url)
+        self.assertEqual(json.loads(response.content), expected)
+        self.assertEqual(get_identity.call_count, 2)
+        SubscriptionSummary.invalidate_responses("test-identity-uuid")
+
+    @override_settings(SUBSCRIPTION_CHECK_CACHE_TIMEOUT=60)
+    def test_invalidate_all_msisdns(self):
+        """
+        Should remove the cached responses for all of the identity's MSISDNs
+        """
+        SubscriptionSummary.invalidate_responses("test-identity-uuid")
+        for msisdn in ("+27820001001", "+27820001002"):
+            SubscriptionSummary.cache_response("test-identity-uuid", msisdn, {})
+            self.assertEqual(SubscriptionSummary.get_cached_response(msisdn), {})
+
+        SubscriptionSummary.invalidate_responses("test-identity-uuid")
+
+        for msisdn in ("+27820001001", "+27820001002"):
+            self.assertIsNone(SubscriptionSummary.get_cached_response(msisdn))
+
 
 class GetSubscriptionDescriptionTests(AuthenticatedAPITestCase):
     def setUp(self):
@@ -2198,3 +2459,29 @@ class NCSubscriptionViewTests(APITestCase):
 
         [call] = responses.calls
         self.assertEqual(json.loads(call.request.body), body)
+
+    def test_get_subscription_description_updated(self):
+        """
+        The description should be updated when a new registration is validated
+        """
+        now = datetime.datetime.now(tz=UTC)
+        identity_id = str(uuid4())
+        source = self.make_source_adminuser()
+
+        view = SubscriptionCheckView()
+        self.assertEqual(view.get_subscription_description(identity_id), "")
+
+        registration = Registration.objects.create(
+            registrant_id=identity_id,
+            reg_type="momconnect_prebirth",
+            data={"edd": "{:%Y-%m-%d}".format(now + datetime.timedelta(weeks=3))},
+            source=source,
+        )
+        self.assertEqual(view.get_subscription_description(identity_id), "")
+
+        registration.validated = True
+        registration.save()
+        self.assertEqual(
+            view.get_subscription_description(identity_id),
+            "baby born on {:%Y-%m-%d}".format(now + datetime.timedelta(weeks=3)),
+        )
@@ -3,7 +3,7 @@ import datetime
 import hmac
 import json
 import logging
-from functools import partial
+from concurrent.futures import ThreadPoolExecutor
 from hashlib import sha256
 from typing import Tuple
 from uuid import UUID
@@ -50,7 +50,13 @@ from seed_services_client.stage_based_messaging import StageBasedMessagingApiCli
 from changes.models import Change
 from changes.serializers import ChangeSerializer
 from eventstore.models import ExternalRegistrationID
-from ndoh_hub.utils import get_available_metrics, is_client, sbm_client
+from ndoh_hub.utils import (
+    engage_context_cache,
+    get_available_metrics,
+    is_client,
+    messageset_catalogue,
+    sbm_client,
+)
 
 from .models import (
     ClinicCode,
@@ -58,6 +64,7 @@ from .models import (
     PositionTracker,
     Registration,
     Source,
+    SubscriptionSummary,
     WhatsAppContact,
 )
 from .serializers import (
@@ -86,7 +93,9 @@ from .serializers import (
 from .tasks import (
     create_rapidpro_clinic_registration,
     create_rapidpro_public_registration,
-    get_whatsapp_contact,
+    get_whatsapp_contacts,
+    prune_whatsapp_contacts,
+    refresh_engage_context_cache,
     request_to_jembi_api,
     submit_jembi_registration_to_rapidpro,
     submit_third_party_registration_to_rapidpro,
@@ -445,10 +454,6 @@ class ThirdPartyRegistration(APIView):
             return self._post(request)
 
     def _post(self, request):
-        is_client = IdentityStoreApiClient(
-            api_url=settings.IDENTITY_STORE_URL,
-            auth_token=settings.IDENTITY_STORE_TOKEN,
-        )
         serializer = ThirdPartyRegistrationSerializer(data=request.data)
         if serializer.is_valid():
             mom_msisdn = serializer.validated_data["mom_msisdn"]
@@ -808,17 +813,6 @@ class EngageContextView(EngageBaseView, generics.CreateAPIView):
             data["chat"]["owner"], phonenumbers.PhoneNumberFormat.E164
         )
 
-    def get_identity(self, msisdn):
-        """
-        Gets the identity for the msisdn, if exists, otherwise returns None
-        """
-        try:
-            identity = self.identity_store.get_identity_by_address("msisdn", msisdn)
-            return next(identity["results"])
-        # Catch both no results and HTTP errors
-        except (StopIteration, RequestException):
-            return None
-
     def get_registrations(self, identity):
         """
         Gets the list of registrations for the identity, ordered from oldest to newest.
@@ -833,33 +827,123 @@ class EngageContextView(EngageBaseView, generics.CreateAPIView):
             "created_at"
         )
 
-    def lookup_field_from_dictionaries(self, field, *dictionaries):
+    def fetch_identity(self, msisdn):
         """
-        Given a field and one or more dictionaries, returns the first match that it
-        finds, or None if no match is found
+        Gets the identity for the msisdn, or None if it doesn't exist. Raises
+        RequestException on HTTP errors.
         """
-        for dictionary in dictionaries:
-            if field in dictionary:
-                return dictionary[field]
+        identity = self.identity_store.get_identity_by_address("msisdn", msisdn)
+        return next(identity["results"], None)
+
+    def fetch_subscriptions(self, identity_id):
+        """
+        Gets the active subscription labels for the identity. Raises RequestException
+        on HTTP errors.
+        """
+        subscriptions = self.stage_based_messaging.get_subscriptions(
+            {"identity": identity_id, "active": True}
+        )
+        return [sub["messageset_label"] for sub in subscriptions["results"]]
 
-    def get_subscriptions(self, identity):
+    def try_fetch_subscriptions(self, identity_id):
         """
-        Gets the list of active subscription labels for the given identity. If there
-        is no identity, returns an empty list
+        Gets the active subscription labels for the identity, or None if they can't
+        be fetched
         """
         try:
-            identity_id = identity["id"]
-        except (KeyError, TypeError):
-            return []
+            return self.fetch_subscriptions(identity_id)
+        except RequestException:
+            return None
+
+    def fetch_remote_context(self, msisdn, identity_id=None):
+        """
+        Fetches the identity and subscriptions for the msisdn. If we already know the
+        identity ID, both are fetched at the same time. Raises RequestException on
+        HTTP errors for the identity. The subscriptions are None if they can't be
+        fetched.
+        """
+        if identity_id is None:
+            identity = self.fetch_identity(msisdn)
+            if identity is None:
+                return None, []
+            return identity, self.try_fetch_subscriptions(identity["id"])
+
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            identity = pool.submit(self.fetch_identity, msisdn)
+            subscriptions = pool.submit(self.try_fetch_subscriptions, identity_id)
+            identity, subscriptions = identity.result(), subscriptions.result()
+        if identity is None:
+            return None, []
+        if identity["id"] != identity_id:
+            # The msisdn has moved to another identity since it was cached
+            subscriptions = self.try_fetch_subscriptions(identity["id"])
+        return identity, subscriptions
 
+    def context_identity(self, identity):
+        """
+        Returns only the parts of the identity that the context uses, so that we
+        don't cache the rest of its personal information
+        """
+        details = identity.get("details", {})
+        return {
+            "id": identity["id"],
+            "details": {
+                field: details[field]
+                for field, _ in self.LOOKUP_FIELDS
+                if field in details
+            },
+        }
+
+    def refresh_cached_context(self, msisdn, refreshing=False):
+        """
+        Fetches the identity and subscriptions for the msisdn and stores them in the
+        cache, as long as the fetch succeeds. If only the subscriptions can't be
+        fetched, returns the identity with no subscriptions, without caching it.
+
+        `refreshing` should be True if the caller marked the msisdn as being
+        refreshed with `start_refresh`, so that the mark is removed when we're done.
+        """
         try:
-            subscriptions = self.stage_based_messaging.get_subscriptions(
-                {"identity": identity_id, "active": True}
-            )
-            return [sub["messageset_label"] for sub in subscriptions["results"]]
+            entry = engage_context_cache.get(msisdn)
+            identity_id = entry["identity"]["id"] if entry else None
+            identity, subscriptions = self.fetch_remote_context(msisdn, identity_id)
+            if identity is None:
+                return None, []
+            identity = self.context_identity(identity)
+            if subscriptions is None:
+                return identity, []
+            engage_context_cache.set(msisdn, identity, subscriptions)
+            return identity, subscriptions
+        finally:
+            if refreshing:
+                engage_context_cache.finish_refresh(msisdn)
+
+    def get_remote_context(self, msisdn):
+        """
+        Gets the identity and subscriptions for the msisdn, from the cache if we have
+        them, refreshing them in the background if they're stale. If they aren't
+        cached and we can't fetch them, returns no identity and no subscriptions.
+        """
+        entry = engage_context_cache.get(msisdn)
+        if entry is not None:
+            if not entry["fresh"] and engage_context_cache.start_refresh(msisdn):
+                refresh_engage_context_cache.delay(msisdn)
+            return entry["identity"], entry["subscriptions"]
+
+        try:
+            return self.refresh_cached_context(msisdn)
         except RequestException:
             # Catch HTTP errors and fail in a clean way
-            return []
+            return None, []
+
+    def lookup_field_from_dictionaries(self, field, *dictionaries):
+        """
+        Given a field and one or more dictionaries, returns the first match that it
+        finds, or None if no match is found
+        """
+        for dictionary in dictionaries:
+            if field in dictionary:
+                return dictionary[field]
 
     def extract_registration_info(self, identity, registrations):
         """
@@ -1019,13 +1103,12 @@ class EngageContextView(EngageBaseView, generics.CreateAPIView):
         context = {"mother_details": {}, "subscriptions": []}
 
         msisdn = self.get_msisdn(serializer.validated_data)
-        identity = self.get_identity(msisdn)
+        identity, subscriptions = self.get_remote_context(msisdn)
         registrations = self.get_registrations(identity)
         info = self.extract_registration_info(identity, registrations)
         if info:
             context["mother_details"] = info
 
-        subscriptions = self.get_subscriptions(identity)
         if subscriptions:
             context["subscriptions"] = subscriptions
 
@@ -1089,40 +1172,46 @@ class WhatsAppContactCheckViewSet(mixins.CreateModelMixin, viewsets.GenericViewS
     serializer_class = WhatsAppContactCheckSerializer
     queryset = WhatsAppContact.objects.all()
 
-    def get_status(self, blocking, msisdn):
-        msisdn = msisdn.raw_input
-        try:
-            contact = WhatsAppContact.objects.filter(
-                created__gt=timezone.now() - datetime.timedelta(days=7), msisdn=msisdn
-            ).latest("created")
-            return contact.api_format
-        except WhatsAppContact.DoesNotExist:
-            if blocking == "wait":
-                # We'll have to do this request in-process, since we have no choice
-                return get_whatsapp_contact(msisdn=msisdn)
-            else:
-                get_whatsapp_contact.delay(msisdn=msisdn)
-                return {"input": msisdn, "status": "processing"}
-
     def create(self, request):
         serializer = self.get_serializer(data=request.data)
         serializer.is_valid(raise_exception=True)
         data = serializer.validated_data
 
-        results = map(partial(self.get_status, data["blocking"]), data["contacts"])
-        return Response({"contacts": results}, status=status.HTTP_201_CREATED)
+        msisdns = [msisdn.raw_input for msisdn in data["contacts"]]
+        results = {
+            msisdn: contact.api_format
+            for msisdn, contact in WhatsAppContact.objects.get_recent(msisdns).items()
+        }
+        # Deduplicate, keeping the order
+        missing = [m for m in dict.fromkeys(msisdns) if m not in results]
+        if missing and data["blocking"] == "wait":
+            # We'll have to do this request in-process, since we have no choice
+            results.update(get_whatsapp_contacts(missing))
+        elif missing:
+            get_whatsapp_contacts.delay(missing)
+            results.update({m: {"input": m, "status": "processing"} for m in missing})
+
+        # In case the API didn't return a result for one of the contacts
+        return Response(
+            {
+                "contacts": [
+                    results.get(msisdn, {"input": msisdn, "status": "failed"})
+                    for msisdn in msisdns
+                ]
+            },
+            status=status.HTTP_201_CREATED,
+        )
 
     @action(
         detail=False, methods=["post"], permission_classes=[PruneContactsPermission]
     )
     def prune(self, request):
         """
-        Prunes any contacts older than 7 days in the database
+        Queues a task to prune any contacts older than 7 days in the database. This
+        also happens periodically, so there's usually no need to call this.
         """
-        WhatsAppContact.objects.filter(
-            created__lt=timezone.now() - datetime.timedelta(days=7)
-        ).delete()
-        return Response(status=status.HTTP_204_NO_CONTENT)
+        prune_whatsapp_contacts.delay()
+        return Response(status=status.HTTP_202_ACCEPTED)
 
 
 class FacilityCodeCheckView(APIView):
@@ -1171,103 +1260,33 @@ class SubscriptionCheckView(APIView):
         except (RequestException, HTTPServiceError):
             raise ServiceUnavailable()
 
-    def _get_messagesets(self):
+    def get_messagesets(self):
         try:
-            return {
-                ms["id"]: ms["short_name"]
-                for ms in sbm_client.get_messagesets()["results"]
-            }
+            return messageset_catalogue.get_messageset_short_names()
         except (RequestException, HTTPServiceError):
             raise ServiceUnavailable()
 
-    def get_messagesets(self):
-        return cache.get_or_set("messagesets", self._get_messagesets, 300)
-
-    def get_subscriptions(self, identity_id):
-        messagesets = self.get_messagesets()
+    def get_active_subscriptions(self, identity_id):
         try:
-            subscriptions = sbm_client.get_subscriptions(
+            return sbm_client.get_subscriptions(
                 {"identity": identity_id, "active": True}
             )["results"]
-            return [messagesets[s["messageset"]] for s in subscriptions]
         except (RequestException, HTTPServiceError):
             raise ServiceUnavailable()
 
+    def get_subscriptions(self, identity_id):
+        # Fetch the messagesets and the subscriptions at the same time
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            messagesets = pool.submit(self.get_messagesets)
+            subscriptions = pool.submit(self.get_active_subscriptions, identity_id)
+            messagesets, subscriptions = messagesets.result(), subscriptions.result()
+        return [messagesets[s["messageset"]] for s in subscriptions]
+
     def get_subscription_description(self, identity_id: str) -> str:
         """
         Gets a human readable string of the details of the current subscriptions
         """
-        try:
-            last_optout = Change.objects.filter(
-                registrant_id=identity_id,
-                action__in=(
-                    "baby_switch",
-                    "pmtct_loss_switch",
-                    "pmtct_loss_optout",
-                    "pmtct_nonloss_optout",
-                    "momconnect_loss_switch",
-                    "momconnect_loss_optout",
-                    "momconnect_nonloss_optout",
-                ),
-                validated=True,
-            ).latest("created_at")
-            last_optout = last_optout.created_at
-        except Change.DoesNotExist:
-            last_optout = timezone.utc.localize(datetime.datetime.min)
-        try:
-            last_baby_switch = Change.objects.filter(
-                registrant_id=identity_id, action="baby_switch", validated=True
-            ).latest("created_at")
-            last_baby_switch = last_baby_switch.created_at
-        except Change.DoesNotExist:
-            last_baby_switch = timezone.utc.localize(datetime.datetime.min)
-
-        registrations = Registration.objects.filter(
-            registrant_id=identity_id,
-            reg_type__in=(
-                "momconnect_prebirth",
-                "momconnect_postbirth",
-                "whatsapp_prebirth",
-                "whatsapp_postbirth",
-            ),
-            created_at__gte=max((last_optout, last_baby_switch)),
-            validated=True,
-        )
-        changes = Change.objects.filter(
-            registrant_id=identity_id,
-            action="baby_switch",
-            created_at__gte=last_optout,
-            validated=True,
-        )
-        subscriptions = []
-        for registration in registrations:
-            try:
-                edd = datetime.datetime.strptime(
-                    registration.data["edd"], "%Y-%m-%d"
-                ).replace(tzinfo=timezone.utc)
-                if edd < timezone.now():
-                    # Messaging continues for 2 weeks after edd before being switched
-                    edd += datetime.timedelta(weeks=2)
-                subscriptions.append(edd)
-            except KeyError:
-                pass
-            try:
-                baby_dob = datetime.datetime.strptime(
-                    registration.data["baby_dob"], "%Y-%m-%d"
-                ).replace(tzinfo=timezone.utc)
-                subscriptions.append(baby_dob)
-            except KeyError:
-                pass
-        for change in changes:
-            subscriptions.append(change.created_at)
-        subscriptions.sort()
-        # Filter out expired subscriptions
-        subs = filter(
-            lambda s: s > timezone.now() - datetime.timedelta(weeks=37 + 104),
-            subscriptions,
-        )
-        texts = map(lambda s: "baby born on {:%Y-%m-%d}".format(s), subs)
-        return ", ".join(texts)
+        return SubscriptionSummary.objects.get_or_refresh(identity_id).description
 
     def derive_subscription_status(self, subscriptions):
         for subscription in subscriptions:
@@ -1295,20 +1314,24 @@ class SubscriptionCheckView(APIView):
         serializer = SubscriptionsCheckSerializer(data=request.query_params)
         serializer.is_valid(raise_exception=True)
         msisdn = self.get_msisdn(serializer.validated_data)
+        cached = SubscriptionSummary.get_cached_response(msisdn)
+        if cached is not None:
+            return Response(cached)
         identity = self.get_identity(msisdn)
         if identity is None:
+            # Not cached, so that a registration shows up on the next check
             return Response({"subscription_status": "none", "opted_out": False})
         subscriptions = self.get_subscriptions(identity["id"])
         subscription_status = self.derive_subscription_status(subscriptions)
         opted_out = self.derive_optout_status(identity, msisdn)
         subscription_description = self.get_subscription_description(identity["id"])
-        return Response(
-            {
-                "subscription_status": subscription_status,
-                "opted_out": opted_out,
-                "subscription_description": subscription_description,
-            }
-        )
+        data = {
+            "subscription_status": subscription_status,
+            "opted_out": opted_out,
+            "subscription_description": subscription_description,
+        }
+        SubscriptionSummary.cache_response(identity["id"], msisdn, data)
+        return Response(data)
 
 
 class RapidProClinicRegistrationView(generics.CreateAPIView):
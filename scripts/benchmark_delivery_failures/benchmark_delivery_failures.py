@@ -0,0 +1,156 @@
+"""
+Times recording SMS delivery failures and storing batches of messages with the
+upsert queries, against the get_or_create/update_or_create path that they replaced,
+and counts the failures that each path loses under concurrent writes
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", ".."))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "ndoh_hub.settings")
+
+import django  # noqa: E402
+
+django.setup()
+
+from django.db import connection  # noqa: E402
+from django.utils import timezone  # noqa: E402
+
+from eventstore.models import DeliveryFailure, Message  # noqa: E402
+
+CREATED_BY = "benchmark_delivery_failures"
+CONTACT_PREFIX = "2789999"
+
+
+def timed(func, *args):
+    start = time.monotonic()
+    func(*args)
+    return time.monotonic() - start
+
+
+def record_failure_upsert(contact_id, timestamp):
+    DeliveryFailure.objects.record_failure(contact_id, timestamp)
+
+
+def record_failure_get_or_create(contact_id, timestamp):
+    df, created = DeliveryFailure.objects.get_or_create(
+        contact_id=contact_id, defaults={"number_of_failures": 0}
+    )
+    if not created and (timestamp - df.timestamp).days <= 0:
+        return
+    df.number_of_failures += 1
+    df.save()
+
+
+def messages(batch, size):
+    return [
+        Message(
+            id=f"{CREATED_BY}-{batch}-{i}",
+            contact_id=f"{CONTACT_PREFIX}{i:04d}",
+            message_direction=Message.INBOUND,
+            created_by=CREATED_BY,
+            data={"text": {"body": "hi"}},
+        )
+        for i in range(size)
+    ]
+
+
+def store_messages_upsert(batch, size):
+    Message.objects.bulk_upsert(messages(batch, size))
+
+
+def store_messages_update_or_create(batch, size):
+    for msg in messages(batch, size):
+        Message.objects.update_or_create(
+            id=msg.id,
+            defaults={
+                "contact_id": msg.contact_id,
+                "message_direction": msg.message_direction,
+                "created_by": msg.created_by,
+                "data": msg.data,
+            },
+        )
+
+
+def concurrent_failures(func, threads, failures):
+    """
+    Records `failures` failures, each on a different day, for a single contact from
+    `threads` threads at once, and returns the number of failures that were counted
+    """
+    contact_id = f"{CONTACT_PREFIX}0000"
+    DeliveryFailure.objects.filter(contact_id=contact_id).delete()
+    # Every failure is at least a day after the stored timestamp, so all count
+    timestamp = timezone.now() + timedelta(days=2)
+
+    def record(_):
+        try:
+            func(contact_id, timestamp)
+        finally:
+            connection.close()
+
+    with ThreadPoolExecutor(threads) as pool:
+        list(pool.map(record, range(failures)))
+    return DeliveryFailure.objects.get(contact_id=contact_id).number_of_failures
+
+
+def report(name, latencies):
+    latencies.sort()
+    p99 = latencies[min(int(len(latencies) * 0.99), len(latencies) - 1)]
+    print(
+        f"{name}: mean {statistics.mean(latencies) * 1000:.2f}ms, "
+        f"p99 {p99 * 1000:.2f}ms"
+    )
+
+
+def cleanup():
+    DeliveryFailure.objects.filter(contact_id__startswith=CONTACT_PREFIX).delete()
+    Message.objects.filter(created_by=CREATED_BY).delete()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--failures", type=int, default=10000)
+    parser.add_argument("--batches", type=int, default=200)
+    parser.add_argument("--batch-size", type=int, default=100)
+    parser.add_argument("--threads", type=int, default=8)
+    args = parser.parse_args()
+
+    try:
+        for name, func in (
+            ("get_or_create", record_failure_get_or_create),
+            ("record_failure", record_failure_upsert),
+        ):
+            cleanup()
+            timestamp = timezone.now() + timedelta(days=2)
+            # Half new contacts, and half existing contacts
+            half = args.failures // 2
+            report(
+                f"{name} failure",
+                [
+                    timed(func, f"{CONTACT_PREFIX}{i % half:04d}", timestamp)
+                    for i in range(args.failures)
+                ],
+            )
+            counted = concurrent_failures(func, args.threads, args.failures // 10)
+            print(
+                f"{name} concurrent: counted {counted} of "
+                f"{args.failures // 10} failures"
+            )
+
+        for name, func in (
+            ("update_or_create", store_messages_update_or_create),
+            ("bulk_upsert", store_messages_upsert),
+        ):
+            cleanup()
+            # Every batch is stored twice, to time both inserts and updates
+            report(
+                f"{name} batch of {args.batch_size}",
+                [timed(func, b // 2, args.batch_size) for b in range(args.batches * 2)],
+            )
+    finally:
+        cleanup()
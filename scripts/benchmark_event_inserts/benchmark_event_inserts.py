@@ -0,0 +1,93 @@
+"""
+Times inserting batches of events, and the common queries on the events table
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+from datetime import timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", ".."))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "ndoh_hub.settings")
+
+import django  # noqa: E402
+
+django.setup()
+
+from django.utils import timezone  # noqa: E402
+
+from eventstore.models import Event  # noqa: E402
+
+CREATED_BY = "benchmark_event_inserts"
+
+
+def timed(func, *args):
+    start = time.monotonic()
+    func(*args)
+    return time.monotonic() - start
+
+
+def insert_batch(batch, size):
+    Event.objects.bulk_create(
+        Event(
+            message_id=f"{CREATED_BY}-{batch}-{i}",
+            recipient_id=f"2782{batch:04d}{i:03d}",
+            status=Event.DELIVERED,
+            created_by=CREATED_BY,
+        )
+        for i in range(size)
+    )
+
+
+def report(name, latencies):
+    latencies.sort()
+    p99 = latencies[min(int(len(latencies) * 0.99), len(latencies) - 1)]
+    print(
+        f"{name}: mean {statistics.mean(latencies) * 1000:.1f}ms, "
+        f"p99 {p99 * 1000:.1f}ms"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--batches", type=int, default=1000)
+    parser.add_argument("--batch-size", type=int, default=100)
+    args = parser.parse_args()
+
+    try:
+        report(
+            "insert batch",
+            [timed(insert_batch, b, args.batch_size) for b in range(args.batches)],
+        )
+        report(
+            "lookup by message id",
+            [
+                timed(
+                    lambda b: list(
+                        Event.objects.filter(message_id=f"{CREATED_BY}-{b}-0")
+                    ),
+                    b,
+                )
+                for b in range(args.batches)
+            ],
+        )
+        report(
+            "lookup by recipient id",
+            [
+                timed(
+                    lambda b: list(
+                        Event.objects.filter(recipient_id=f"2782{b:04d}000")
+                    ),
+                    b,
+                )
+                for b in range(args.batches)
+            ],
+        )
+        since = timezone.now() - timedelta(days=1)
+        report(
+            "count last day",
+            [timed(lambda: Event.objects.filter(timestamp__gte=since).count())],
+        )
+    finally:
+        Event.objects.filter(created_by=CREATED_BY).delete()
@@ -0,0 +1,105 @@
+"""
+Fills the eventstore with fake contacts, and reports how long erasing the PII of a
+sample of those contacts takes
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import time
+import uuid
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", ".."))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "ndoh_hub.settings")
+
+import django  # noqa: E402
+
+django.setup()
+
+from eventstore.models import Event, Message, OptOut, PublicRegistration  # noqa
+from eventstore.tasks import delete_contact_pii  # noqa: E402
+
+CREATED_BY = "benchmark_forget_contact"
+
+
+def create_contacts(count, messages_per_contact, batch_size=1000):
+    contacts = []
+    for start in range(0, count, batch_size):
+        batch = [
+            (str(uuid.uuid4()), f"2782{i:07d}")
+            for i in range(start, min(start + batch_size, count))
+        ]
+        PublicRegistration.objects.bulk_create(
+            PublicRegistration(
+                contact_id=c,
+                device_contact_id=c,
+                source="benchmark",
+                language="eng",
+                channel="WhatsApp",
+                created_by=CREATED_BY,
+                data={"msisdn": f"+{m}"},
+            )
+            for c, m in batch
+        )
+        OptOut.objects.bulk_create(
+            OptOut(contact_id=c, created_by=CREATED_BY, data={"msisdn": f"+{m}"})
+            for c, m in batch
+        )
+        Message.objects.bulk_create(
+            Message(
+                id=f"{CREATED_BY}-{m}-{i}",
+                contact_id=m,
+                created_by=CREATED_BY,
+                data={"text": {"body": "hi"}},
+            )
+            for c, m in batch
+            for i in range(messages_per_contact)
+        )
+        Event.objects.bulk_create(
+            Event(
+                message_id=f"{CREATED_BY}-{m}-{i}",
+                recipient_id=m,
+                status=Event.DELIVERED,
+                created_by=CREATED_BY,
+            )
+            for c, m in batch
+            for i in range(messages_per_contact)
+        )
+        contacts.extend(batch)
+    return contacts
+
+
+def cleanup():
+    for model in (PublicRegistration, OptOut, Message, Event):
+        model.objects.filter(created_by=CREATED_BY).delete()
+
+
+def percentile(values, p):
+    return values[min(int(len(values) * p / 100), len(values) - 1)]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--contacts", type=int, default=10000)
+    parser.add_argument("--messages-per-contact", type=int, default=10)
+    parser.add_argument("--samples", type=int, default=100)
+    args = parser.parse_args()
+
+    try:
+        print(f"Creating {args.contacts} contacts...")
+        contacts = create_contacts(args.contacts, args.messages_per_contact)
+
+        latencies = []
+        for contact_uuid, msisdn in random.sample(contacts, args.samples):
+            start = time.monotonic()
+            delete_contact_pii({"uuid": contact_uuid, "urns": [f"whatsapp:{msisdn}"]})
+            latencies.append(time.monotonic() - start)
+    finally:
+        cleanup()
+
+    latencies.sort()
+    print(f"Erased {len(latencies)} contacts")
+    print(f"mean: {statistics.mean(latencies) * 1000:.1f}ms")
+    for p in (50, 90, 99):
+        print(f"p{p}: {percentile(latencies, p) * 1000:.1f}ms")
@@ -0,0 +1,71 @@
+"""
+Compares the number of connections and the throughput of making requests without
+and with a pooled HTTP session, against a local stub server
+"""
+import argparse
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+class StubServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    connections = 0
+
+    def process_request(self, request, client_address):
+        self.connections += 1
+        return super().process_request(request, client_address)
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def do_PATCH(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        body = b"{}"
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def run(server, url, count, patch):
+    server.connections = 0
+    start = time.time()
+    for i in range(count):
+        response = patch(
+            f"{url}/v1/contacts/{27820000000 + i}/profile",
+            json={"healthcheck_completed": True},
+        )
+        response.raise_for_status()
+    return time.time() - start, server.connections
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--requests", type=int, default=1000)
+    args = parser.parse_args()
+
+    server = StubServer(("127.0.0.1", 0), StubHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_port}"
+
+    session = requests.Session()
+    session.mount("http://", HTTPAdapter(pool_maxsize=10))
+
+    for name, patch in (("requests.patch", requests.patch), ("session", session.patch)):
+        duration, connections = run(server, url, args.requests, patch)
+        print(
+            f"{name}: {args.requests} requests in {duration:.2f}s "
+            f"({args.requests / duration:.0f}/s), {connections} connections"
+        )
+    server.shutdown()
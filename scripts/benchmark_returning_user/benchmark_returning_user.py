@@ -0,0 +1,70 @@
+"""
+Submits returning user HealthChecks to a running hub at a fixed rate, and reports
+the response latencies
+"""
+import argparse
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urljoin
+
+import requests
+
+HEALTHCHECK = {
+    "source": "benchmark",
+    "age": "18-40",
+    "fever": False,
+    "cough": False,
+    "sore_throat": False,
+    "exposure": "no",
+    "tracing": True,
+    "risk": "low",
+}
+PROFILE = {"province": "ZA-WC", "city": "Cape Town"}
+
+
+def submit(session, url, data):
+    start = time.monotonic()
+    response = session.post(url, json=data)
+    response.raise_for_status()
+    return time.monotonic() - start
+
+
+def percentile(values, p):
+    return values[min(int(len(values) * p / 100), len(values) - 1)]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--url", required=True, help="The base URL of the hub")
+    parser.add_argument("--token", required=True, help="The hub auth token")
+    parser.add_argument("--version", default="v3", choices=("v3", "v4"))
+    parser.add_argument("--rate", type=float, default=30, help="Requests per second")
+    parser.add_argument("--requests", type=int, default=900)
+    parser.add_argument("--msisdns", type=int, default=100)
+    args = parser.parse_args()
+
+    url = urljoin(args.url, f"/api/{args.version}/covid19triage/")
+    session = requests.Session()
+    session.headers["Authorization"] = f"Token {args.token}"
+    msisdns = [f"+2782{i:07d}" for i in range(args.msisdns)]
+
+    for msisdn in msisdns:
+        submit(session, url, {**HEALTHCHECK, **PROFILE, "msisdn": msisdn})
+
+    with ThreadPoolExecutor(max_workers=int(args.rate)) as pool:
+        futures = []
+        start = time.monotonic()
+        for i in range(args.requests):
+            time.sleep(max(start + i / args.rate - time.monotonic(), 0))
+            data = {**HEALTHCHECK, "msisdn": msisdns[i % len(msisdns)]}
+            futures.append(pool.submit(submit, session, url, data))
+        latencies = sorted(f.result() * 1000 for f in futures)
+
+    print(
+        f"{len(latencies)} requests at {args.rate}/s: "
+        f"mean {statistics.mean(latencies):.1f}ms, "
+        f"p50 {percentile(latencies, 50):.1f}ms, "
+        f"p95 {percentile(latencies, 95):.1f}ms, "
+        f"p99 {percentile(latencies, 99):.1f}ms"
+    )
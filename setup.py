@@ -31,6 +31,7 @@ setup(
         "openpyxl==2.5.9",
         "iso-639==0.4.5",
         "django-prometheus==1.0.15",
+        "prometheus-client==0.7.1",
         "wabclient==2.2.1",
         "rapidpro-python==2.6.1",
         "pycountry==19.8.18",